@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Benchmark of the lazy changelog parser against the full parsing by
+:class:`debian.changelog.Changelog`, on real changelogs.
+
+The changelogs are given as paths (plain or gzipped), for instance the
+``debian/changelog`` of the glibc, gcc or perl source packages; the
+changelogs of the packages installed locally are used by default. Both
+parsers must give the same results, with the same encoding fallback as
+:func:`swh.loader.debian.loader.get_package_metadata`.
+
+"""
+
+import glob
+import gzip
+import io
+import logging
+import os
+import time
+
+import click
+from debian.changelog import Changelog
+
+from swh.loader.debian.changelog import parse_changelog
+
+
+DEFAULT_CHANGELOGS = '/usr/share/doc/*/changelog.Debian.gz'
+
+
+def full_parse(data):
+    """Get the changelog information with :class:`Changelog`"""
+    try:
+        changelog = Changelog(io.BytesIO(data))
+    except UnicodeDecodeError:
+        changelog = Changelog(io.BytesIO(data), encoding='iso-8859-15')
+    return {
+        'author': changelog.author,
+        'date': changelog.date,
+        'entries': [(block.package, str(block.version))
+                    for block in changelog],
+    }
+
+
+def lazy_parse(data):
+    """Get the changelog information with :func:`parse_changelog`"""
+    try:
+        return parse_changelog(io.BytesIO(data))
+    except UnicodeDecodeError:
+        return parse_changelog(io.BytesIO(data), encoding='iso-8859-15')
+
+
+def best_time(func, data, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ret = func(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, ret
+
+
+@click.command()
+@click.argument('changelogs', nargs=-1, type=click.Path(exists=True))
+@click.option('--top', '-n', default=10, show_default=True,
+              help='Number of (largest) changelogs to report individually')
+@click.option('--repeat', '-r', default=3, show_default=True,
+              help='Number of runs per changelog (the best one is reported)')
+def main(changelogs, top, repeat):
+    # Changelog warns about each line it does not expect
+    logging.disable(logging.WARNING)
+
+    paths = changelogs or sorted(glob.glob(DEFAULT_CHANGELOGS))
+    if not paths:
+        raise click.UsageError('No changelogs found')
+
+    results = []
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            data = f.read()
+        full_time, full = best_time(full_parse, data, repeat)
+        lazy_time, lazy = best_time(lazy_parse, data, repeat)
+        if full != lazy:
+            raise click.ClickException('Different results for %s' % path)
+        results.append((len(data), len(lazy['entries']), full_time,
+                        lazy_time, path))
+    results.sort(reverse=True)
+
+    print('%10s %8s %10s %10s %8s  %s' % (
+        'size (KiB)', 'entries', 'full (ms)', 'lazy (ms)', 'speedup', 'path',
+    ))
+    for size, entries, full_time, lazy_time, path in results[:top]:
+        print('%10d %8d %10.2f %10.2f %8.1f  %s' % (
+            size / 1024, entries, full_time * 1000, lazy_time * 1000,
+            full_time / lazy_time, os.path.relpath(path),
+        ))
+
+    full_total = sum(result[2] for result in results)
+    lazy_total = sum(result[3] for result in results)
+    print('%10d %8d %10.2f %10.2f %8.1f  total (%d changelogs)' % (
+        sum(result[0] for result in results) / 1024,
+        sum(result[1] for result in results),
+        full_total * 1000, lazy_total * 1000, full_total / lazy_total,
+        len(results),
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Scaling benchmark of the branch deduplication done in
+:meth:`DebianLoader.prepare`, on synthetic origins where each package
+version is published in several suites."""
+
+import hashlib
+import time
+
+import click
+
+from swh.loader.debian.loader import deduplicate_branches
+
+
+def _sha256(*parts):
+    return hashlib.sha256('/'.join(map(str, parts)).encode()).hexdigest()
+
+
+def make_packages(nb_branches, suites_per_version=3):
+    """Generate nb_branches branches, the same version being published in
+    suites_per_version suites"""
+    packages = {}
+    for i in range(nb_branches):
+        version = '1.%d-1' % (i // suites_per_version)
+        suite = 'suite%d' % (i % suites_per_version)
+        files = {}
+        for name in ('foo_%s.dsc' % version, 'foo_%s.debian.tar.xz' % version,
+                     'foo_1.%d.orig.tar.gz' % (i // (suites_per_version * 4))):
+            files[name] = {
+                'name': name,
+                'uri': 'http://deb.debian.org/debian/pool/main/f/foo/' + name,
+                'size': len(name) * 1000,
+                'md5sum': _sha256('md5', name)[:32],
+                'sha256': _sha256('sha256', name),
+            }
+        packages['%s/main/%s' % (suite, version)] = {
+            'id': i,
+            'name': 'foo',
+            'version': version,
+            'revision_id': None,
+            'files': files,
+        }
+    return packages
+
+
+@click.command()
+@click.option('--branches', '-b', multiple=True, type=int,
+              default=[10000, 30000, 100000], show_default=True,
+              help='Number of branches to deduplicate')
+@click.option('--repeat', '-r', default=3, show_default=True,
+              help='Number of runs per size (the best one is reported)')
+def main(branches, repeat):
+    print('%10s %10s %10s %12s' % (
+        'branches', 'versions', 'time (s)', 'us/branch',
+    ))
+    for nb_branches in branches:
+        packages = make_packages(nb_branches)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            _, branches_revs = deduplicate_branches(packages)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('%10d %10d %10.3f %12.2f' % (
+            nb_branches, len(branches_revs), best,
+            best / nb_branches * 1e6,
+        ))
+
+
+if __name__ == '__main__':
+    main()
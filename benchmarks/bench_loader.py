@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Offline benchmark of the Debian loader on synthetic source packages.
+
+Packages are generated once (with dpkg-source) in the work directory, then
+served by a local HTTP server. Each scenario is loaded in a fresh process,
+against an in-memory storage and a SQLite lister database, and reported
+with the time spent in each stage, the peak RSS and the peak disk usage of
+the scratch directory.
+
+"""
+
+import functools
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import threading
+import time
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import click
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import PackageSpec, build_packages, package_files  # noqa: E402
+
+
+MiB = 1024 * 1024
+
+SCENARIOS = {
+    # many small files
+    'small-files': lambda scale: [
+        PackageSpec('smallfiles', nb_files=int(5000 * scale),
+                    file_size=2048),
+    ],
+    # a few huge, incompressible files
+    'huge-files': lambda scale: [
+        PackageSpec('hugefiles', nb_files=4, file_size=int(64 * MiB * scale),
+                    compressible=False),
+    ],
+    'native': lambda scale: [
+        PackageSpec('native', source_format='3.0 (native)',
+                    nb_files=int(1000 * scale), file_size=4096,
+                    nb_versions=2),
+    ],
+    'format-1.0': lambda scale: [
+        PackageSpec('oldformat', source_format='1.0',
+                    nb_files=int(1000 * scale), file_size=4096,
+                    nb_versions=2),
+    ],
+    # many versions sharing an orig tarball
+    'shared-orig': lambda scale: [
+        PackageSpec('sharedorig', nb_files=int(1000 * scale),
+                    file_size=4096, nb_versions=10),
+    ],
+}
+
+# the stages reported by the loader (see swh.loader.debian.metrics) shown
+STAGES = ('download', 'unpack', 'extract', 'hash', 'metadata', 'prune',
+          'store', 'flush')
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(directory):
+    """Serve directory over HTTP on a local port, in a background thread.
+
+    Returns:
+        str: the base URI of the server
+
+    """
+    handler = functools.partial(QuietHandler, directory=directory) \
+        if sys.version_info >= (3, 7) else QuietHandler
+    if sys.version_info < (3, 7):
+        os.chdir(directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def generate(scenario, scale, datadir, regenerate=False):
+    """Build the packages of scenario in datadir (unless already there).
+
+    Returns:
+        list: (name, version, dsc path) tuples
+
+    """
+    outdir = os.path.join(datadir, '%s-%s' % (scenario, scale))
+    index = os.path.join(outdir, 'index.json')
+    if regenerate:
+        shutil.rmtree(outdir, ignore_errors=True)
+    if not os.path.exists(index):
+        packages = []
+        for spec in SCENARIOS[scenario](scale):
+            for version, dsc_path in build_packages(spec, outdir):
+                packages.append((spec.name, version, dsc_path))
+        with open(index, 'w') as f:
+            json.dump(packages, f)
+    with open(index) as f:
+        return json.load(f)
+
+
+class DiskMonitor:
+    """Poll the disk usage of a directory tree, keeping its peak"""
+
+    def __init__(self, path, interval=0.05):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def usage(self):
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files + dirs:
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                total += st.st_blocks * 512
+        return total
+
+    def run(self):
+        while not self.stop.is_set():
+            self.peak = max(self.peak, self.usage())
+            self.stop.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop.set()
+        self.thread.join()
+
+
+def loader_config(workdir, overrides):
+    from swh.loader.debian.loader import DebianLoader
+
+    config = {
+        key: default for key, (_, default) in
+        list(DebianLoader.DEFAULT_CONFIG.items())
+        + list(DebianLoader.ADDITIONAL_CONFIG.items())
+    }
+    config.update({
+        'storage': {'cls': 'memory', 'args': {}},
+        'content_size_limit': 100 * MiB,
+        'lister_db_url': 'sqlite:///%s' % os.path.join(workdir, 'lister.db'),
+        'scratch_dirs': [{'path': os.path.join(workdir, 'scratch')}],
+    })
+    config.update(overrides)
+    return config
+
+
+def run_scenario(packages, base_uri, workdir, overrides):
+    """Load packages (as returned by :func:`generate`) in a single visit,
+    and measure it"""
+    from swh.loader.debian.loader import DebianLoader
+    from swh.storage.schemata.distribution import (
+        Area, Distribution, Package, SQLBase,
+    )
+
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(os.path.join(workdir, 'scratch'))
+    config = loader_config(workdir, overrides)
+
+    engine = create_engine(config['lister_db_url'])
+    SQLBase.metadata.create_all(engine)
+    db_session = sessionmaker(bind=engine)()
+    area = Area(distribution=Distribution(name='Debian', type='deb',
+                                          mirror_uri=base_uri),
+                name='main')
+    branches = {}
+    for name, version, dsc_path in packages:
+        files = package_files(dsc_path, '%s/%s' % (
+            base_uri, os.path.basename(os.path.dirname(dsc_path))))
+        package = Package(area=area, name=name, version=version,
+                          directory='', files=files)
+        db_session.add(package)
+        db_session.flush()
+        branches['sid/main/%s' % version] = {
+            'id': package.id,
+            'name': name,
+            'version': version,
+            'revision_id': None,
+            'files': files,
+        }
+    db_session.commit()
+
+    class BenchLoader(DebianLoader):
+        def parse_config_file(self, *args, **kwargs):
+            return config
+
+    loader = BenchLoader()
+    with DiskMonitor(os.path.join(workdir, 'scratch')) as disk:
+        start = time.perf_counter()
+        status = loader.load(origin='http://bench/%s' % packages[0][0],
+                             date='2019-01-01 00:00:00+00',
+                             packages=branches)
+        total = time.perf_counter() - start
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    maxrss_children = \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return {
+        'status': status['status'],
+        'versions': len(branches),
+        'contents': len(loader.storage._contents),
+        'directories': len(loader.storage._directories),
+        'total': total,
+        'stages': {
+            stage: stats['seconds'] for stage, stats in
+            status.get('stats', {}).get('stages', {}).items()
+        },
+        'maxrss': maxrss,
+        'maxrss_children': maxrss_children,
+        'disk': disk.peak,
+    }
+
+
+def _run_in_process(queue, *args):
+    queue.put(run_scenario(*args))
+
+
+@click.command()
+@click.option('--scenario', '-s', 'scenarios', multiple=True,
+              type=click.Choice(sorted(SCENARIOS)),
+              help='Scenario to run (default: all)')
+@click.option('--scale', default=1.0, show_default=True,
+              help='Multiply the number or size of files by this factor')
+@click.option('--workdir', default='bench-loader', show_default=True,
+              help='Where to generate the packages and run the loader')
+@click.option('--regenerate', is_flag=True,
+              help='Generate the packages again')
+@click.option('--config', '-c', 'overrides', multiple=True,
+              help='Loader configuration override, as key=python literal')
+@click.option('--json', 'json_output', type=click.File('w'),
+              help='Also write the results to this file')
+def main(scenarios, scale, workdir, regenerate, overrides, json_output):
+    """Benchmark the Debian loader on synthetic source packages."""
+    import ast
+
+    overrides = dict(
+        (key, ast.literal_eval(value))
+        for key, value in (o.split('=', 1) for o in overrides)
+    )
+    workdir = os.path.abspath(workdir)
+    datadir = os.path.join(workdir, 'data')
+    os.makedirs(datadir, exist_ok=True)
+    base_uri = serve(datadir)
+
+    # each scenario runs in a fresh process, for its peak RSS to be its own
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    header = ('%-12s %8s %8s %8s' + ' %8s' * len(STAGES) + ' %9s %9s') % (
+        ('scenario', 'versions', 'contents', 'total')
+        + STAGES + ('rss (MiB)', 'disk (MiB)'))
+    print(header)
+    for scenario in scenarios or sorted(SCENARIOS):
+        packages = generate(scenario, scale, datadir, regenerate)
+        queue = ctx.Queue()
+        process = ctx.Process(target=_run_in_process, args=(
+            queue, packages, base_uri, os.path.join(workdir, 'run'),
+            overrides,
+        ))
+        process.start()
+        result = queue.get()
+        process.join()
+        results[scenario] = result
+
+        print(('%-12s %8d %8d %8.2f' + ' %8.2f' * len(STAGES)
+               + ' %9.1f %9.1f') % (
+                   (scenario, result['versions'], result['contents'],
+                    result['total'])
+                   + tuple(result['stages'].get(stage, 0)
+                           for stage in STAGES)
+                   + (max(result['maxrss'], result['maxrss_children']) / MiB,
+                      result['disk'] / MiB)))
+        if result['status'] != 'eventful':
+            print('  status: %s' % result['status'])
+
+    if json_output:
+        json.dump({'scale': scale, 'config': overrides,
+                   'results': results}, json_output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
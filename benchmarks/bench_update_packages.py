@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Benchmark of the write-back of revision ids to the lister database at
+the end of a visit, row by row (as previously done) and in bulk.
+
+Run it against a scratch PostgreSQL database: its package tables are
+created if needed, and emptied.
+
+"""
+
+import hashlib
+import time
+
+import click
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from swh.loader.debian.loader import update_packages_revisions
+from swh.storage.schemata.distribution import (
+    Area, Distribution, Package, SQLBase,
+)
+
+
+def populate(db_session, nb_packages):
+    """Create nb_packages packages without revision in the database"""
+    for model in (Package, Area, Distribution):
+        db_session.query(model).delete()
+    dist = Distribution(name='Debian', type='deb',
+                        mirror_uri='http://deb.debian.org/debian/')
+    area = Area(distribution=dist, name='main')
+    db_session.add(area)
+    db_session.flush()
+    db_session.bulk_insert_mappings(Package, [
+        {
+            'area_id': area.id,
+            'name': 'foo',
+            'version': '1.%d-1' % i,
+            'directory': 'pool/main/f/foo',
+            'files': {},
+        }
+        for i in range(nb_packages)
+    ])
+    db_session.commit()
+    return {
+        package_id: hashlib.sha1(str(package_id).encode()).digest()
+        for (package_id,) in db_session.query(Package.id)
+    }
+
+
+def update_row_by_row(db_session, revisions):
+    """The previous implementation of DebianLoader.update_packages"""
+    for package_id, rev in revisions.items():
+        db_package = db_session.query(Package)\
+                               .filter(Package.id == package_id)\
+                               .one()
+        db_package.revision_id = rev
+    db_session.commit()
+
+
+def check(db_session, revisions):
+    db_session.expire_all()
+    stored = dict(db_session.query(Package.id, Package.revision_id))
+    assert stored == revisions, 'revision ids were not all written back'
+
+
+@click.command()
+@click.option('--db-url', default='postgresql:///bench-lister-debian',
+              show_default=True, help='Scratch lister database')
+@click.option('--packages', '-n', multiple=True, type=int,
+              default=[10000, 50000], show_default=True,
+              help='Number of packages to update')
+def main(db_url, packages):
+    engine = create_engine(db_url)
+    SQLBase.metadata.create_all(engine)
+    db_session = sessionmaker(bind=engine)()
+
+    print('%10s %14s %14s' % ('packages', 'row by row (s)', 'bulk (s)'))
+    for nb_packages in packages:
+        timings = []
+        for update in (update_row_by_row, update_packages_revisions):
+            revisions = populate(db_session, nb_packages)
+            start = time.perf_counter()
+            update(db_session, revisions)
+            timings.append(time.perf_counter() - start)
+            check(db_session, revisions)
+        print('%10d %14.3f %14.3f' % (nb_packages, *timings))
+
+
+if __name__ == '__main__':
+    main()
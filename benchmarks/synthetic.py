@@ -0,0 +1,202 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Generation of synthetic Debian source packages, built with dpkg-source.
+
+The generated data only depends on the parameters of the packages (file
+contents are drawn from a seeded generator), so that benchmark runs are
+comparable.
+
+"""
+
+import hashlib
+import os
+import random
+import shutil
+import subprocess
+import tarfile
+
+from debian.deb822 import Dsc
+
+
+CHANGELOG_ENTRY = """\
+%(name)s (%(version)s) unstable; urgency=medium
+
+  * Synthetic release %(version)s.
+
+ -- Benchmark Maintainer <bench@example.org>  %(date)s
+
+"""
+
+CONTROL = """\
+Source: %(name)s
+Section: misc
+Priority: optional
+Maintainer: Benchmark Maintainer <bench@example.org>
+Standards-Version: 4.3.0
+
+Package: %(name)s
+Architecture: all
+Description: synthetic package
+ Generated for benchmarks.
+"""
+
+
+class PackageSpec:
+    """Parameters of a synthetic source package.
+
+    Args:
+        name (str): source package name
+        source_format (str): '1.0', '3.0 (native)' or '3.0 (quilt)'
+        nb_files (int): number of upstream files
+        file_size (int): size of each upstream file, in bytes
+        nb_versions (int): number of versions, which share the same
+          upstream tarball (unless the format is native)
+        compressible (bool): whether file contents are text-like (as
+          opposed to random data)
+        seed (int): the seed of the file contents generator
+
+    """
+
+    def __init__(self, name, source_format='3.0 (quilt)', nb_files=100,
+                 file_size=1024, nb_versions=1, compressible=True, seed=0):
+        self.name = name
+        self.source_format = source_format
+        self.nb_files = nb_files
+        self.file_size = file_size
+        self.nb_versions = nb_versions
+        self.compressible = compressible
+        self.seed = seed
+
+    @property
+    def native(self):
+        return self.source_format == '3.0 (native)'
+
+    def versions(self):
+        if self.native:
+            return ['1.%d' % i for i in range(self.nb_versions)]
+        return ['1.0-%d' % (i + 1) for i in range(self.nb_versions)]
+
+
+def _file_data(rng, size, compressible):
+    if not compressible:
+        return rng.getrandbits(8 * size).to_bytes(size, 'little') \
+            if size else b''
+    words = [b'static', b'int', b'return', b'void', b'char', b'0x%x',
+             b'struct', b'const', b'if', b'else', b'\n', b'{', b'}', b';']
+    out = bytearray()
+    while len(out) < min(size, 65536):
+        out += rng.choice(words) + b' '
+    # large files repeat their first 64KiB, to keep generation fast
+    return bytes(out) * (size // len(out) + 1) if size else b''
+
+
+def _write_tree(spec, srcdir):
+    rng = random.Random(spec.seed)
+    files_per_dir = 100
+    for i in range(spec.nb_files):
+        path = os.path.join(srcdir, 'src', 'd%04d' % (i // files_per_dir),
+                            'f%06d.c' % i)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(_file_data(rng, spec.file_size,
+                               spec.compressible)[:spec.file_size])
+
+
+def _write_debian_dir(spec, srcdir, versions):
+    debian = os.path.join(srcdir, 'debian')
+    os.makedirs(os.path.join(debian, 'source'), exist_ok=True)
+    with open(os.path.join(debian, 'changelog'), 'w') as f:
+        for i, version in reversed(list(enumerate(versions))):
+            f.write(CHANGELOG_ENTRY % {
+                'name': spec.name,
+                'version': version,
+                'date': 'Mon, %02d Jan 2018 12:00:00 +0000' % (i + 1),
+            })
+    with open(os.path.join(debian, 'control'), 'w') as f:
+        f.write(CONTROL % {'name': spec.name})
+    with open(os.path.join(debian, 'source', 'format'), 'w') as f:
+        f.write(spec.source_format + '\n')
+    with open(os.path.join(debian, 'rules'), 'w') as f:
+        f.write('#!/usr/bin/make -f\n%:\n\tdh $@\n')
+    os.chmod(os.path.join(debian, 'rules'), 0o755)
+
+
+def build_packages(spec, outdir):
+    """Build the versions of the package described by spec in outdir.
+
+    Returns:
+        list: (version, dsc path) tuples
+
+    """
+    workdir = os.path.join(outdir, '.build-%s' % spec.name)
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    os.makedirs(outdir, exist_ok=True)
+
+    upstream_version = '1.0'
+    srcdir = os.path.join(workdir, '%s-%s' % (spec.name, upstream_version))
+    _write_tree(spec, srcdir)
+
+    if not spec.native:
+        orig = os.path.join(workdir, '%s_%s.orig.tar.gz' %
+                            (spec.name, upstream_version))
+        with tarfile.open(orig, 'w:gz', compresslevel=1) as tar:
+            tar.add(srcdir, arcname=os.path.basename(srcdir))
+
+    ret = []
+    versions = spec.versions()
+    for i, version in enumerate(versions):
+        _write_debian_dir(spec, srcdir, versions[:i + 1])
+        if spec.native:
+            upstream_version = version
+            dirname = '%s-%s' % (spec.name, version)
+            os.rename(srcdir, os.path.join(workdir, dirname))
+            srcdir = os.path.join(workdir, dirname)
+        subprocess.check_call(
+            ['dpkg-source', '-Zgzip', '-z1', '-b',
+             os.path.basename(srcdir)],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        dsc_name = '%s_%s.dsc' % (spec.name, version)
+        with open(os.path.join(workdir, dsc_name), 'rb') as f:
+            filenames = [dsc_name] + [
+                entry['name'] for entry in Dsc(f)['Files']
+            ]
+        for filename in filenames:
+            dest = os.path.join(outdir, filename)
+            if not os.path.exists(dest):
+                os.link(os.path.join(workdir, filename), dest)
+        ret.append((version, os.path.join(outdir, dsc_name)))
+
+    shutil.rmtree(workdir)
+    return ret
+
+
+def package_files(dsc_path, base_uri):
+    """The files of the package at dsc_path, in the format of the lister
+    database, with URIs relative to base_uri"""
+    with open(dsc_path, 'rb') as f:
+        filenames = [os.path.basename(dsc_path)] + [
+            entry['name'] for entry in Dsc(f)['Files']
+        ]
+    files = {}
+    for filename in filenames:
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        with open(os.path.join(os.path.dirname(dsc_path), filename),
+                  'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+                sha256.update(chunk)
+        files[filename] = {
+            'name': filename,
+            'uri': '%s/%s' % (base_uri.rstrip('/'), filename),
+            'size': os.path.getsize(os.path.join(os.path.dirname(dsc_path),
+                                                 filename)),
+            'md5sum': md5.hexdigest(),
+            'sha256': sha256.hexdigest(),
+        }
+    return files
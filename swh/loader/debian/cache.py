@@ -0,0 +1,171 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+class ArtifactCache:
+    """Node-local cache of source package files, addressed by their sha256.
+
+    The cache is shared by all the workers of a node: a file lock per
+    artifact makes sure only one of them downloads a given artifact, the
+    others waiting for it to be available. Entries are evicted in least
+    recently used order when the cache grows over `max_size` bytes.
+
+    Args:
+        root (str): the directory holding the cache
+        max_size (int): the eviction threshold, in bytes
+
+    """
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.objects_dir = os.path.join(root, 'objects')
+        self.locks_dir = os.path.join(root, 'locks')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+
+    def path(self, sha256):
+        """Path of the cache entry for the artifact with the given sha256"""
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def _info_path(self, sha256):
+        return '%s.json' % self.path(sha256)
+
+    def _lock_path(self, sha256):
+        return os.path.join(self.locks_dir, '%s.lock' % sha256)
+
+    @contextlib.contextmanager
+    def _locked(self, lock_path, blocking=True):
+        """Hold an exclusive lock on lock_path; yield whether it was acquired
+        (always True when blocking).
+
+        :meth:`evict` removes the lock file of an entry while holding it:
+        a lock acquired on a lock file which is not at lock_path anymore is
+        not held, and lock_path is locked again.
+
+        """
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        while True:
+            with open(lock_path, 'a') as lockfile:
+                try:
+                    fcntl.flock(lockfile, flags)
+                except BlockingIOError:
+                    yield False
+                    return
+                try:
+                    current = os.path.samestat(os.stat(lock_path),
+                                               os.fstat(lockfile.fileno()))
+                except FileNotFoundError:
+                    current = False
+                if not current:
+                    continue
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+                return
+
+    def fetch(self, sha256, dest, fill):
+        """Put the artifact with the given sha256 at dest.
+
+        The artifact is hardlinked from the cache (or copied when the cache
+        is on another filesystem). On a cache miss, `fill` is called with a
+        temporary path to write the artifact to; it must raise if the
+        artifact could not be retrieved or did not match its checksums, and
+        return a (json-serializable) dict of information about the artifact,
+        which is kept alongside it.
+
+        Returns:
+            dict: the information about the artifact returned by `fill`
+
+        """
+        path = self.path(sha256)
+        info_path = self._info_path(sha256)
+        with self._locked(self._lock_path(sha256)):
+            hit = os.path.exists(path)
+            if hit:
+                os.utime(path)
+                with open(info_path) as f:
+                    info = json.load(f)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = '%s.%s.%s.tmp' % (path, os.getpid(),
+                                             threading.get_ident())
+                try:
+                    info = fill(tmp_path)
+                    with open(info_path, 'w') as f:
+                        json.dump(info, f)
+                    os.rename(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+
+            try:
+                os.link(path, dest)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.copyfile(path, dest)
+
+        log.debug('Artifact %s %s the cache', sha256,
+                  'found in' if hit else 'added to', extra={
+                      'swh_type': 'deb_cache_hit' if hit else 'deb_cache_miss',
+                      'swh_sha256': sha256,
+                  })
+
+        if not hit:
+            self.evict()
+
+        return info
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        max_size. Entries being written or read are left alone."""
+        with self._locked(os.path.join(self.root, 'evict.lock'),
+                          blocking=False) as acquired:
+            if not acquired:
+                # another worker is already evicting entries
+                return
+
+            entries = []
+            total = 0
+            for subdir in os.listdir(self.objects_dir):
+                subdir = os.path.join(self.objects_dir, subdir)
+                for name in os.listdir(subdir):
+                    if name.endswith(('.tmp', '.json')):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(subdir, name))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, name))
+                    total += stat.st_size
+
+            entries.sort()
+            for _, size, sha256 in entries:
+                if total <= self.max_size:
+                    break
+                lock_path = self._lock_path(sha256)
+                with self._locked(lock_path, blocking=False) as acquired:
+                    if not acquired:
+                        continue
+                    os.unlink(self.path(sha256))
+                    os.unlink(self._info_path(sha256))
+                    os.unlink(lock_path)
+                total -= size
@@ -0,0 +1,163 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Lazy parsing of Debian changelogs.
+
+A revision only needs the author and date of the first entry of the
+changelog, and the package and version of each entry. :func:`parse_changelog`
+follows the state machine of :class:`debian.changelog.Changelog` (with its
+default, lenient, settings) to get them with the same results, but only
+decodes and matches the heading and trailer lines of the entries: the lines
+of changes are skipped, once the whole changelog is checked to be valid in
+its encoding.
+
+"""
+
+import codecs
+
+from debian.changelog import (
+    comments, cvs_keyword, emacs_variables, endline, more_comments,
+    old_format_re1, old_format_re2, old_format_re3, old_format_re4,
+    old_format_re5, old_format_re6, old_format_re7, old_format_re8, topline,
+    vim_variables,
+)
+from debian.debian_support import Version
+
+
+# The states of the parser
+FIRST_HEADING = 'first heading'
+NEXT_HEADING = 'next heading'
+IN_ENTRY = 'in entry'
+TRAILING_LINES = 'trailing lines'
+
+OLD_FORMAT = (old_format_re1, old_format_re2, old_format_re3, old_format_re4,
+              old_format_re5, old_format_re6, old_format_re7, old_format_re8)
+
+# Size of the chunks of data checked to be valid in the encoding
+CHECK_CHUNK_SIZE = 1024 * 1024
+
+
+def _ends_entries(line):
+    """Whether line, found between entries, ends the entries of the
+    changelog: editor variables, or a changelog in an old format (unless
+    it is a comment)"""
+    if (emacs_variables.match(line) is not None
+            or vim_variables.match(line) is not None):
+        return True
+    if (cvs_keyword.match(line) is not None
+            or comments.match(line) is not None
+            or more_comments.match(line) is not None):
+        return False
+    return any(regexp.match(line) is not None for regexp in OLD_FORMAT)
+
+
+def _version_string(version):
+    """The equivalent of ``str(Version(version))``, without the cost of
+    building a :class:`Version`: version itself, once checked to be valid.
+
+    Raises:
+        ValueError: if version is not a valid version
+
+    """
+    if version is None:
+        return str(None)
+    m = Version.re_valid_version.match(version)
+    if not m or (m.group('epoch') is None
+                 and ':' in m.group('upstream_version')):
+        raise ValueError('Invalid version string %r' % version)
+    return version
+
+
+def check_encoding(data, encoding):
+    """Check that data can be decoded with encoding, without decoding it
+    all at once.
+
+    Raises:
+        UnicodeDecodeError: if data cannot be decoded
+
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    view = memoryview(data)
+    for i in range(0, len(data), CHECK_CHUNK_SIZE):
+        decoder.decode(view[i:i + CHECK_CHUNK_SIZE])
+    decoder.decode(b'', final=True)
+
+
+def parse_changelog(changelog, encoding='utf-8'):
+    """Parse the information needed to build a revision from a changelog.
+
+    Args:
+        changelog: the changelog, as a binary file
+        encoding (str): the encoding of the changelog
+
+    Returns:
+        dict: with the following keys, as :class:`Changelog` would return
+        them
+
+        - author (str): the author of the first entry (None if it has no
+          trailer)
+        - date (str): the date of the first entry (None if it has no
+          trailer)
+        - entries (list): (package, version) of each entry
+
+    Raises:
+        UnicodeDecodeError: if the changelog cannot be decoded with
+          encoding, as :class:`Changelog` does
+
+    """
+    data = changelog.read()
+    check_encoding(data, encoding)
+
+    author = date = None
+    entries = []
+    state = FIRST_HEADING
+    pos = 0
+    while pos < len(data) and state != TRAILING_LINES:
+        if state == IN_ENTRY:
+            # skip the changes, up to the next trailer line
+            trailer = data.find(b'\n -- ', pos - 1)
+            if trailer < 0:
+                break
+            pos = trailer + 1
+
+        end = data.find(b'\n', pos)
+        if end < 0:
+            end = len(data)
+        line = data[pos:end]
+        pos = end + 1
+
+        if not line.strip():
+            # blank lines between entries are ignored (and ASCII)
+            continue
+
+        line = line.decode(encoding)
+        if state == IN_ENTRY:
+            match = endline.match(line)
+            if match is not None:
+                if not entries[1:]:
+                    author = '%s <%s>' % (match.group(1), match.group(2))
+                    date = match.group(4)
+                state = NEXT_HEADING
+            continue
+
+        match = topline.match(line)
+        if match is not None:
+            entries.append((match.group(1), match.group(2)))
+            state = IN_ENTRY
+        elif state == NEXT_HEADING and _ends_entries(line):
+            state = TRAILING_LINES
+
+    if state == FIRST_HEADING:
+        # Changelog ends up with an empty entry
+        entries.append((None, None))
+
+    return {
+        'author': author,
+        'date': date,
+        'entries': [
+            (package, _version_string(version))
+            for package, version in entries
+        ],
+    }
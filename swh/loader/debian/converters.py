@@ -3,8 +3,6 @@
 # License: GNU General Public License version 3, or any later version
 # See top-level LICENSE file for more information
 
-import copy
-import datetime
 import email.utils
 import logging
 
@@ -23,15 +21,10 @@ def package_metadata_to_revision(package, directory, metadata):
     """Convert a package dictionary to a revision suitable for storage.
 
     Args:
-        package: a dictionary with the following keys:
-
-            - metadata: the metadata for the package, containing::
-
-                package_info:
-                    changelog
-                    pgp_signature
-
-            - directory
+        package (dict): the package, with name and version keys
+        directory: the root directory of the package (anything with a
+          ``hash`` attribute)
+        metadata (PackageMetadata): the metadata of the package
 
     Returns:
         A revision suitable for persistence in swh.storage
@@ -40,20 +33,8 @@ def package_metadata_to_revision(package, directory, metadata):
     message = 'Synthetic revision for Debian source package %s version %s' % (
         package['name'], package['version'])
 
-    def prepare(obj):
-        if isinstance(obj, list):
-            return [prepare(item) for item in obj]
-        elif isinstance(obj, dict):
-            return {k: prepare(v) for k, v in obj.items()}
-        elif isinstance(obj, datetime.datetime):
-            return obj.isoformat()
-        elif isinstance(obj, bytes):
-            return obj.decode('utf-8')
-        else:
-            return copy.deepcopy(obj)
-
-    author = metadata['package_info']['changelog']['person']
-    date = metadata['package_info']['changelog']['date']
+    author = metadata.changelog.person
+    date = metadata.changelog.date
 
     ret = {
         'author': author,
@@ -65,7 +46,7 @@ def package_metadata_to_revision(package, directory, metadata):
         'message': message.encode('utf-8'),
         'synthetic': True,
         'parents': [],
-        'metadata': prepare(metadata),
+        'metadata': metadata.to_revision_metadata(),
     }
 
     rev_id = bytes.fromhex(identifiers.revision_identifier(ret))
@@ -0,0 +1,645 @@
+# Copyright (C) 2015-2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import concurrent.futures
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+from urllib.request import url2pathname
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from swh.model import hashutil
+
+from .cache import ArtifactCache
+from .exceptions import PackageDownloadFailed, ScratchSpaceExhausted
+from .hashing import hash_file
+from .records import OriginalArtifact
+from .scratch import ScratchSpace
+
+
+log = logging.getLogger(__name__)
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# HTTP statuses worth retrying on the same mirror
+TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# The ioctl sharing the data of a file with another one, on copy-on-write
+# filesystems (FICLONE, on Linux)
+FICLONE = 0x40049409
+
+
+def _debian_to_hashlib(hashname):
+    """Convert Debian hash names to hashlib-compatible names"""
+    return {
+        'md5sum': 'md5',
+    }.get(hashname, hashname)
+
+
+def _debian_hashes(fileinfo):
+    """The hashlib names of the checksums declared by Debian in fileinfo,
+    indexed by their Debian names"""
+    return {
+        hashname: _debian_to_hashlib(hashname)
+        for hashname in fileinfo
+        if hashname not in ('name', 'size', 'uri')
+    }
+
+
+def _checksums_mismatch(fileinfo, size, artifact_info):
+    """Describe how the file at size, with the hashes in artifact_info,
+    differs from fileinfo; None if it does not"""
+    debian_hashes = _debian_hashes(fileinfo)
+    if (size == fileinfo['size']
+            and all(artifact_info[algo] == fileinfo[hashname]
+                    for hashname, algo in debian_hashes.items())):
+        return None
+
+    downloadinfo = {
+        'name': fileinfo['name'],
+        'size': size,
+    }
+    for hashname, algo in debian_hashes.items():
+        downloadinfo[hashname] = artifact_info[algo]
+    return 'Checksums mismatch: fetched %s, expected %s' % (
+        downloadinfo, {k: v for k, v in fileinfo.items() if k != 'uri'})
+
+
+def link_file(src, dest):
+    """Make the file at src available at dest without copying its data: as a
+    hardlink if possible, else as a reflink, else as a symlink.
+
+    Returns:
+        str: the kind of link made
+
+    """
+    try:
+        os.link(src, dest)
+        return 'hardlink'
+    except OSError:
+        pass
+
+    try:
+        with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+        return 'reflink'
+    except OSError:
+        if os.path.lexists(dest):
+            os.unlink(dest)
+
+    os.symlink(os.path.abspath(src), dest)
+    return 'symlink'
+
+
+def _package_key(package):
+    """Key identifying the download of a given package: its files, with
+    their uris, sizes and checksums"""
+    return (package['name'], str(package['version']), tuple(sorted(
+        (filename, tuple(sorted(fileinfo.items())))
+        for filename, fileinfo in package['files'].items()
+    )))
+
+
+class _TransientError(Exception):
+    """A download attempt failed, but the mirror may serve the file on a
+    later attempt: the data received so far is kept"""
+    pass
+
+
+class _MirrorError(Exception):
+    """The mirror does not serve the expected file: the data received so
+    far is dropped, and the mirror is not tried again"""
+    pass
+
+
+class _PartialFile:
+    """A file being downloaded, and the hashes of the data written to it so
+    far, so that an interrupted download can be resumed.
+
+    Args:
+        path (str): the path of the file
+        size (int): the expected size of the file
+        algos (set): the hashlib names of the hashes to compute on top of
+          the ones of the original artifact
+
+    """
+
+    def __init__(self, path, size, algos):
+        self.file = open(path, 'wb')
+        self.expected_size = size
+        self.algos = algos
+        self.reset()
+
+    def reset(self):
+        """Drop the data received so far"""
+        self.file.seek(0)
+        self.file.truncate()
+        self.size = 0
+        self.multihash = hashutil.MultiHash(length=self.expected_size)
+        self.hashes = {algo: hashlib.new(algo) for algo in self.algos}
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.size += len(chunk)
+        self.multihash.update(chunk)
+        for hash in self.hashes.values():
+            hash.update(chunk)
+
+    def hexdigest(self):
+        """The hexadecimal hashes of the data received so far"""
+        digests = self.multihash.hexdigest()
+        for algo, hash in self.hashes.items():
+            digests[algo] = hash.hexdigest()
+        return digests
+
+    def close(self):
+        self.file.close()
+
+
+class Downloader:
+    """Fetch the files of Debian source packages concurrently.
+
+    HTTP sessions are pooled per mirror host for the lifetime of the
+    downloader, so that connections are kept alive across the files of a
+    package and across packages.
+
+    Failed transfers are retried with an exponential backoff, going round
+    the mirrors serving the file; interrupted transfers are resumed where
+    they stopped. A mirror which does not serve the expected file (as
+    announced by its ``Content-Length``, or as found out once the file is
+    hashed) is not tried again for this file.
+
+    Args:
+        max_workers (int): maximum number of files downloaded at the same
+          time
+        cache (ArtifactCache): the cache to get artifacts from, and store
+          them into, when their sha256 is known
+        scratch (ScratchSpace): where to allocate the directories packages
+          are downloaded to
+        mirrors (list): base URLs of equivalent Debian mirrors: the files
+          whose uri is under one of them can be downloaded from the others
+        retries (int): number of failed attempts retried, per file
+        backoff (float): delay (in seconds) before the first retry, doubled
+          at each subsequent one
+        timeout (float): timeout (in seconds) of the connection to the
+          mirror, and of each read from it
+        local_mirrors (dict): local paths of mirrors, indexed by their base
+          URLs. The files under them, and ``file://`` uris, are used in
+          place: they are linked to (see :func:`link_file`) rather than
+          copied, and must not be written to.
+
+    """
+
+    def __init__(self, max_workers=4, cache=None, scratch=None, mirrors=(),
+                 retries=3, backoff=1, timeout=60, local_mirrors=None):
+        self.max_workers = max_workers
+        self.cache = cache
+        if scratch is None:
+            scratch = ScratchSpace()
+        self.scratch = scratch
+        self.mirrors = [
+            mirror if mirror.endswith('/') else mirror + '/'
+            for mirror in mirrors
+        ]
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # the most specific base URLs first
+        self.local_mirrors = sorted((local_mirrors or {}).items(),
+                                    key=lambda item: len(item[0]),
+                                    reverse=True)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+        )
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.prefetched = {}
+
+    def get_session(self, uri):
+        """Get the pooled HTTP session for the host of uri"""
+        host = urlsplit(uri).netloc
+        with self.sessions_lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.max_workers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[host] = session
+        return session
+
+    def get_mirror_uris(self, uri):
+        """Get the uris of the file at uri on each mirror, starting with uri
+        itself"""
+        for mirror in self.mirrors:
+            if uri.startswith(mirror):
+                path = uri[len(mirror):]
+                return [uri] + [other + path for other in self.mirrors
+                                if other != mirror]
+        return [uri]
+
+    def get_local_path(self, uri):
+        """Get the local path of the file at uri, if it is a ``file://`` uri
+        or it is under a local mirror; None otherwise"""
+        if uri.startswith('file://'):
+            return url2pathname(urlsplit(uri).path)
+        for base_uri, root in self.local_mirrors:
+            if uri.startswith(base_uri):
+                return os.path.join(
+                    root, url2pathname(uri[len(base_uri):].lstrip('/')))
+        return None
+
+    def download_file(self, fileinfo, path):
+        """Retrieve the file described by fileinfo to path: from a local
+        mirror, or from the artifact cache, if possible.
+
+        Args:
+            fileinfo (dict): the file information dict from the package
+              ``files``, with an ``uri`` key
+            path (str): the path where the file is written
+
+        Raises:
+            PackageDownloadFailed: if the download failed or the checksums
+              did not match
+
+        Returns:
+            OriginalArtifact: the original artifact information
+
+        """
+        uri = fileinfo['uri']
+        local_path = self.get_local_path(uri)
+        if local_path is not None:
+            try:
+                return self.use_local_file(fileinfo, local_path, path)
+            except PackageDownloadFailed as e:
+                if uri.startswith('file://'):
+                    raise
+                # the local mirror may be out of sync
+                log.warning('Local copy of %s unusable (%s), downloading it'
+                            % (uri, e), extra={
+                                'swh_type': 'deb_local_mirror_miss',
+                                'swh_uri': uri,
+                            })
+                if os.path.lexists(path):
+                    os.unlink(path)
+
+        if self.cache is None or 'sha256' not in fileinfo:
+            return self.fetch_file(fileinfo, path)
+
+        info = self.cache.fetch(
+            fileinfo['sha256'], path,
+            lambda tmp_path: self.fetch_file(fileinfo, tmp_path).to_dict(),
+        )
+        # the cached artifact may have been downloaded under another name
+        info['name'] = fileinfo['name']
+        return OriginalArtifact.from_dict(info)
+
+    def use_local_file(self, fileinfo, local_path, path):
+        """Link the file described by fileinfo from local_path to path, and
+        check its checksums, hashing it in place.
+
+        Args:
+            fileinfo (dict): the file information dict from the package
+              ``files``
+            local_path (str): the path of the local copy of the file
+            path (str): the path where the file is linked
+
+        Returns:
+            OriginalArtifact: the original artifact information
+
+        Raises:
+            PackageDownloadFailed: if the local copy is missing, or its
+              checksums did not match
+
+        """
+        try:
+            size = os.path.getsize(local_path)
+        except OSError as e:
+            raise PackageDownloadFailed('Local copy missing: %s' % e)
+        if size != fileinfo['size']:
+            raise PackageDownloadFailed(
+                'Size mismatch: %s has %s bytes, expected %s' %
+                (local_path, size, fileinfo['size']))
+
+        link = link_file(local_path, path)
+        hashes = {
+            algo: hashlib.new(algo)
+            for algo in _debian_hashes(fileinfo).values()
+            if algo not in hashutil.DEFAULT_ALGORITHMS
+        }
+        artifact_info = hash_file(path, length=size,
+                                  extra_hashes=hashes.values()).hexdigest()
+        for algo, hash in hashes.items():
+            artifact_info[algo] = hash.hexdigest()
+
+        mismatch = _checksums_mismatch(fileinfo, size, artifact_info)
+        if mismatch:
+            raise PackageDownloadFailed(mismatch)
+
+        log.debug('Using %s in place (%s)' % (local_path, link), extra={
+            'swh_type': 'deb_local_mirror_hit',
+            'swh_path': local_path,
+            'swh_link': link,
+        })
+        return OriginalArtifact.from_hashes(fileinfo['name'], size,
+                                            artifact_info)
+
+    def fetch_file(self, fileinfo, path):
+        """Download the file described by fileinfo to path, and check its
+        checksums.
+
+        The file is hashed while it is downloaded, both with the checksums
+        declared by Debian and with the ones of the original artifact.
+
+        Args:
+            fileinfo (dict): the file information dict from the package
+              ``files``, with an ``uri`` key
+            path (str): the path where the file is written
+
+        Returns:
+            OriginalArtifact: the original artifact information
+
+        Raises:
+            PackageDownloadFailed: if the download failed or the checksums
+              did not match, on every mirror
+
+        """
+        partial = _PartialFile(path, fileinfo['size'], {
+            algo for algo in _debian_hashes(fileinfo).values()
+            if algo not in hashutil.DEFAULT_ALGORITHMS
+        })
+
+        uris = self.get_mirror_uris(fileinfo['uri'])
+        errors = []
+        failures = 0
+        try:
+            while uris:
+                uri = uris[0]
+                try:
+                    self.fetch_into(uri, partial)
+                    artifact_info = partial.hexdigest()
+                    mismatch = _checksums_mismatch(fileinfo, partial.size,
+                                                   artifact_info)
+                    if mismatch:
+                        raise _MirrorError(mismatch)
+                except _MirrorError as e:
+                    errors.append('%s: %s' % (uri, e))
+                    partial.reset()
+                    uris.pop(0)
+                    continue
+                except (_TransientError, requests.RequestException) as e:
+                    errors.append('%s: %s' % (uri, e))
+                    failures += 1
+                    if failures > self.retries:
+                        break
+                    delay = self.backoff * 2 ** (failures - 1)
+                    log.warning('Download of %s failed (%s), retrying in '
+                                '%ss from byte %s' %
+                                (uri, e, delay, partial.size), extra={
+                                    'swh_type': 'deb_download_retry',
+                                    'swh_uri': uri,
+                                    'swh_offset': partial.size,
+                                    'swh_failures': failures,
+                                })
+                    # go round the mirrors, resuming the download
+                    uris.append(uris.pop(0))
+                    time.sleep(delay)
+                    continue
+
+                return OriginalArtifact.from_hashes(
+                    fileinfo['name'], partial.size, artifact_info)
+        finally:
+            partial.close()
+
+        raise PackageDownloadFailed('Download of %s failed: %s' % (
+            fileinfo['name'], '; '.join(errors)))
+
+    def fetch_into(self, uri, partial):
+        """Download the file at uri into partial, resuming after the data it
+        already holds if the mirror supports it.
+
+        Raises:
+            _TransientError: if the download failed, and may be retried
+            _MirrorError: if the mirror does not serve the expected file
+            requests.RequestException: if the connection failed
+
+        """
+        headers = {}
+        if partial.size:
+            headers['Range'] = 'bytes=%s-' % partial.size
+        r = self.get_session(uri).get(uri, stream=True, headers=headers,
+                                      timeout=self.timeout)
+        with r:
+            if r.status_code == 206 and partial.size:
+                content_range = r.headers.get('Content-Range', '')
+                if content_range != 'bytes %s-%s/%s' % (
+                        partial.size, partial.expected_size - 1,
+                        partial.expected_size):
+                    partial.reset()
+                    raise _TransientError(
+                        'Unexpected range %r' % content_range)
+            elif r.status_code == 200:
+                # the range, if any, is not supported: start over
+                partial.reset()
+            elif r.status_code == 416 or r.status_code in TRANSIENT_STATUSES:
+                if r.status_code == 416:
+                    partial.reset()
+                raise _TransientError('Status code %s' % r.status_code)
+            else:
+                raise _MirrorError('Status code %s: %s' %
+                                   (r.status_code, r.text))
+
+            length = r.headers.get('Content-Length')
+            if (length is not None and 'Content-Encoding' not in r.headers
+                    and partial.size + int(length) != partial.expected_size):
+                raise _MirrorError('Size mismatch: announced %s bytes from '
+                                   'byte %s, expected %s in total' %
+                                   (length, partial.size,
+                                    partial.expected_size))
+
+            # an interrupted transfer loses the chunk being received
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if partial.size + len(chunk) > partial.expected_size:
+                    raise _MirrorError(
+                        'Size mismatch: more than %s bytes' %
+                        partial.expected_size)
+                partial.write(chunk)
+
+        if partial.size < partial.expected_size:
+            raise _TransientError('Interrupted after %s of %s bytes' %
+                                  (partial.size, partial.expected_size))
+
+    def submit(self, package, tempdir):
+        """Schedule the download of all the files of package into tempdir.
+
+        Returns:
+            dict: the futures of the downloads, indexed by file name
+
+        """
+        return {
+            filename: self.executor.submit(
+                self.download_file, fileinfo,
+                os.path.join(tempdir.name, filename),
+            )
+            for filename, fileinfo in package['files'].items()
+        }
+
+    def prefetch(self, package):
+        """Start downloading package in the background, for a later call to
+        :meth:`download_package`. Nothing is done if there is no scratch
+        space available right away."""
+        key = _package_key(package)
+        if key in self.prefetched:
+            return
+
+        try:
+            tempdir = self.scratch.allocate(package, blocking=False)
+        except ScratchSpaceExhausted:
+            return
+        self.prefetched[key] = tempdir, self.submit(package, tempdir)
+
+    def download_package(self, package, tempdir=None, prefetch=None):
+        """Fetch a source package in a temporary directory and check the
+        checksums for all files.
+
+        Args:
+            package (dict): package information dictionary
+            tempdir (tempfile.TemporaryDirectory): the directory to download
+              the files to, owned by the caller. A new one is allocated if
+              missing.
+            prefetch (dict): a package to :meth:`prefetch` once package is
+              downloaded
+
+        Returns:
+            tuple: the directory holding the files
+            (:class:`ScratchDirectory`), and the original artifact
+            information of each file (dict, indexed by file name)
+
+        Raises:
+            PackageDownloadFailed: if any of the files failed to download
+
+        """
+        owned = tempdir is None
+        pending = None
+        if owned:
+            pending = self.prefetched.pop(_package_key(package), None)
+
+        if pending:
+            tempdir, futures = pending
+        else:
+            if owned:
+                tempdir = self.scratch.allocate(package)
+            futures = self.submit(package, tempdir)
+
+        try:
+            files_info = {
+                filename: future.result()
+                for filename, future in futures.items()
+            }
+        except BaseException:
+            self._abort(futures, tempdir if owned else None)
+            raise
+
+        if prefetch is not None:
+            self.prefetch(prefetch)
+
+        return tempdir, files_info
+
+    def _abort(self, futures, tempdir=None):
+        """Cancel the pending downloads in futures and remove tempdir"""
+        for future in futures.values():
+            future.cancel()
+        concurrent.futures.wait(futures.values())
+        if tempdir is not None:
+            tempdir.cleanup()
+
+    def cleanup(self):
+        """Drop the downloads prefetched but never used"""
+        while True:
+            try:
+                _, (tempdir, futures) = self.prefetched.popitem()
+            except KeyError:
+                # emptied, possibly by another loader sharing the downloader
+                break
+            self._abort(futures, tempdir)
+
+    def close(self):
+        """Release the worker threads and the HTTP sessions"""
+        self.cleanup()
+        self.executor.shutdown()
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+def download_package(package, downloader=None, tempdir=None, prefetch=None):
+    """Fetch a source package in a temporary directory and check the checksums
+    for all files
+
+    Args:
+        package (dict): package information dictionary
+        downloader (Downloader): the download engine to use; a single use one
+          is created if missing
+        tempdir (tempfile.TemporaryDirectory): the directory to download the
+          files to, owned by the caller; a new one is created if missing
+        prefetch (dict): a package to start downloading once package is
+          downloaded
+
+    Returns:
+        tuple: the directory holding the files, and the original artifact
+        information of each file (see :meth:`Downloader.download_package`)
+
+    """
+    if downloader is not None:
+        return downloader.download_package(package, tempdir=tempdir,
+                                           prefetch=prefetch)
+
+    downloader = Downloader()
+    try:
+        return downloader.download_package(package, tempdir=tempdir)
+    finally:
+        downloader.close()
+
+
+def get_downloader(config, scratch=None):
+    """Instantiate the download engine described by the loader config.
+
+    Args:
+        config (dict): the loader configuration
+        scratch (ScratchSpace): the scratch space to allocate the package
+          directories from, shared with other download engines; if missing,
+          one is set up from the configuration
+
+    """
+    artifact_cache = None
+    if config['artifact_cache_dir']:
+        artifact_cache = ArtifactCache(
+            config['artifact_cache_dir'],
+            config['artifact_cache_max_size'],
+        )
+    if scratch is None:
+        scratch = ScratchSpace(
+            dirs=config['scratch_dirs'],
+            budget=config['scratch_budget'],
+            expansion_factor=config['scratch_expansion_factor'],
+        )
+    return Downloader(
+        max_workers=config['download_max_workers'],
+        cache=artifact_cache,
+        scratch=scratch,
+        mirrors=config['download_mirrors'],
+        retries=config['download_retries'],
+        backoff=config['download_backoff'],
+        timeout=config['download_timeout'],
+        local_mirrors=config['local_mirrors'],
+    )
@@ -0,0 +1,24 @@
+# Copyright (C) 2015-2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+
+class DebianLoaderException(Exception):
+    pass
+
+
+class PackageDownloadFailed(DebianLoaderException):
+    """Raise this exception when a package download failed"""
+    pass
+
+
+class PackageExtractionFailed(DebianLoaderException):
+    """Raise this exception when a package extraction failed"""
+    pass
+
+
+class ScratchSpaceExhausted(DebianLoaderException):
+    """Raise this exception when there is not enough scratch space to
+    process a package"""
+    pass
@@ -0,0 +1,304 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Hash files without copying their data around.
+
+Large files are memory-mapped and hashed in place; smaller ones are read
+into a buffer reused across files. Either way, the data of a file is never
+held in a Python :class:`bytes` object. In particular, the files over the
+loader's content size limit, which are not sent to the archive, are never
+loaded in memory.
+
+The bytes read and mapped by each thread are accounted in its
+:class:`IOStats`.
+
+Successive versions of a package are mostly extracted from the same
+upstream tarball: a :class:`TreeHashCache` keeps the hashes of the files of
+the last trees hashed, so that only the files which changed are hashed
+again.
+
+"""
+
+import collections
+import mmap
+import os
+import resource
+import stat
+import threading
+
+from swh.model.from_disk import (
+    Content, Directory, accept_all_directories, mode_to_perms,
+)
+from swh.model.hashutil import DEFAULT_ALGORITHMS, MultiHash
+
+
+# Size of the buffer files are read into
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Files at least this large are memory-mapped rather than read
+MMAP_MIN_SIZE = READ_BUFFER_SIZE
+
+
+class IOStats:
+    """Amount of file data hashed by a thread.
+
+    Attributes:
+        files (int): the number of files hashed
+        bytes_read (int): the bytes copied from files to the read buffer
+        bytes_mapped (int): the bytes hashed in place from memory-mapped
+          files
+        files_reused (int): the files whose hashes were reused rather than
+          computed
+        bytes_reused (int): the size of these files
+
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes_read = 0
+        self.bytes_mapped = 0
+        self.files_reused = 0
+        self.bytes_reused = 0
+
+    def as_log_extra(self):
+        """The statistics, along with the peak resident set size of the
+        process, as logging extras"""
+        return {
+            'swh_files_hashed': self.files,
+            'swh_bytes_read': self.bytes_read,
+            'swh_bytes_mapped': self.bytes_mapped,
+            'swh_files_reused': self.files_reused,
+            'swh_bytes_reused': self.bytes_reused,
+            'swh_maxrss': get_maxrss(),
+        }
+
+
+_local = threading.local()
+
+
+def get_io_stats():
+    """Get the statistics of the current thread"""
+    try:
+        return _local.stats
+    except AttributeError:
+        return reset_io_stats()
+
+
+def reset_io_stats():
+    """Start accounting for the current thread from scratch"""
+    _local.stats = IOStats()
+    return _local.stats
+
+
+def get_maxrss():
+    """Peak resident set size of the current process, in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _get_buffer():
+    try:
+        return _local.buffer
+    except AttributeError:
+        _local.buffer = bytearray(READ_BUFFER_SIZE)
+        return _local.buffer
+
+
+def hash_file(path, length=None, hash_names=DEFAULT_ALGORITHMS,
+              extra_hashes=()):
+    """Hash the file at path.
+
+    Args:
+        path (str or bytes): the path of the file
+        length (int): the length of the file, if already known
+        hash_names (set): the algorithms to compute
+        extra_hashes (list): :mod:`hashlib` objects to update with the data
+          of the file as well
+
+    Returns:
+        MultiHash: the hashes of the file
+
+    """
+    stats = get_io_stats()
+    with open(path, 'rb') as f:
+        if length is None:
+            length = os.fstat(f.fileno()).st_size
+        h = MultiHash(hash_names=hash_names, length=length)
+        if length >= MMAP_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                h.update(data)
+                for extra in extra_hashes:
+                    extra.update(data)
+            stats.bytes_mapped += length
+        else:
+            buf = _get_buffer()
+            view = memoryview(buf)
+            while True:
+                size = f.readinto(buf)
+                if not size:
+                    break
+                h.update(view[:size])
+                for extra in extra_hashes:
+                    extra.update(view[:size])
+                stats.bytes_read += size
+            view.release()
+    stats.files += 1
+    return h
+
+
+def content_from_file(path, file_stat=None, hashes=None):
+    """Equivalent of :meth:`Content.from_file` (with `save_path`), hashing
+    the file with :func:`hash_file`.
+
+    Args:
+        path (bytes): the path of the file
+        file_stat (os.stat_result): the :func:`os.lstat` of the file, if
+          already known
+        hashes (dict): the hashes of the (regular) file, if already known
+
+    """
+    if file_stat is None:
+        file_stat = os.lstat(path)
+    mode = file_stat.st_mode
+
+    if stat.S_ISLNK(mode):
+        return Content.from_symlink(path=path, mode=mode)
+    elif not stat.S_ISREG(mode):
+        return Content.from_bytes(mode=mode, data=b'')
+
+    if hashes is None:
+        hashes = hash_file(path, length=file_stat.st_size).digest()
+    ret = dict(hashes)
+    ret['path'] = path
+    ret['perms'] = mode_to_perms(mode)
+    ret['length'] = file_stat.st_size
+    return Content(ret)
+
+
+def directory_from_disk(path, dir_filter=accept_all_directories,
+                        known_files=None, files=None, mtime_before=None):
+    """Equivalent of :meth:`Directory.from_disk` (with `save_path`), hashing
+    the files with :func:`hash_file`.
+
+    The hashes of the files of a previously hashed tree can be reused: a
+    regular file with the same path, size and modification time as one of
+    known_files is not hashed again.
+
+    Args:
+        path (bytes): the root of the tree
+        dir_filter: the filter of the directories to include
+        known_files (dict): the files of a previous tree, as filled in files
+        files (dict): if not None, filled with the ``(size, mtime_ns)`` and
+          the hashes of the regular files of the tree, indexed by their path
+          relative to path
+        mtime_before (int): if not None, the files modified since (in
+          nanoseconds since the epoch) are left out of files: their
+          modification time does not identify their contents
+
+    """
+    if known_files is None:
+        known_files = {}
+    stats = get_io_stats()
+    prefix_len = len(os.path.join(path, b''))
+    dirs = {}
+    for root, dentries, fentries in os.walk(path, topdown=False):
+        entries = {}
+        # symbolic links to directories appear in dentries
+        for name in fentries + dentries:
+            entry_path = os.path.join(root, name)
+            if not os.path.isdir(entry_path) or os.path.islink(entry_path):
+                if files is None and not known_files:
+                    entries[name] = content_from_file(entry_path)
+                    continue
+
+                file_stat = os.lstat(entry_path)
+                if not stat.S_ISREG(file_stat.st_mode):
+                    entries[name] = content_from_file(entry_path, file_stat)
+                    continue
+
+                rel_path = entry_path[prefix_len:]
+                identity = (file_stat.st_size, file_stat.st_mtime_ns)
+                hashes = None
+                known = known_files.get(rel_path)
+                if known is not None and known[0] == identity:
+                    hashes = known[1]
+                    stats.files_reused += 1
+                    stats.bytes_reused += file_stat.st_size
+                content = content_from_file(entry_path, file_stat, hashes)
+                entries[name] = content
+                if files is not None and (
+                        mtime_before is None
+                        or file_stat.st_mtime_ns < mtime_before):
+                    if hashes is None:
+                        hashes = {algo: content.data[algo]
+                                  for algo in DEFAULT_ALGORITHMS}
+                    files[rel_path] = (identity, hashes)
+            elif dir_filter(name, dirs[entry_path].entries):
+                entries[name] = dirs[entry_path]
+
+        dirs[root] = Directory({'name': os.path.basename(root)})
+        dirs[root].update(entries)
+
+    return dirs[path]
+
+
+class TreeHashCache:
+    """Hashes of the files of the trees last hashed from each set of upstream
+    tarballs, to reuse them when hashing another tree extracted from the
+    same ones.
+
+    A file is identified by its path, size and modification time, which
+    extraction sets from the tarball: the files patched, or otherwise
+    written by the extraction, are always hashed. So are the files of the
+    ``debian`` directory, which come from the Debian tarball rather than
+    from the upstream ones. Only the regular files are cached; directory
+    identifiers are computed from the entries of each tree, as by
+    :func:`directory_from_disk`.
+
+    Args:
+        max_trees (int): the number of trees whose file hashes are kept,
+          the least recently used ones being dropped first
+
+    """
+
+    def __init__(self, max_trees):
+        self.max_trees = max_trees
+        self.trees = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def directory_from_disk(self, key, path, mtime_before,
+                            dir_filter=accept_all_directories):
+        """Hash the tree at path with :func:`directory_from_disk`, reusing
+        the hashes of the last tree with the same key.
+
+        Args:
+            key: the identifier of the tarballs the tree was extracted from
+            path (bytes): the root of the tree
+            mtime_before (int): the time at which the extraction of the tree
+              started, in nanoseconds since the epoch: the files modified
+              since then are not cached
+            dir_filter: the filter of the directories to include
+
+        """
+        with self.lock:
+            known_files = self.trees.get(key)
+            if known_files is not None:
+                self.trees.move_to_end(key)
+
+        files = {}
+        directory = directory_from_disk(path, dir_filter=dir_filter,
+                                        known_files=known_files, files=files,
+                                        mtime_before=mtime_before)
+
+        files = {
+            rel_path: info for rel_path, info in files.items()
+            if not rel_path.startswith(b'debian/')
+        }
+        with self.lock:
+            self.trees[key] = files
+            self.trees.move_to_end(key)
+            while len(self.trees) > self.max_trees:
+                self.trees.popitem(last=False)
+
+        return directory
@@ -0,0 +1,134 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Compact sets of object identifiers, of bounded size.
+
+The loader remembers the objects it sent, or found in the archive, so that
+the objects shared by the versions of a package are neither looked up nor
+sent again. A Python set of :class:`bytes` takes about 100 bytes per
+identifier, without bound: an :class:`IdSet` packs the identifiers in hash
+tables (with open addressing) of a few bytearrays, and forgets the oldest
+ones once it holds `max_ids` of them.
+
+Forgetting an identifier is harmless: the object is just looked up in the
+archive again. Membership is exact: an identifier is never reported as
+seen if it was not added.
+
+"""
+
+
+# The number of slots of a new table
+MIN_SLOTS = 1024
+
+
+class _Table:
+    """A hash table of identifiers of id_size bytes, in a bytearray of
+    nslots slots, with linear probing. An empty slot is all zeroes."""
+
+    def __init__(self, id_size, nslots):
+        self.id_size = id_size
+        self.nslots = nslots
+        self.mask = nslots - 1
+        self.data = bytearray(id_size * nslots)
+        self.count = 0
+        self.empty = bytes(id_size)
+
+    def _find(self, id):
+        """The slot of id, or else the empty slot where it would go"""
+        size = self.id_size
+        data = self.data
+        slot = int.from_bytes(id[:8], 'little') & self.mask
+        while True:
+            offset = slot * size
+            current = data[offset:offset + size]
+            if current == id:
+                return offset, True
+            if current == self.empty:
+                return offset, False
+            slot = (slot + 1) & self.mask
+
+    def __contains__(self, id):
+        return self._find(id)[1]
+
+    def add(self, id):
+        """Add id, if missing; return whether it was"""
+        offset, found = self._find(id)
+        if found:
+            return False
+        self.data[offset:offset + self.id_size] = id
+        self.count += 1
+        return True
+
+    def ids(self):
+        size = self.id_size
+        for offset in range(0, len(self.data), size):
+            id = bytes(self.data[offset:offset + size])
+            if id != self.empty:
+                yield id
+
+
+class IdSet:
+    """A set of identifiers of a fixed size, holding at most about max_ids
+    of them.
+
+    The identifiers are spread over two generations: once the current
+    generation holds max_ids / 2 identifiers, the previous one is dropped,
+    and a new one is started. The table of a generation grows as needed,
+    doubling so as to stay at most half full: the set takes at most
+    2 * max_ids * id_size bytes when max_ids is a power of two.
+
+    Args:
+        id_size (int): the size of the identifiers, in bytes
+        max_ids (int): the number of identifiers over which the oldest ones
+          are forgotten
+
+    """
+
+    def __init__(self, id_size, max_ids):
+        self.id_size = id_size
+        self.max_ids = max_ids
+        self.clear()
+
+    def clear(self):
+        self.current = _Table(self.id_size, MIN_SLOTS)
+        self.previous = None
+        # the all-zero identifier marks empty slots
+        self.zero = [False, False]
+
+    def _check(self, id):
+        if len(id) != self.id_size:
+            raise ValueError('Expected an identifier of %s bytes, got %r' %
+                             (self.id_size, id))
+        return id == self.current.empty
+
+    def __contains__(self, id):
+        if self._check(id):
+            return any(self.zero)
+        return id in self.current or (self.previous is not None
+                                      and id in self.previous)
+
+    def __len__(self):
+        return (self.current.count + sum(self.zero)
+                + (self.previous.count if self.previous is not None else 0))
+
+    def add(self, id):
+        if self._check(id):
+            self.zero[0] = True
+            return
+
+        if not self.current.add(id):
+            return
+
+        table = self.current
+        if table.count * 2 >= self.max_ids:
+            # start a new generation
+            self.previous = table
+            self.current = _Table(self.id_size, MIN_SLOTS)
+            self.zero = [False, self.zero[0]]
+        elif table.count * 2 > table.nslots:
+            grown = _Table(self.id_size, table.nslots * 2)
+            for existing in table.ids():
+                grown.add(existing)
+            self.current = grown
@@ -0,0 +1,157 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import hashlib
+import logging
+import sqlite3
+
+from swh.storage.schemata.distribution import Package
+
+
+log = logging.getLogger(__name__)
+
+
+def artifact_key(name, version, files):
+    """Compute the key of a source package in the revision index.
+
+    The synthetic revision of a source package only depends on its name, its
+    version and the contents of its files: packages with the same key have
+    the same revision.
+
+    Args:
+        name (str): the source package name
+        version (str): the source package version
+        files (dict): the package files, indexed by file name, with (at
+          least) their sha256
+
+    Returns:
+        str: the key of the package, or None if a file has no sha256
+
+    """
+    h = hashlib.sha256()
+    h.update(('%s\0%s\0' % (name, version)).encode('utf-8'))
+    for filename in sorted(files):
+        sha256 = files[filename].get('sha256')
+        if not sha256:
+            return None
+        h.update(('%s\0%s\0' % (filename, sha256)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def package_key(package):
+    """Key of a package dictionary, as given to the loader"""
+    return artifact_key(package['name'], str(package['version']),
+                        package['files'])
+
+
+class RevisionIndex:
+    """Local index from source packages to the synthetic revisions they were
+    archived as, shared by the loaders of a node.
+
+    Only revisions which made it to the archive must be added to the index.
+
+    Args:
+        path (str): the path to the SQLite database holding the index
+
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=timeout)
+        with self.db:
+            self.db.execute(
+                'create table if not exists revision_index ('
+                '  key text primary key,'
+                '  revision_id blob not null'
+                ')'
+            )
+
+    def get_many(self, keys):
+        """Look the given keys up.
+
+        Returns:
+            dict: the revision ids (bytes) of the keys found in the index
+
+        """
+        keys = list(keys)
+        ret = {}
+        # stay under SQLite's limit on the number of query parameters
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            cur = self.db.execute(
+                'select key, revision_id from revision_index '
+                'where key in (%s)' % ','.join('?' * len(batch)),
+                batch,
+            )
+            ret.update((key, bytes(rev)) for key, rev in cur)
+        return ret
+
+    def add_many(self, items):
+        """Add (key, revision id) pairs to the index"""
+        with self.db:
+            self.db.executemany(
+                'insert or replace into revision_index (key, revision_id) '
+                'values (?, ?)',
+                ((key, bytes(rev)) for key, rev in items),
+            )
+
+    def build_from_lister_db(self, db_session, batch_size=10000):
+        """Add all the packages with a revision in the lister database to
+        the index.
+
+        Returns:
+            int: the number of packages added
+
+        """
+        count = 0
+        batch = []
+        query = db_session.query(Package)\
+                          .filter(Package.revision_id.isnot(None))\
+                          .yield_per(batch_size)
+        for package in query:
+            key = artifact_key(package.name, package.version, package.files)
+            if key is None:
+                continue
+            batch.append((key, package.revision_id))
+            if len(batch) >= batch_size:
+                self.add_many(batch)
+                count += len(batch)
+                batch = []
+        self.add_many(batch)
+        count += len(batch)
+
+        log.info('Added %s packages to the revision index %s' %
+                 (count, self.path), extra={
+                     'swh_type': 'deb_index_build',
+                     'swh_index': self.path,
+                     'swh_count': count,
+                 })
+        return count
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == '__main__':
+    import click
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(process)d %(message)s'
+    )
+
+    @click.command()
+    @click.option('--lister-db-url', default='postgresql:///lister-debian',
+                  help='Debian lister database')
+    @click.argument('index_path')
+    def main(lister_db_url, index_path):
+        """Build the revision index at INDEX_PATH from the lister database."""
+        db_session = sessionmaker(bind=create_engine(lister_db_url))()
+        RevisionIndex(index_path).build_from_lister_db(db_session)
+
+    main()
@@ -3,102 +3,105 @@
 # License: GNU General Public License version 3, or any later version
 # See top-level LICENSE file for more information
 
-import copy
-import hashlib
+import collections
+import concurrent.futures
+import io
 import logging
 import os
+import queue
 import re
 import subprocess
 import tempfile
+import threading
+import time
+import types
 
 from dateutil.parser import parse as parse_date
-from debian.changelog import Changelog
 from debian.deb822 import Dsc
-import requests
-from sqlalchemy import create_engine
+from sqlalchemy import bindparam, create_engine, text
 from sqlalchemy.orm import sessionmaker
 
+from swh.core.utils import grouper
 from swh.loader.core.loader import BufferedLoader
 from swh.storage.schemata.distribution import Package
 from swh.model import hashutil
-from swh.model.from_disk import Directory
 from swh.model.identifiers import identifier_to_bytes, snapshot_identifier
 
 from . import converters
+from .changelog import parse_changelog
+from .download import download_package, get_downloader
+from .exceptions import (  # noqa: F401
+    DebianLoaderException, PackageDownloadFailed, PackageExtractionFailed,
+    ScratchSpaceExhausted,
+)
+from .hashing import (
+    TreeHashCache, directory_from_disk, hash_file, reset_io_stats,
+)
+from .idset import IdSet
+from .index import RevisionIndex, package_key
+from .metrics import LoadStats, get_metrics
+from .records import ChangelogInfo, OriginalArtifact, PackageMetadata
+from .resources import get_worker_resources
+from .scratch import package_size
+from .stream import TreeStreamer
+from .unpack import unpack_package
 
 
 UPLOADERS_SPLIT = re.compile(r'(?<=\>)\s*,\s*')
 
+# Number of directory ids checked in a single call to directory_missing
+DIRECTORY_MISSING_BATCH_SIZE = 1000
 
-log = logging.getLogger(__name__)
-
+# Number of lister packages updated in a single statement
+PACKAGE_UPDATE_BATCH_SIZE = 1000
 
-class DebianLoaderException(Exception):
-    pass
+# The storage the core loader sets up when the storage client is shared: an
+# in-memory one, which opens no connection
+PLACEHOLDER_STORAGE_CONFIG = {'cls': 'memory', 'args': {}}
 
+# The upstream tarballs of a package, and their components
+UPSTREAM_TARBALL_RE = re.compile(r'\.orig(-[^./]+)?\.tar\.[^.]+$')
 
-class PackageDownloadFailed(DebianLoaderException):
-    """Raise this exception when a package extraction failed"""
-    pass
 
-
-class PackageExtractionFailed(DebianLoaderException):
-    """Raise this exception when a package extraction failed"""
-    pass
+log = logging.getLogger(__name__)
 
 
-def _debian_to_hashlib(hashname):
-    """Convert Debian hash names to hashlib-compatible names"""
-    return {
-        'md5sum': 'md5',
-    }.get(hashname, hashname)
+def get_dsc_path(package, tempdir):
+    """Get the path of the dsc file of a package downloaded in tempdir
 
+    Raises:
+        PackageExtractionFailed: if the package references several dsc files
 
-def download_package(package):
-    """Fetch a source package in a temporary directory and check the checksums
-    for all files"""
+    """
+    dsc_name = None
+    for filename in package['files']:
+        if filename.endswith('.dsc'):
+            if dsc_name:
+                raise PackageExtractionFailed(
+                    'Package %s_%s references several dsc files' %
+                    (package['name'], package['version'])
+                )
+            dsc_name = filename
 
-    tempdir = tempfile.TemporaryDirectory(
-        prefix='swh.loader.debian.%s.' % package['name']
-    )
+    return os.path.join(tempdir.name, dsc_name)
 
-    for filename, fileinfo in copy.deepcopy(package['files']).items():
-        uri = fileinfo.pop('uri')
-        hashes = {
-            hashname: hashlib.new(_debian_to_hashlib(hashname))
-            for hashname in fileinfo
-            if hashname not in ('name', 'size')
-        }
 
-        r = requests.get(uri, stream=True)
-        if r.status_code != 200:
-            raise PackageDownloadFailed(
-                'Download of %s returned status_code %s: %s' %
-                (uri, r.status_code, r.text)
-            )
+def get_upstream_key(files_info):
+    """Identify the upstream tarballs of a package, by their sha256.
 
-        size = 0
-        with open(os.path.join(tempdir.name, filename), 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024 * 1024):
-                size += len(chunk)
-                f.write(chunk)
-                for hash in hashes.values():
-                    hash.update(chunk)
-
-        downloadinfo = {
-            'name': filename,
-            'size': size,
-        }
-        for hashname, hash in hashes.items():
-            downloadinfo[hashname] = hash.hexdigest()
+    Args:
+        files_info (dict): the :class:`OriginalArtifact` of each file of the
+          package, indexed by file name
 
-        if fileinfo != downloadinfo:
-            raise PackageDownloadFailed(
-                'Checksums mismatch: fetched %s, expected %s' %
-                (downloadinfo, fileinfo)
-            )
+    Returns:
+        tuple: the sorted sha256 of the upstream tarballs, None for a native
+        package
 
-    return tempdir
+    """
+    return tuple(sorted(
+        info.sha256 for filename, info in files_info.items()
+        if UPSTREAM_TARBALL_RE.search(filename)
+    )) or None
 
 
 def extract_package(package, tempdir):
@@ -115,17 +118,7 @@ def extract_package(package, tempdir):
         tuple: path to the dsc (str) and extraction directory (str)
 
     """
-    dsc_name = None
-    for filename in package['files']:
-        if filename.endswith('.dsc'):
-            if dsc_name:
-                raise PackageExtractionFailed(
-                    'Package %s_%s references several dsc files' %
-                    (package['name'], package['version'])
-                )
-            dsc_name = filename
-
-    dsc_path = os.path.join(tempdir.name, dsc_name)
+    dsc_path = get_dsc_path(package, tempdir)
     destdir = os.path.join(tempdir.name, 'extracted')
     logfile = os.path.join(tempdir.name, 'extract.log')
 
@@ -160,25 +153,20 @@ def get_file_info(filepath):
         filepath: the path to the original file
 
     Returns:
-        dict: information about the original file, in a dictionary with the
-        following keys
-
-        - name: the file name
-        - sha1, sha1_git, sha256: original file hashes
-        - length: original file length
+        OriginalArtifact: information about the original file
     """
 
     name = os.path.basename(filepath)
     if isinstance(name, bytes):
         name = name.decode('utf-8')
 
-    hashes = hashutil.MultiHash.from_path(filepath).hexdigest()
-    hashes['name'] = name
-    hashes['length'] = os.path.getsize(filepath)
-    return hashes
+    length = os.path.getsize(filepath)
+    return OriginalArtifact.from_hashes(
+        name, length, hash_file(filepath, length=length).hexdigest())
 
 
-def get_package_metadata(package, dsc_path, extracted_path):
+def get_package_metadata(package, dsc_path, extracted_path, files_info=None,
+                         changelog_data=None):
     """Get the package metadata from the source package at dsc_path,
     extracted in extracted_path.
 
@@ -186,75 +174,82 @@ def get_package_metadata(package, dsc_path, extracted_path):
         package: the package dict (with a dsc_path key)
         dsc_path: path to the package's dsc file
         extracted_path: the path where the package got extracted
+        files_info (dict): the information about the package files, as
+          computed at download time, indexed by file name. Missing files
+          are hashed from disk using :func:`get_file_info`.
+        changelog_data (bytes): the contents of the package changelog, when
+          the package was not extracted to disk
 
     Returns:
-        dict: a dictionary with the following keys:
-
-        - history: list of (package_name, package_version) tuples parsed from
-          the package changelog
-        - source_files: information about all the files in the source package
+        PackageMetadata: the metadata of the package
 
     """
-    ret = {}
-
     with open(dsc_path, 'rb') as dsc:
         parsed_dsc = Dsc(dsc)
 
-    source_files = [get_file_info(dsc_path)]
+    if files_info is None:
+        files_info = {}
 
     dsc_dir = os.path.dirname(dsc_path)
     for filename in package['files']:
-        file_path = os.path.join(dsc_dir, filename)
-        file_info = get_file_info(file_path)
-        source_files.append(file_info)
-
-    ret['original_artifact'] = source_files
+        if filename not in files_info:
+            files_info[filename] = get_file_info(
+                os.path.join(dsc_dir, filename))
+
+    # The dsc file is listed both first and among the package files, as it
+    # always was: the metadata stays consistent with the revisions already
+    # archived.
+    dsc_name = os.path.basename(dsc_path)
+    original_artifact = (files_info[dsc_name],) + tuple(
+        files_info[filename] for filename in package['files']
+    )
 
     # Parse the changelog to retrieve the rest of the package information
-    changelog_path = os.path.join(extracted_path, 'debian/changelog')
-    with open(changelog_path, 'rb') as changelog:
+    changelog_path = os.path.join(extracted_path or '', 'debian/changelog')
+    if changelog_data is not None:
+        changelog_file = io.BytesIO(changelog_data)
+    else:
+        changelog_file = open(changelog_path, 'rb')
+    with changelog_file as changelog:
         try:
-            parsed_changelog = Changelog(changelog)
+            parsed_changelog = parse_changelog(changelog)
         except UnicodeDecodeError:
             log.warn('Unknown encoding for changelog %s,'
-                     ' falling back to iso' %
-                     changelog_path.decode('utf-8'), extra={
+                     ' falling back to iso' % changelog_path, extra={
                          'swh_type': 'deb_changelog_encoding',
                          'swh_name': package['name'],
                          'swh_version': str(package['version']),
-                         'swh_changelog': changelog_path.decode('utf-8'),
+                         'swh_changelog': changelog_path,
                      })
 
-            # need to reset as Changelog scrolls to the end of the file
+            # need to reset as parsing scrolls to the end of the file
             changelog.seek(0)
-            parsed_changelog = Changelog(changelog, encoding='iso-8859-15')
-
-    package_info = {
-        'name': package['name'],
-        'version': str(package['version']),
-        'changelog': {
-            'person': converters.uid_to_person(parsed_changelog.author),
-            'date': parse_date(parsed_changelog.date),
-            'history': [(block.package, str(block.version))
-                        for block in parsed_changelog][1:],
-        }
-    }
+            parsed_changelog = parse_changelog(changelog,
+                                               encoding='iso-8859-15')
 
-    maintainers = [
-        converters.uid_to_person(parsed_dsc['Maintainer'], encode=False),
-    ]
-    maintainers.extend(
-        converters.uid_to_person(person, encode=False)
-        for person in UPLOADERS_SPLIT.split(parsed_dsc.get('Uploaders', ''))
+    changelog = ChangelogInfo(
+        person=converters.uid_to_person(parsed_changelog['author']),
+        date=parse_date(parsed_changelog['date']),
+        history=tuple(parsed_changelog['entries'][1:]),
     )
-    package_info['maintainers'] = maintainers
 
-    ret['package_info'] = package_info
+    maintainers = (parsed_dsc['Maintainer'],) + tuple(
+        UPLOADERS_SPLIT.split(parsed_dsc.get('Uploaders', ''))
+    )
 
-    return ret
+    return PackageMetadata(
+        name=package['name'],
+        version=str(package['version']),
+        changelog=changelog,
+        maintainers=maintainers,
+        original_artifact=original_artifact,
+    )
 
 
-def process_package(package):
+def process_package(package, downloader=None, tempdir=None,
+                    unpack_max_size=0, content_size_limit=None,
+                    prefetch=None, stream_min_size=0, stats=None,
+                    hash_cache=None):
     """Process a source package into its constituent components.
 
     The source package will be decompressed in a temporary directory.
@@ -266,16 +261,30 @@ def process_package(package):
             - version: source package version
             - dsc: the full path of the package's DSC file.
 
-    Returns:
-        tuple: A tuple with two elements:
-
-        - package: the original package dict augmented with the following keys:
+        downloader (Downloader): the download engine to fetch the package
+          files with
+        tempdir (tempfile.TemporaryDirectory): the directory to process the
+          package in, owned by the caller; a new one is created if missing
+        unpack_max_size (int): if not 0, try unpacking packages up to that
+          size in memory (see :mod:`swh.loader.debian.unpack`) before
+          extracting them with dpkg-source
+        content_size_limit (int): size over which contents unpacked in
+          memory are not kept
+        prefetch (dict): the package to start downloading once this one is
+          downloaded
+        stream_min_size (int): if not 0, the size of the packages over which
+          the extracted tree is not loaded in memory, but streamed by a
+          :class:`TreeStreamer` when stored
+        stats (LoadStats): where to account the time spent and the data
+          handled by each stage of the processing
+        hash_cache (TreeHashCache): the hashes of the files of the trees
+          previously extracted, reused for the files extracted unchanged
+          from the same upstream tarballs
 
-            - metadata: the metadata from get_package_metadata
-            - directory: the sha1_git of the root directory of the package
-
-        - objects: a dictionary of the parsed directories and files, both
-          indexed by id
+    Returns:
+        tuple: the root :class:`Directory` of the package (or the
+        :class:`TreeStreamer` to walk it), its metadata (see
+        :func:`get_package_metadata`), and the directory holding its files
 
     Raises:
         FileNotFoundError: if the dsc file does not exist
@@ -290,78 +299,489 @@ def process_package(package):
                  'swh_version': str(package['version']),
              })
 
-    tempdir = download_package(package)
-    dsc, debdir = extract_package(package, tempdir)
+    if stats is None:
+        stats = LoadStats()
+    io_stats = reset_io_stats()
+    owned = tempdir is None
+    with stats.stage('download') as stage:
+        tempdir, files_info = download_package(
+            package, downloader=downloader, tempdir=tempdir,
+            prefetch=prefetch)
+        stage.files += len(files_info)
+        stage.bytes += sum(info.length for info in files_info.values())
 
-    directory = Directory.from_disk(path=os.fsencode(debdir), save_path=True)
-    metadata = get_package_metadata(package, dsc, debdir)
+    try:
+        stream = stream_min_size and package_size(package) >= stream_min_size
+        unpacked = None
+        if unpack_max_size and not stream:
+            with stats.stage('unpack', io_stats):
+                unpacked = unpack_package(
+                    package, get_dsc_path(package, tempdir),
+                    max_size=unpack_max_size,
+                    content_size_limit=content_size_limit or unpack_max_size,
+                )
+
+        if unpacked:
+            directory, changelog_data = unpacked
+            dsc, debdir = get_dsc_path(package, tempdir), None
+        else:
+            # the files written by the extraction are more recent than the
+            # download directory
+            extracted_since = os.stat(tempdir.name).st_mtime_ns
+            with stats.stage('extract'):
+                dsc, debdir = extract_package(package, tempdir)
+            upstream_key = get_upstream_key(files_info)
+            if stream:
+                # the tree is hashed when it is stored
+                directory = TreeStreamer(os.fsencode(debdir))
+            elif hash_cache is not None and upstream_key is not None:
+                with stats.stage('hash', io_stats):
+                    directory = hash_cache.directory_from_disk(
+                        upstream_key, os.fsencode(debdir), extracted_since)
+            else:
+                with stats.stage('hash', io_stats):
+                    directory = directory_from_disk(os.fsencode(debdir))
+            changelog_data = None
+
+        with stats.stage('metadata'):
+            metadata = get_package_metadata(package, dsc, debdir,
+                                            files_info=files_info,
+                                            changelog_data=changelog_data)
+    except BaseException:
+        if owned:
+            tempdir.cleanup()
+        raise
+
+    extra = {
+        'swh_type': 'deb_process_end',
+        'swh_name': package['name'],
+        'swh_version': str(package['version']),
+    }
+    extra.update(io_stats.as_log_extra())
+    extra.update(stats.as_log_extra())
+    log.debug('Processed package %s_%s' %
+              (package['name'], str(package['version'])), extra=extra)
 
     return directory, metadata, tempdir
 
 
+def collect_package_objects(package, directory, metadata):
+    """Collect the objects to store for a package processed by
+    :func:`process_package`.
+
+    Returns:
+        tuple: the objects to store (dict, indexed by object type), and the
+        revision of the package. For a streamed package, the objects are
+        only known once the tree is walked: the only object is the tree
+        streamer and the package metadata (under the ``'stream'`` key),
+        and the revision is None.
+
+    """
+    if isinstance(directory, TreeStreamer):
+        return {'stream': (directory, metadata)}, None
+
+    objects = directory.collect()
+    revision = converters.package_metadata_to_revision(
+        package, directory, metadata
+    )
+    objects['revision'] = {
+        revision['id']: revision,
+    }
+
+    return objects, revision
+
+
+def prune_known_objects(objects, root, directory_missing,
+                        known_directories=()):
+    """Drop the objects of the subtrees already in the archive from the
+    objects collected for a package.
+
+    The tree is walked from its root, one level at a time: only the
+    directories missing from the archive are kept, and only their entries
+    are looked at, so that the contents and subdirectories of a known
+    directory are never sent (nor read from disk).
+
+    Args:
+        objects (dict): the objects collected for the package, as returned
+          by :func:`collect_package_objects`
+        root (bytes): the id of the root directory of the package
+        directory_missing (callable): the storage method listing the
+          missing directories among a list of directory ids
+        known_directories (set or IdSet): ids of directories known to be
+          (or about to be) archived, which are not checked against the
+          archive
+
+    Returns:
+        dict: the objects to store, indexed by object type
+
+    """
+    all_directories = objects.get('directory', {})
+    all_contents = objects.get('content', {})
+    directories = {}
+    contents = {}
+
+    level = [root]
+    while level:
+        to_check = [dir_id for dir_id in level
+                    if dir_id not in known_directories]
+        missing = set()
+        for batch in grouper(to_check, DIRECTORY_MISSING_BATCH_SIZE):
+            missing.update(directory_missing(list(batch)))
+
+        next_level = []
+        for dir_id in level:
+            if dir_id not in missing or dir_id in directories:
+                continue
+            directory = directories[dir_id] = all_directories[dir_id]
+            for entry in directory['entries']:
+                if entry['type'] == 'dir':
+                    next_level.append(entry['target'])
+                elif entry['type'] == 'file':
+                    contents[entry['target']] = all_contents[entry['target']]
+        level = next_level
+
+    ret = dict(objects)
+    ret['directory'] = directories
+    ret['content'] = contents
+    return ret
+
+
+def _freeze(obj):
+    """Hashable equivalent of a json-like object"""
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in obj.items()))
+    elif isinstance(obj, list):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+
+def deduplicate_branches(packages):
+    """Find the branches whose packages have the same files.
+
+    Args:
+        packages (dict): the packages to load, indexed by branch name
+
+    Returns:
+        tuple: the branch each branch is equivalent to (dict), and the
+        revision ids already known for the branches which are not
+        equivalent to another one (dict, values are None for the packages
+        to load)
+
+    """
+    branches_by_files = {}
+    branches_revs = {}
+    equiv_branch = {}
+    for branch, package in packages.items():
+        if 'files' not in package:
+            # already loaded, use default values
+            branches_revs[branch] = identifier_to_bytes(
+                package['revision_id']
+            )
+            equiv_branch[branch] = branch
+            continue
+
+        files_key = _freeze(package['files'])
+        eq_branch = branches_by_files.get(files_key)
+        if eq_branch is not None:
+            equiv_branch[branch] = eq_branch
+            if (not branches_revs[eq_branch]
+                    and package['revision_id']):
+                branches_revs[eq_branch] = identifier_to_bytes(
+                    package['revision_id']
+                )
+        else:
+            # No match: new entry
+            equiv_branch[branch] = branch
+            branches_by_files[files_key] = branch
+            if package['revision_id']:
+                branches_revs[branch] = identifier_to_bytes(
+                    package['revision_id']
+                )
+            else:
+                branches_revs[branch] = None
+
+    return equiv_branch, branches_revs
+
+
+def get_packages_revisions(db_session, package_ids,
+                           batch_size=PACKAGE_UPDATE_BATCH_SIZE):
+    """Get the revision_id of the packages of the lister database which
+    have one.
+
+    Args:
+        db_session: the lister database session
+        package_ids (iterable): the ids of the packages to look up
+        batch_size (int): the number of packages looked up per query
+
+    Returns:
+        dict: the revision ids (bytes), indexed by package id
+
+    """
+    ret = {}
+    for batch in grouper(package_ids, batch_size):
+        ret.update(
+            db_session.query(Package.id, Package.revision_id)
+                      .filter(Package.id.in_(list(batch)))
+                      .filter(Package.revision_id.isnot(None))
+        )
+    return ret
+
+
+def update_packages_revisions(db_session, revisions,
+                              batch_size=PACKAGE_UPDATE_BATCH_SIZE):
+    """Set the revision_id of packages of the lister database, in bulk, and
+    commit.
+
+    On PostgreSQL, each batch of packages is updated by a single
+    ``UPDATE ... FROM (VALUES ...)`` statement; other databases get one
+    executemany per batch.
+
+    Args:
+        db_session: the lister database session
+        revisions (dict): the revision ids (bytes), indexed by package id
+        batch_size (int): the number of packages to update per statement
+
+    """
+    items = sorted(revisions.items())
+    table = Package.__table__
+    dialect = db_session.bind.dialect
+    postgresql = dialect.name == 'postgresql'
+    if postgresql:
+        table_name = dialect.identifier_preparer.format_table(table)
+    for i in range(0, len(items), batch_size):
+        batch = items[i:i + batch_size]
+        if postgresql:
+            values = []
+            params = {}
+            for j, (package_id, rev) in enumerate(batch):
+                values.append('(:id_%d, cast(:rev_%d as bytea))' % (j, j))
+                params['id_%d' % j] = package_id
+                params['rev_%d' % j] = rev
+            db_session.execute(text(
+                'update %s set revision_id = v.revision_id '
+                'from (values %s) as v(id, revision_id) '
+                'where %s.id = v.id'
+                % (table_name, ', '.join(values), table_name)
+            ), params)
+        else:
+            db_session.execute(
+                table.update()
+                     .where(table.c.id == bindparam('package_id'))
+                     .values(revision_id=bindparam('rev')),
+                [{'package_id': package_id, 'rev': rev}
+                 for package_id, rev in batch],
+            )
+    db_session.commit()
+
+
+def _process_package_in_worker(package, tempdir_name, config):
+    """Process package in tempdir_name, from a worker process of the loader
+    process pool.
+
+    Only the objects to store (whose contents reference files in
+    tempdir_name), the revision and the processing statistics are sent back
+    to the loader, which owns tempdir_name.
+
+    """
+    resources = get_worker_resources()
+    downloader = resources.get_downloader(config)
+    tempdir = types.SimpleNamespace(name=tempdir_name)
+    stats = LoadStats()
+    directory, metadata, _ = process_package(
+        package, downloader=downloader, tempdir=tempdir,
+        unpack_max_size=config['unpack_max_size'],
+        content_size_limit=config['content_size_limit'],
+        stream_min_size=config['stream_min_size'],
+        stats=stats,
+        hash_cache=resources.get_hash_cache(config['hash_cache_trees']),
+    )
+    objects, revision = collect_package_objects(package, directory, metadata)
+    return objects, revision, stats
+
+
 class DebianLoader(BufferedLoader):
     """A loader for Debian packages"""
 
     CONFIG_BASE_FILENAME = 'loader/debian'
     ADDITIONAL_CONFIG = {
         'lister_db_url': ('str', 'postgresql:///lister-debian'),
+        'download_max_workers': ('int', 4),
+        'download_prefetch': ('bool', False),
+        'download_mirrors': ('list[str]', []),
+        'download_retries': ('int', 3),
+        'download_backoff': ('int', 1),
+        'download_timeout': ('int', 60),
+        'local_mirrors': ('dict', {}),
+        'artifact_cache_dir': ('str', None),
+        'artifact_cache_max_size': ('int', 10 * 1024 * 1024 * 1024),
+        'pipeline_depth': ('int', 0),
+        'process_pool_size': ('int', 0),
+        'unpack_max_size': ('int', 0),
+        'scratch_dirs': ('list[dict]', []),
+        'scratch_budget': ('int', 0),
+        'scratch_expansion_factor': ('int', 4),
+        'revision_index_path': ('str', None),
+        'stream_min_size': ('int', 0),
+        'metrics': ('dict', {'cls': 'noop', 'args': {}}),
+        'checkpoint_interval': ('int', 10),
+        'hash_cache_trees': ('int', 4),
+        'seen_max_ids': ('int', 1024 * 1024),
     }
 
     visit_type = 'deb'
 
-    def __init__(self, config=None):
-        super().__init__(logging_class=None, config=config)
-        self.db_engine = create_engine(self.config['lister_db_url'])
-        self.mk_session = sessionmaker(bind=self.db_engine)
-        self.db_session = self.mk_session()
+    def __init__(self, config=None, resources=None):
+        """Instantiate the loader.
+
+        Args:
+            config (dict): the loader configuration; parsed from the
+              configuration file if missing
+            resources (WorkerResources): the resources shared by the loaders
+              of the worker process; if missing, the loader sets its own up
+
+        """
+        if resources is not None:
+            if config is None:
+                config = resources.get_loader_config(self.__class__)
+            # the core loader sets its own storage client up unconditionally:
+            # only let it build a placeholder, replaced by the shared client
+            super().__init__(logging_class=None, config=dict(
+                config, storage=PLACEHOLDER_STORAGE_CONFIG))
+            self.config = config
+            self.storage = resources.get_storage(self.config['storage'])
+            self.db_session = resources.get_db_session(
+                self.config['lister_db_url'])
+            self.db_engine = self.db_session.bind
+            self.downloader = resources.get_downloader(self.config)
+            self.hash_cache = resources.get_hash_cache(
+                self.config['hash_cache_trees'])
+            self.metrics = resources.get_metrics(self.config['metrics'])
+        else:
+            super().__init__(logging_class=None, config=config)
+            self.db_engine = create_engine(self.config['lister_db_url'])
+            self.mk_session = sessionmaker(bind=self.db_engine)
+            self.db_session = self.mk_session()
+            self.downloader = get_downloader(self.config)
+            self.hash_cache = None
+            if self.config['hash_cache_trees']:
+                self.hash_cache = TreeHashCache(
+                    self.config['hash_cache_trees'])
+            self.metrics = get_metrics(**self.config['metrics'])
+        # the worker resources outlive the loader: only close its own
+        self.owns_resources = resources is None
+        # the configuration of the process pool workers, which set their own
+        # download engine up
+        self.worker_config = self.config
+        self.reset_seen_objects()
 
     def load(self, *, origin, date, packages):
         return super().load(origin=origin, date=date, packages=packages)
 
+    def load_many(self, visits):
+        """Load several origins in a row, each one in its own visit.
+
+        The objects sent during a visit are not sent again by the following
+        ones, and the package files are shared between visits (and the
+        workers of the process pool) through the artifact cache. If none is
+        configured, a temporary one is set up for the duration of the batch,
+        with a download engine of its own; the latter still allocates the
+        package directories from the scratch space of the loader, shared
+        with the other loaders of the worker process.
+
+        Args:
+            visits (list): (origin, date, packages) tuples, with the
+              arguments of :meth:`load`
+
+        Returns:
+            list: the status of each visit
+
+        """
+        downloader = self.downloader
+        batch_cache_dir = None
+        if not self.config['artifact_cache_dir'] and len(visits) > 1:
+            batch_cache_dir = tempfile.TemporaryDirectory(
+                prefix='swh.loader.debian.cache.')
+            self.worker_config = dict(self.config,
+                                      artifact_cache_dir=batch_cache_dir.name)
+            self.downloader = get_downloader(self.worker_config,
+                                             scratch=downloader.scratch)
+
+        results = []
+        try:
+            for origin, date, packages in visits:
+                try:
+                    result = self.load(origin=origin, date=date,
+                                       packages=packages)
+                except Exception:
+                    log.exception('Loading of origin %s failed' % origin)
+                    self.reset_seen_objects()
+                    result = {'status': 'failed'}
+                results.append(result)
+        finally:
+            if batch_cache_dir is not None:
+                self.downloader.close()
+                self.downloader = downloader
+                self.worker_config = self.config
+                batch_cache_dir.cleanup()
+
+        return results
+
+    def reset_seen_objects(self):
+        """Forget about the objects sent by previous visits: after a
+        failure, some of them may not have reached the archive.
+
+        The ids of the objects sent, or found in the archive, are kept in
+        :class:`IdSet`, so that the objects shared by the versions of a
+        package are filtered out before any storage call, or read of their
+        file. The contents are keyed by their blake2s256 hash, as
+        :meth:`filter_missing_contents` looks them up.
+
+        """
+        max_ids = self.config['seen_max_ids']
+        self.contents_seen = IdSet(32, max_ids)
+        self.directories_seen = IdSet(20, max_ids)
+        self.revisions_seen = IdSet(20, max_ids)
+        self.releases_seen = IdSet(20, max_ids)
+
     def prepare_origin_visit(self, *, origin, date, packages):
         self.origin = {'url': origin, 'type': 'deb'}
         self.visit_date = date
+        # reset the state left by a previous visit of the same loader
+        self.snapshot = None
+        self.counters = dict.fromkeys(self.counters, 0)
+        self.visit_start = time.monotonic()
+        # the stages of the visit which are not specific to a version, and
+        # the sum of the stages of the versions
+        self.visit_stats = LoadStats()
+        self.versions_stats = LoadStats()
+        self.versions_failed = 0
+        self.versions_to_load = []
+        # the packages saved to the lister database during this visit
+        self.saved_packages = set()
+        # set up by prepare, released by cleanup even if prepare fails
+        self.tempdirs = []
+        self.process_pool = None
+        self.pipeline = None
+        self.revision_index = None
+        self.partial = False
+        # the snapshot of the previous visit, if nothing changed since
+        self.unchanged_snapshot = None
 
     def prepare(self, *, origin, date, packages):
         self.packages = packages
+        if self.config['revision_index_path']:
+            self.revision_index = RevisionIndex(
+                self.config['revision_index_path'])
 
-        # Deduplicate branches according to equivalent files
-        branches_files = {}
-        branches_revs = {}
-        equiv_branch = {}
-        for branch, package in packages.items():
-            if 'files' not in package:
-                # already loaded, use default values
-                branches_revs[branch] = identifier_to_bytes(
-                    package['revision_id']
-                )
-                equiv_branch[branch] = branch
-                continue
-
-            for eq_branch, files in branches_files.items():
-                if package['files'] == files:
-                    equiv_branch[branch] = eq_branch
-                    if (not branches_revs[eq_branch]
-                            and package['revision_id']):
-                        branches_revs[eq_branch] = identifier_to_bytes(
-                            package['revision_id']
-                        )
-                    break
-            else:
-                # No match: new entry
-                equiv_branch[branch] = branch
-                branches_files[branch] = package['files']
-                if package['revision_id']:
-                    branches_revs[branch] = identifier_to_bytes(
-                        package['revision_id']
-                    )
-                else:
-                    branches_revs[branch] = None
-
+        equiv_branch, branches_revs = deduplicate_branches(packages)
         self.equivs = {
             'branches': equiv_branch,
             'revisions': branches_revs,
         }
+        with self.visit_stats.stage('checkpoint_lookup'):
+            self.lookup_checkpoints()
+        with self.visit_stats.stage('index_lookup'):
+            self.lookup_revision_index()
 
         self.versions_to_load = [
             (branch, self.packages[branch])
@@ -369,78 +789,520 @@ class DebianLoader(BufferedLoader):
             if not branches_revs[branch]
         ]
 
+        if not self.versions_to_load:
+            with self.visit_stats.stage('snapshot_lookup'):
+                self.unchanged_snapshot = self.lookup_previous_snapshot()
+
         self.version_idx = 0
         self.done = self.version_idx >= len(self.versions_to_load)
 
         self.current_data = {}
-        self.tempdirs = []
-        self.partial = False
+        self.current_branch = None
+        self.current_tempdir = None
+        self.current_stats = None
+        # the branches stored since the last checkpoint
+        self.unsaved_branches = []
+
+        if (self.config['process_pool_size'] > 0
+                and len(self.versions_to_load) > 1):
+            self.start_process_pool()
+        elif self.config['pipeline_depth'] > 0 and not self.done:
+            self.start_pipeline()
+
+    def lookup_previous_snapshot(self):
+        """Get the latest snapshot of the origin, if it has the branches this
+        visit would snapshot: then the visit can reuse it as is.
+
+        Returns:
+            dict: the snapshot, or None if there is none or it differs
+
+        """
+        branches = self.get_snapshot_branches()
+        previous = self.storage.snapshot_get_latest(self.origin_id)
+        if previous is None:
+            return None
+
+        previous_branches = dict(previous['branches'])
+        while (previous['next_branch'] is not None
+               and len(previous_branches) <= len(branches)):
+            previous = self.storage.snapshot_get_branches(
+                previous['id'], branches_from=previous['next_branch'])
+            previous_branches.update(previous['branches'])
+
+        unchanged = previous_branches == branches
+        log.debug('Previous snapshot of %s %s' % (
+            self.origin['url'], 'unchanged' if unchanged else 'outdated'),
+                  extra={
+                      'swh_type': 'deb_snapshot_lookup',
+                      'swh_origin': self.origin['url'],
+                      'swh_snapshot': hashutil.hash_to_hex(previous['id']),
+                      'swh_unchanged': unchanged,
+                  })
+        if not unchanged:
+            return None
+        return {'id': previous['id'], 'branches': branches}
+
+    def lookup_checkpoints(self):
+        """Get the revisions of the packages saved by the checkpoints of a
+        previous, interrupted, visit from the lister database"""
+        branches = {
+            package['id']: branch
+            for branch, package in self.packages.items()
+            if not self.equivs['revisions'][self.equivs['branches'][branch]]
+        }
+        if not branches:
+            return
+
+        found = get_packages_revisions(self.db_session, branches)
+        for package_id, rev in found.items():
+            branch = self.equivs['branches'][branches[package_id]]
+            self.equivs['revisions'][branch] = rev
+            self.saved_packages.add(package_id)
+
+        log.debug('Found %s of %s packages saved by a previous visit' %
+                  (len(found), len(branches)), extra={
+                      'swh_type': 'deb_checkpoint_lookup',
+                      'swh_lookups': len(branches),
+                      'swh_hits': len(found),
+                  })
+
+    def lookup_revision_index(self):
+        """Get the revisions of the packages left to load from the revision
+        index, if they are still in the archive"""
+        if self.revision_index is None:
+            return
+
+        branches_keys = {
+            branch: package_key(self.packages[branch])
+            for branch, rev in self.equivs['revisions'].items()
+            if not rev
+        }
+        found = self.revision_index.get_many(
+            key for key in branches_keys.values() if key
+        )
+        if not found:
+            return
+
+        missing = set(self.storage.revision_missing(list(found.values())))
+        for branch, key in branches_keys.items():
+            rev = found.get(key)
+            if rev and rev not in missing:
+                self.equivs['revisions'][branch] = rev
+
+        log.debug('Found %s of %s packages in the revision index' %
+                  (len(found) - len(missing), len(branches_keys)), extra={
+                      'swh_type': 'deb_index_lookup',
+                      'swh_lookups': len(branches_keys),
+                      'swh_hits': len(found) - len(missing),
+                  })
+
+    def update_revision_index(self, branches):
+        """Add the revisions of the packages of branches, loaded during this
+        visit, to the revision index, once they have been sent to the
+        archive"""
+        if self.revision_index is None:
+            return
+
+        items = []
+        for branch in branches:
+            rev = self.equivs['revisions'][branch]
+            key = package_key(self.packages[branch])
+            if rev and key:
+                items.append((key, rev))
+        self.revision_index.add_many(items)
+
+    def process_version(self, idx):
+        """Process the package at index idx of versions_to_load into the
+        objects to store.
+
+        Returns:
+            tuple: the objects to store (dict, indexed by object type), the
+            revision of the package, the temporary directory holding the
+            package files, and the statistics of the processing
+            (:class:`LoadStats`)
+
+        """
+        _, package = self.versions_to_load[idx]
+        stats = LoadStats()
+
+        next_package = None
+        if (self.config['download_prefetch']
+                and idx + 1 < len(self.versions_to_load)):
+            _, next_package = self.versions_to_load[idx + 1]
+
+        directory, metadata, tempdir = process_package(
+            package, downloader=self.downloader,
+            unpack_max_size=self.config['unpack_max_size'],
+            content_size_limit=self.config['content_size_limit'],
+            prefetch=next_package,
+            stream_min_size=self.config['stream_min_size'],
+            stats=stats,
+            hash_cache=self.hash_cache,
+        )
+        objects, revision = collect_package_objects(
+            package, directory, metadata
+        )
+
+        return objects, revision, tempdir, stats
+
+    def start_process_pool(self):
+        """Start processing the versions to load in a pool of
+        process_pool_size worker processes"""
+        self.process_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.config['process_pool_size'],
+        )
+        self.process_pool_futures = collections.deque()
+        self.process_pool_next_idx = 0
+
+    def _fill_process_pool(self):
+        """Submit versions to the process pool, keeping at most
+        process_pool_size of them in flight, as long as there is scratch
+        space for them"""
+        while (len(self.process_pool_futures)
+               < self.config['process_pool_size']
+               and self.process_pool_next_idx < len(self.versions_to_load)):
+            _, package = self.versions_to_load[self.process_pool_next_idx]
+            try:
+                tempdir = self.downloader.scratch.allocate(package,
+                                                           blocking=False)
+            except ScratchSpaceExhausted as e:
+                if self.process_pool_futures:
+                    # wait for the versions in flight to be stored
+                    break
+                future = concurrent.futures.Future()
+                future.set_exception(e)
+                tempdir = None
+            else:
+                future = self.process_pool.submit(
+                    _process_package_in_worker, package, tempdir.name,
+                    self.worker_config,
+                )
+            self.process_pool_next_idx += 1
+            self.process_pool_futures.append((future, tempdir))
+
+    def process_version_in_pool(self):
+        """Get the result of the next version processed in the process
+        pool, in the format of :meth:`process_version`"""
+        self._fill_process_pool()
+        future, tempdir = self.process_pool_futures.popleft()
+        try:
+            objects, revision, stats = future.result()
+        except BaseException:
+            if tempdir is not None:
+                tempdir.cleanup()
+            raise
+        return objects, revision, tempdir, stats
+
+    def stop_process_pool(self):
+        """Shut the process pool down, and drop the results which have not
+        been stored"""
+        if self.process_pool is None:
+            return
+
+        for future, _ in self.process_pool_futures:
+            future.cancel()
+        self.process_pool.shutdown(wait=True)
+        for _, tempdir in self.process_pool_futures:
+            if tempdir is not None:
+                tempdir.cleanup()
+        self.process_pool = None
+
+    def start_pipeline(self):
+        """Start processing the versions to load in a background thread, at
+        most pipeline_depth versions ahead of the one being stored"""
+        self.pipeline = queue.Queue(maxsize=self.config['pipeline_depth'])
+        self.pipeline_stop = threading.Event()
+        self.pipeline_thread = threading.Thread(
+            target=self._pipeline_worker,
+            name='swh.loader.debian.pipeline',
+            daemon=True,
+        )
+        self.pipeline_thread.start()
+
+    def _pipeline_worker(self):
+        for idx in range(len(self.versions_to_load)):
+            if self.pipeline_stop.is_set():
+                return
+
+            try:
+                item = self.process_version(idx), None
+            except BaseException as e:
+                item = None, e
+
+            while True:
+                if self.pipeline_stop.is_set():
+                    if item[0]:
+                        item[0][2].cleanup()
+                    return
+                try:
+                    self.pipeline.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    def _drain_pipeline(self):
+        """Drop the results queued by the pipeline worker"""
+        while True:
+            try:
+                result, _ = self.pipeline.get_nowait()
+            except queue.Empty:
+                break
+            if result:
+                result[2].cleanup()
+
+    def stop_pipeline(self):
+        """Stop the background processing of versions, and drop the results
+        which have not been stored.
+
+        The worker may be waiting for the scratch space held by the queued
+        results: they are released before waiting for the worker, then
+        again once it is done, in case it queued one more meanwhile.
+
+        """
+        if self.pipeline is None:
+            return
+
+        self.pipeline_stop.set()
+        self._drain_pipeline()
+        self.pipeline_thread.join()
+        self._drain_pipeline()
+        self.pipeline = None
 
     def fetch_data(self):
         if self.done:
             return False
 
         branch, package = self.versions_to_load[self.version_idx]
+        idx = self.version_idx
         self.version_idx += 1
 
         try:
-            directory, metadata, tempdir = process_package(package)
-            self.tempdirs.append(tempdir)
-            self.current_data = directory.collect()
-            revision = converters.package_metadata_to_revision(
-                package, directory, metadata
-            )
-
-            self.current_data['revision'] = {
-                revision['id']: revision,
-            }
+            if self.process_pool is not None:
+                result = self.process_version_in_pool()
+            elif self.pipeline is not None:
+                result, exc = self.pipeline.get()
+                if exc:
+                    raise exc
+            else:
+                result = self.process_version(idx)
 
-            self.equivs['revisions'][branch] = revision['id']
+            (self.current_data, revision, self.current_tempdir,
+             self.current_stats) = result
+            self.current_branch = branch
+            self.tempdirs.append(self.current_tempdir)
+            if revision is not None:
+                self.equivs['revisions'][branch] = revision['id']
 
         except DebianLoaderException:
             log.exception('Package %s_%s failed to load' %
                           (package['name'], package['version']))
             self.partial = True
+            self.versions_failed += 1
 
         self.done = self.version_idx >= len(self.versions_to_load)
         return not self.done
 
-    def store_data(self):
-        self.maybe_load_contents(
-            self.current_data.get('content', {}).values())
-        self.maybe_load_directories(
-            self.current_data.get('directory', {}).values())
-        self.maybe_load_revisions(
-            self.current_data.get('revision', {}).values())
-        self.current_data = {}
+    def store_streamed_version(self, streamer, metadata, stats):
+        """Send the objects of the current version as they are walked by
+        streamer, making sure that the children of objects always reach the
+        archive before them."""
+        package = self.packages[self.current_branch]
+        io_stats = reset_io_stats()
+        batches = iter(streamer)
+        while True:
+            with stats.stage('hash', io_stats):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            object_type, objects = batch
+            with stats.stage('store'):
+                if object_type == 'content':
+                    self.maybe_load_contents(objects)
+                else:
+                    self.send_batch_contents(self.contents.pop())
+                    self.maybe_load_directories(objects)
+        with stats.stage('store'):
+            self.send_batch_contents(self.contents.pop())
+            self.send_batch_directories(self.directories.pop())
 
-        if self.done:
-            self.flush()
-            self.update_packages()
-            self.generate_and_load_snapshot()
+            # the root directory id is only known once the tree is walked
+            revision = converters.package_metadata_to_revision(
+                package, streamer, metadata
+            )
+            self.maybe_load_revisions([revision])
+        self.equivs['revisions'][self.current_branch] = revision['id']
+
+        extra = {
+            'swh_type': 'deb_stream_end',
+            'swh_name': package['name'],
+            'swh_version': str(package['version']),
+        }
+        extra.update(io_stats.as_log_extra())
+        log.debug('Streamed package %s_%s' %
+                  (package['name'], str(package['version'])), extra=extra)
+
+    def maybe_load_missing_directories(self, directories):
+        """Load directories already found missing from swh-storage, without
+        asking the storage about them again.
 
-    def update_packages(self):
+        """
+        if not self.config['send_directories']:
+            return
+        missing = []
+        for directory in directories:
+            if directory['id'] in self.directories_seen:
+                continue
+            self.directories_seen.add(directory['id'])
+            missing.append(directory)
+        if self.directories.add(missing):
+            self.send_batch_contents(self.contents.pop())
+            self.send_batch_directories(self.directories.pop())
+
+    def store_data(self):
+        stats = self.current_stats or LoadStats()
+        if 'stream' in self.current_data:
+            self.store_streamed_version(*self.current_data.pop('stream'),
+                                        stats=stats)
+
+        if 'revision' in self.current_data:
+            (revision,) = self.current_data['revision'].values()
+            total = (len(self.current_data['directory'])
+                     + len(self.current_data['content']))
+            with stats.stage('prune'):
+                self.current_data = prune_known_objects(
+                    self.current_data, revision['directory'],
+                    self.storage.directory_missing,
+                    known_directories=self.directories_seen,
+                )
+            kept = (len(self.current_data['directory'])
+                    + len(self.current_data['content']))
+            log.debug('Sending %s of %s objects for revision %s' %
+                      (kept, total, hashutil.hash_to_hex(revision['id'])),
+                      extra={
+                          'swh_type': 'deb_prune',
+                          'swh_revision': hashutil.hash_to_hex(
+                              revision['id']),
+                          'swh_objects_total': total,
+                          'swh_objects_sent': kept,
+                      })
+
+        with stats.stage('store') as stage:
+            contents = self.current_data.get('content', {}).values()
+            stage.files += len(contents)
+            stage.bytes += sum(content['length'] for content in contents)
+            self.maybe_load_contents(contents)
+            # the directories left by pruning were all found missing
+            self.maybe_load_missing_directories(
+                self.current_data.get('directory', {}).values())
+            self.maybe_load_revisions(
+                self.current_data.get('revision', {}).values())
+            self.current_data = {}
+
+            if self.current_tempdir is not None:
+                # Contents are read from the package directory when they are
+                # sent: send them before freeing its space
+                self.send_batch_contents(self.contents.pop())
+        if self.current_tempdir is not None:
+            self.current_tempdir.cleanup()
+            self.tempdirs.remove(self.current_tempdir)
+            self.current_tempdir = None
+
+        if self.current_stats is not None:
+            self.record_version_stats(self.current_stats)
+            self.current_stats = None
+
+        if self.current_branch is not None:
+            if self.equivs['revisions'][self.current_branch]:
+                self.unsaved_branches.append(self.current_branch)
+            self.current_branch = None
+
+        interval = self.config['checkpoint_interval']
+        if (not self.done and interval
+                and len(self.unsaved_branches) >= interval):
+            with self.visit_stats.stage('checkpoint'):
+                self.checkpoint()
+
+        if self.done and self.unchanged_snapshot is not None:
+            # nothing was loaded: only the revisions found in the revision
+            # index may be missing from the lister database
+            with self.visit_stats.stage('update_packages'):
+                self.update_packages()
+            with self.visit_stats.stage('snapshot'):
+                self.maybe_load_snapshot(self.unchanged_snapshot)
+        elif self.done:
+            with self.visit_stats.stage('flush'):
+                self.flush()
+            with self.visit_stats.stage('index_update'):
+                self.update_revision_index(self.unsaved_branches)
+            with self.visit_stats.stage('update_packages'):
+                self.update_packages()
+            self.unsaved_branches = []
+            with self.visit_stats.stage('snapshot'):
+                self.generate_and_load_snapshot()
+
+    def checkpoint(self):
+        """Save the revisions of the versions stored since the last
+        checkpoint to the lister database (and to the revision index), once
+        their objects are in the archive, so that an interrupted visit
+        resumes after them"""
+        self.flush()
+        self.update_revision_index(self.unsaved_branches)
+        self.update_packages(self.unsaved_branches)
+        log.debug('Saved %s versions' % len(self.unsaved_branches), extra={
+            'swh_type': 'deb_checkpoint',
+            'swh_versions': len(self.unsaved_branches),
+        })
+        self.unsaved_branches = []
+
+    def record_version_stats(self, stats):
+        """Log the statistics of the version just stored, send them to the
+        metrics sink, and add them to the statistics of the visit"""
+        package = self.packages[self.current_branch]
+        extra = {
+            'swh_type': 'deb_version_stats',
+            'swh_name': package['name'],
+            'swh_version': str(package['version']),
+        }
+        extra.update(stats.as_log_extra())
+        log.debug('Loaded package %s_%s in %.3fs' %
+                  (package['name'], str(package['version']),
+                   sum(stage.seconds for stage in stats.stages.values())),
+                  extra=extra)
+        stats.send(self.metrics)
+        self.versions_stats.merge(stats)
+
+    def update_packages(self, branches=None):
+        """Save the revisions of the packages of the lister database which
+        are not saved yet.
+
+        Args:
+            branches (list): only save the packages of these branches (and
+              of their equivalent branches); all of them if missing
+
+        """
+        if branches is not None:
+            branches = set(branches)
+        revisions = {}
         for branch in self.packages:
             package = self.packages[branch]
-            if package['revision_id']:
+            if package['revision_id'] or package['id'] in self.saved_packages:
                 continue
-            rev = self.equivs['revisions'][self.equivs['branches'][branch]]
+            equiv_branch = self.equivs['branches'][branch]
+            if branches is not None and equiv_branch not in branches:
+                continue
+            rev = self.equivs['revisions'][equiv_branch]
             if not rev:
                 continue
+            revisions[package['id']] = rev
 
-            db_package = self.db_session.query(Package)\
-                                        .filter(Package.id == package['id'])\
-                                        .one()
-            db_package.revision_id = rev
-
-        self.db_session.commit()
+        if not revisions:
+            return
+        update_packages_revisions(self.db_session, revisions)
+        self.saved_packages.update(revisions)
 
-    def generate_and_load_snapshot(self):
-        """Create a SWH archive "snapshot" of the package being loaded, and send it to
-        the archive.
-
-
-        """
+    def get_snapshot_branches(self):
+        """Get the branches of the snapshot of the visit: the revision of each
+        package, or None if it could not be loaded"""
         branches = {}
         for branch in self.packages:
             rev = self.equivs['revisions'][self.equivs['branches'][branch]]
@@ -454,23 +1316,82 @@ class DebianLoader(BufferedLoader):
                 target = None
 
             branches[branch.encode('utf-8')] = target
-        snapshot = {'branches': branches}
+        return branches
+
+    def generate_and_load_snapshot(self):
+        """Create a SWH archive "snapshot" of the package being loaded, and send it to
+        the archive.
+
+
+        """
+        snapshot = {'branches': self.get_snapshot_branches()}
         snapshot['id'] = identifier_to_bytes(snapshot_identifier(snapshot))
         self.maybe_load_snapshot(snapshot)
 
+    def get_stats_summary(self):
+        """Summary of the visit: the number of versions loaded, and the
+        statistics of each stage"""
+        stats = LoadStats()
+        stats.merge(self.versions_stats)
+        stats.merge(self.visit_stats)
+        return {
+            'seconds': round(time.monotonic() - self.visit_start, 3),
+            'versions': len(self.versions_to_load),
+            'versions_failed': self.versions_failed,
+            'stages': stats.to_dict(),
+        }
+
     def load_status(self):
         status = 'eventful' if self.versions_to_load else 'uneventful'
 
         return {
             'status': status if not self.partial else 'failed',
+            'stats': self.get_stats_summary(),
         }
 
     def visit_status(self):
         return 'partial' if self.partial else 'full'
 
+    def post_load(self, success=True):
+        if not success:
+            self.reset_seen_objects()
+
+        self.visit_stats.send(self.metrics)
+        self.metrics.timing('visit', time.monotonic() - self.visit_start)
+        self.metrics.increment('visits.%s' % (
+            'failed' if not success or self.partial else 'done'))
+        self.metrics.increment('versions', len(self.versions_to_load))
+        if self.versions_failed:
+            self.metrics.increment('versions.failed', self.versions_failed)
+
+        extra = {
+            'swh_type': 'deb_visit_end',
+            'swh_origin': self.origin['url'],
+            'swh_success': success and not self.partial,
+            'swh_versions': len(self.versions_to_load),
+            'swh_versions_failed': self.versions_failed,
+        }
+        extra.update(self.visit_stats.as_log_extra())
+        log.info('Visit of %s done in %.3fs' %
+                 (self.origin['url'], time.monotonic() - self.visit_start),
+                 extra=extra)
+
     def cleanup(self):
+        # release the scratch space of the version being stored first: the
+        # pipeline worker may be waiting for it
         for d in self.tempdirs:
             d.cleanup()
+        self.tempdirs = []
+        self.stop_process_pool()
+        self.stop_pipeline()
+        self.downloader.cleanup()
+        if self.revision_index is not None:
+            self.revision_index.close()
+            self.revision_index = None
+        # return the lister database connection to the pool
+        self.db_session.close()
+        if self.owns_resources:
+            self.metrics.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,228 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Instrumentation of the stages of the loading of packages.
+
+The time spent in each stage, and the files and bytes it handled, are
+accumulated in :class:`LoadStats`. They are logged as ``swh_*`` extras, and
+sent to a metrics sink, selected by the ``metrics`` configuration of the
+loader (see :func:`get_metrics`).
+
+"""
+
+import collections
+import contextlib
+import logging
+import socket
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class StageStats:
+    """Accumulated statistics of a stage.
+
+    Attributes:
+        seconds (float): the time spent in the stage
+        calls (int): the number of times the stage was run
+        files (int): the number of files it handled
+        bytes (int): the number of bytes it handled
+
+    """
+
+    def __init__(self, seconds=0.0, calls=0, files=0, bytes=0):
+        self.seconds = seconds
+        self.calls = calls
+        self.files = files
+        self.bytes = bytes
+
+    def merge(self, other):
+        self.seconds += other.seconds
+        self.calls += other.calls
+        self.files += other.files
+        self.bytes += other.bytes
+
+    def to_dict(self):
+        return {
+            'seconds': round(self.seconds, 3),
+            'calls': self.calls,
+            'files': self.files,
+            'bytes': self.bytes,
+        }
+
+
+class LoadStats:
+    """Statistics of the stages of the loading of a package, or of a whole
+    visit, in the order the stages were first run"""
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+
+    def __getitem__(self, stage):
+        ret = self.stages.get(stage)
+        if ret is None:
+            ret = self.stages[stage] = StageStats()
+        return ret
+
+    @contextlib.contextmanager
+    def stage(self, name, io_stats=None):
+        """Time the block run in the context as stage name.
+
+        Args:
+            name (str): the name of the stage
+            io_stats (IOStats): if set, the files hashed and the bytes read
+              (or mapped) during the stage are accounted to it
+
+        Yields:
+            StageStats: the statistics of the stage, for the block to account
+            the files and bytes it handled
+
+        """
+        stats = self[name]
+        if io_stats is not None:
+            files = io_stats.files
+            nbytes = io_stats.bytes_read + io_stats.bytes_mapped
+        start = time.monotonic()
+        try:
+            yield stats
+        finally:
+            stats.seconds += time.monotonic() - start
+            stats.calls += 1
+            if io_stats is not None:
+                stats.files += io_stats.files - files
+                stats.bytes += (io_stats.bytes_read + io_stats.bytes_mapped
+                                - nbytes)
+
+    def merge(self, other):
+        for name, stats in other.stages.items():
+            self[name].merge(stats)
+
+    def as_log_extra(self):
+        """The statistics, as logging extras"""
+        ret = {}
+        for name, stats in self.stages.items():
+            ret['swh_%s_seconds' % name] = round(stats.seconds, 3)
+            if stats.files:
+                ret['swh_%s_files' % name] = stats.files
+            if stats.bytes:
+                ret['swh_%s_bytes' % name] = stats.bytes
+        return ret
+
+    def to_dict(self):
+        return collections.OrderedDict(
+            (name, stats.to_dict()) for name, stats in self.stages.items()
+        )
+
+    def send(self, metrics):
+        """Send the statistics to a metrics sink"""
+        for name, stats in self.stages.items():
+            metrics.timing('stage.%s' % name, stats.seconds)
+            if stats.files:
+                metrics.increment('stage.%s.files' % name, stats.files)
+            if stats.bytes:
+                metrics.increment('stage.%s.bytes' % name, stats.bytes)
+
+
+class NoopMetrics:
+    """A metrics sink dropping everything"""
+
+    def timing(self, name, seconds):
+        """Record a duration of seconds for name"""
+        pass
+
+    def increment(self, name, value=1):
+        """Increment the counter name by value"""
+        pass
+
+    def close(self):
+        """Release the resources of the sink; it can still be used
+        afterwards"""
+        pass
+
+
+class InMemoryMetrics(NoopMetrics):
+    """A metrics sink keeping the metrics in memory.
+
+    Attributes:
+        timings (dict): the durations recorded, indexed by name
+        counters (collections.Counter): the counters
+
+    """
+
+    def __init__(self):
+        self.timings = collections.defaultdict(list)
+        self.counters = collections.Counter()
+
+    def timing(self, name, seconds):
+        self.timings[name].append(seconds)
+
+    def increment(self, name, value=1):
+        self.counters[name] += value
+
+
+class StatsdMetrics(NoopMetrics):
+    """A metrics sink sending the metrics to a statsd server, over UDP.
+
+    Metrics are only sent on a best-effort basis: failing to send them
+    never fails a load. The socket is opened when the first metric is sent,
+    and again after :meth:`close`.
+
+    Args:
+        host (str): the host of the statsd server
+        port (int): its port
+        prefix (str): the prefix of the metric names
+
+    """
+
+    def __init__(self, host='localhost', port=8125,
+                 prefix='swh.loader.debian'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = None
+
+    def _send(self, name, value, metric_type):
+        data = '%s.%s:%s|%s' % (self.prefix, name, value, metric_type)
+        try:
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.sendto(data.encode('ascii'), self.address)
+        except OSError as e:
+            log.debug('Failed to send metric %s: %s' % (name, e))
+
+    def timing(self, name, seconds):
+        self._send(name, int(seconds * 1000), 'ms')
+
+    def increment(self, name, value=1):
+        self._send(name, value, 'c')
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+METRICS_CLASSES = {
+    'noop': NoopMetrics,
+    'memory': InMemoryMetrics,
+    'statsd': StatsdMetrics,
+}
+
+
+def get_metrics(cls='noop', args=None):
+    """Get a metrics sink.
+
+    Args:
+        cls (str): the type of sink: ``'noop'``, ``'memory'`` or
+          ``'statsd'``
+        args (dict): the arguments of its constructor
+
+    Raises:
+        ValueError: if cls is unknown
+
+    """
+    if cls not in METRICS_CLASSES:
+        raise ValueError('Unknown metrics class `%s`' % cls)
+    return METRICS_CLASSES[cls](**(args or {}))
@@ -0,0 +1,109 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Records carrying the information gathered about a package version.
+
+The records are immutable named tuples: they take less memory than the
+equivalent dicts, are cheap to pickle to and from the process pool, and can
+be shared rather than copied. :meth:`PackageMetadata.to_revision_metadata`
+serializes them to the metadata of the revision of the package.
+
+"""
+
+import collections
+
+from . import converters
+
+
+class OriginalArtifact(collections.namedtuple('OriginalArtifact', [
+        'name', 'length', 'sha1', 'sha1_git', 'sha256', 'blake2s256'])):
+    """Information about an original file of a source package.
+
+    Attributes:
+        name (str): the file name
+        length (int): the file length
+        sha1, sha1_git, sha256, blake2s256 (str): the (hexadecimal) hashes
+          of the file
+
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_hashes(cls, name, length, hashes):
+        """Build the record from the hexadecimal hashes of a
+        :class:`MultiHash` (or any mapping of the hash names)"""
+        return cls(name, length, hashes['sha1'], hashes['sha1_git'],
+                   hashes['sha256'], hashes['blake2s256'])
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+    def to_dict(self):
+        return dict(zip(self._fields, self))
+
+
+class ChangelogInfo(collections.namedtuple('ChangelogInfo', [
+        'person', 'date', 'history'])):
+    """Information parsed from the changelog of a package.
+
+    Attributes:
+        person (dict): the author of the last entry, as returned by
+          :func:`converters.uid_to_person`
+        date (datetime.datetime): the date of the last entry
+        history (tuple): (package, version) of the previous entries
+
+    """
+
+    __slots__ = ()
+
+
+class PackageMetadata(collections.namedtuple('PackageMetadata', [
+        'name', 'version', 'changelog', 'maintainers',
+        'original_artifact'])):
+    """Metadata of a package version.
+
+    Attributes:
+        name (str): the package name
+        version (str): the package version
+        changelog (ChangelogInfo): the information from the changelog
+        maintainers (tuple): the uids of the maintainer and uploaders
+        original_artifact (tuple): the :class:`OriginalArtifact` of the dsc
+          file, then of each package file
+
+    """
+
+    __slots__ = ()
+
+    def to_revision_metadata(self):
+        """Serialize the metadata for the revision of the package.
+
+        The result only holds (json-serializable) new lists and dicts, and
+        strings shared with the record: nothing needs to be copied.
+
+        """
+        person = self.changelog.person
+        return {
+            'original_artifact': [
+                artifact.to_dict() for artifact in self.original_artifact
+            ],
+            'package_info': {
+                'name': self.name,
+                'version': self.version,
+                'changelog': {
+                    'person': {
+                        key: value.decode('utf-8')
+                        for key, value in person.items()
+                    },
+                    'date': self.changelog.date.isoformat(),
+                    'history': list(self.changelog.history),
+                },
+                'maintainers': [
+                    converters.uid_to_person(uid, encode=False)
+                    for uid in self.maintainers
+                ],
+            },
+        }
@@ -0,0 +1,135 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Resources shared by the loaders run in a worker process.
+
+Database engines, storage clients, download engines and metrics sinks are
+costly to set up, or keep connections (or sockets) open: they are created
+once per worker process, then shared by the loaders of all the tasks it
+runs. So is the cache of the hashes of extracted trees, which is worth
+keeping across tasks.
+
+"""
+
+import json
+import os
+import threading
+
+from typing import List
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from swh.storage import get_storage
+
+from .download import get_downloader
+from .hashing import TreeHashCache
+from .metrics import get_metrics
+
+
+# The loader configuration keys the download engine depends on
+DOWNLOADER_CONFIG_KEYS = (
+    'download_max_workers',
+    'download_mirrors',
+    'download_retries',
+    'download_backoff',
+    'download_timeout',
+    'local_mirrors',
+    'artifact_cache_dir',
+    'artifact_cache_max_size',
+    'scratch_dirs',
+    'scratch_budget',
+    'scratch_expansion_factor',
+)
+
+
+def _config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+
+class WorkerResources:
+    """Registry of the resources of a worker process, indexed by their
+    configuration.
+
+    Engines, storage clients, download engines and metrics sinks are
+    thread-safe, and shared as is; each loader gets its own database session.
+
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.loader_configs = {}
+        self.db_engines = {}
+        self.storages = {}
+        self.downloaders = {}
+        self.hash_caches = {}
+        self.metrics = {}
+
+    def _get(self, registry, key, factory):
+        with self.lock:
+            ret = registry.get(key)
+            if ret is None:
+                ret = registry[key] = factory()
+        return ret
+
+    def get_loader_config(self, loader_class):
+        """Get the configuration of loader_class, parsed once"""
+        return self._get(
+            self.loader_configs, loader_class,
+            lambda: loader_class.parse_config_file(
+                additional_configs=[loader_class.ADDITIONAL_CONFIG]),
+        )
+
+    def get_db_session(self, db_url):
+        """Get a new session on the (shared) engine for db_url"""
+        engine = self._get(self.db_engines, db_url,
+                           lambda: create_engine(db_url))
+        return sessionmaker(bind=engine)()
+
+    def get_storage(self, storage_config):
+        """Get the storage client for storage_config"""
+        return self._get(self.storages, _config_key(storage_config),
+                         lambda: get_storage(**storage_config))
+
+    def get_downloader(self, config):
+        """Get the download engine for the loader config"""
+        downloader_config = {
+            key: config[key] for key in DOWNLOADER_CONFIG_KEYS
+        }
+        return self._get(self.downloaders, _config_key(downloader_config),
+                         lambda: get_downloader(config))
+
+    def get_metrics(self, metrics_config):
+        """Get the metrics sink for metrics_config"""
+        return self._get(self.metrics, _config_key(metrics_config),
+                         lambda: get_metrics(**metrics_config))
+
+    def get_hash_cache(self, max_trees):
+        """Get the cache of the hashes of the last max_trees trees
+        extracted; None if max_trees is 0"""
+        if not max_trees:
+            return None
+        return self._get(self.hash_caches, max_trees,
+                         lambda: TreeHashCache(max_trees))
+
+
+_worker_resources = None
+
+# The resources inherited from the parent of a forked process share their
+# connections with it: they must be neither used nor closed (which would
+# happen when they are garbage collected) by the child.
+_inherited_resources = []  # type: List[WorkerResources]
+
+
+def get_worker_resources():
+    """Get the resources of the current process, discarding the ones
+    inherited from its parent after a fork"""
+    global _worker_resources
+    if _worker_resources is None or _worker_resources.pid != os.getpid():
+        if _worker_resources is not None:
+            _inherited_resources.append(_worker_resources)
+        _worker_resources = WorkerResources()
+    return _worker_resources
@@ -0,0 +1,145 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import logging
+import shutil
+import tempfile
+import threading
+
+from .exceptions import ScratchSpaceExhausted
+
+
+log = logging.getLogger(__name__)
+
+
+def package_size(package):
+    """Cumulated declared size of the files of package"""
+    return sum(fileinfo.get('size', 0)
+               for fileinfo in package['files'].values())
+
+
+class ScratchDirectory:
+    """A temporary directory holding a package, whose space is reserved in
+    a :class:`ScratchSpace` until it is cleaned up"""
+
+    def __init__(self, space, size, tempdir):
+        self.space = space
+        self.size = size
+        self.tempdir = tempdir
+        self.name = tempdir.name
+
+    def cleanup(self):
+        self.tempdir.cleanup()
+        if self.space is not None:
+            self.space.release(self.size)
+            self.space = None
+
+
+class ScratchSpace:
+    """Allocate the temporary directories packages are processed in.
+
+    Each package gets a directory in the first of the scratch directories
+    that accepts packages of its size and has enough free space, so that
+    small packages can be processed in a tmpfs and larger ones on disk.
+
+    The space needed by a package is estimated from the declared size of
+    its files, and reserved until its directory is cleaned up; the total
+    reserved space is kept under `budget`.
+
+    Args:
+        dirs (list): the scratch directories to use, in order of
+          preference, as dicts with the following keys:
+
+          - path: the scratch directory (None for the system default)
+          - max_size (optional): the size of the largest packages to
+            process there
+
+        budget (int): the maximum space reserved at the same time (0 for no
+          limit)
+        expansion_factor (int): estimated ratio between the size of the
+          unpacked package and the size of its files
+
+    """
+
+    def __init__(self, dirs=None, budget=0, expansion_factor=4):
+        self.dirs = dirs or [{'path': None}]
+        self.budget = budget
+        self.expansion_factor = expansion_factor
+        self.reserved = 0
+        self.cond = threading.Condition()
+
+    def estimate(self, package):
+        """Estimate the space needed to process package"""
+        return package_size(package) * (1 + self.expansion_factor)
+
+    def _pick_dir(self, size):
+        for scratch_dir in self.dirs:
+            max_size = scratch_dir.get('max_size')
+            if max_size is not None and size > max_size:
+                continue
+            path = scratch_dir.get('path') or tempfile.gettempdir()
+            if shutil.disk_usage(path).free < size:
+                continue
+            return path
+        return None
+
+    def allocate(self, package, blocking=True):
+        """Reserve space for package and create its directory.
+
+        Args:
+            package (dict): the package to allocate a directory for
+            blocking (bool): wait for space reserved by other packages to be
+              released, rather than failing right away
+
+        Returns:
+            ScratchDirectory: the directory to process the package in
+
+        Raises:
+            ScratchSpaceExhausted: if there is not enough space for package
+
+        """
+        size = self.estimate(package)
+        with self.cond:
+            while True:
+                path = None
+                if not self.budget or self.reserved + size <= self.budget:
+                    path = self._pick_dir(size)
+                if path is not None:
+                    break
+                if not blocking or not self.reserved:
+                    raise ScratchSpaceExhausted(
+                        'Not enough scratch space for package %s_%s '
+                        '(%s bytes needed, %s bytes reserved)' %
+                        (package['name'], package['version'], size,
+                         self.reserved)
+                    )
+                self.cond.wait()
+
+            self.reserved += size
+
+        try:
+            tempdir = tempfile.TemporaryDirectory(
+                prefix='swh.loader.debian.%s.' % package['name'],
+                dir=path,
+            )
+        except BaseException:
+            self.release(size)
+            raise
+
+        log.debug('Scratch directory %s for package %s_%s' %
+                  (tempdir.name, package['name'], package['version']),
+                  extra={
+                      'swh_type': 'deb_scratch_allocate',
+                      'swh_name': package['name'],
+                      'swh_version': str(package['version']),
+                      'swh_scratch_dir': tempdir.name,
+                      'swh_size': size,
+                  })
+        return ScratchDirectory(self, size, tempdir)
+
+    def release(self, size):
+        with self.cond:
+            self.reserved -= size
+            self.cond.notify_all()
@@ -0,0 +1,98 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import os
+
+from swh.model.from_disk import DentryPerms
+from swh.model.hashutil import hash_to_bytes
+from swh.model.identifiers import directory_identifier
+
+from .hashing import content_from_file
+
+
+# Number of objects in each batch yielded by TreeStreamer
+STREAM_BATCH_SIZE = 1000
+
+
+class TreeStreamer:
+    """Stream the objects of an on-disk tree, without holding the whole tree
+    in memory.
+
+    Iterating over the streamer walks the tree depth-first, and yields its
+    objects in batches, as (object type, list of objects) pairs:
+    ``'content'`` batches in the format of :meth:`Content.get_data` (with
+    the path of the files), and ``'directory'`` batches in the format of
+    :meth:`Directory.get_data`. Children are always yielded before their
+    parents; the root directory comes last.
+
+    Only the entries of the directories being walked are kept, so that
+    memory usage depends on the batch size and on the shape of the tree,
+    but not on its size.
+
+    Args:
+        path (bytes): the root of the tree
+        batch_size (int): the maximum number of objects per batch
+
+    Attributes:
+        hash (bytes): the id of the root directory, once the tree has been
+          walked
+
+    """
+
+    def __init__(self, path, batch_size=STREAM_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.hash = None
+
+    @staticmethod
+    def _list(path):
+        return iter(list(os.scandir(path)))
+
+    def __iter__(self):
+        contents = []
+        directories = []
+        # the directories being walked: (name, entries, remaining children)
+        stack = [(b'', [], self._list(self.path))]
+        while stack:
+            _, entries, children = stack[-1]
+            for child in children:
+                if child.is_dir(follow_symlinks=False):
+                    stack.append((child.name, [], self._list(child.path)))
+                    break
+
+                content = content_from_file(child.path)
+                contents.append(content.get_data())
+                entries.append({
+                    'type': 'file',
+                    'perms': content.data['perms'],
+                    'target': content.hash,
+                    'name': child.name,
+                })
+                if len(contents) >= self.batch_size:
+                    yield 'content', contents
+                    contents = []
+            else:
+                # all the children have been walked
+                name, _, _ = stack.pop()
+                dir_id = hash_to_bytes(directory_identifier({
+                    'entries': entries,
+                }))
+                directories.append({'id': dir_id, 'entries': entries})
+                if stack:
+                    stack[-1][1].append({
+                        'type': 'dir',
+                        'perms': DentryPerms.directory,
+                        'target': dir_id,
+                        'name': name,
+                    })
+                else:
+                    self.hash = dir_id
+
+                if len(directories) >= self.batch_size or not stack:
+                    if contents:
+                        yield 'content', contents
+                        contents = []
+                    yield 'directory', directories
+                    directories = []
@@ -6,8 +6,20 @@
 from celery import current_app as app
 
 from .loader import DebianLoader
+from .resources import get_worker_resources
 
 
 @app.task(name=__name__ + '.LoadDebianPackage')
 def load_debian_packages(origin, date, packages):
-    return DebianLoader().load(origin=origin, date=date, packages=packages)
+    loader = DebianLoader(resources=get_worker_resources())
+    return loader.load(origin=origin, date=date, packages=packages)
+
+
+@app.task(name=__name__ + '.LoadDebianPackagesBatch')
+def load_debian_packages_batch(origins, date=None):
+    """Load a batch of origins, given as (origin, packages) pairs, in a
+    single loader run. Each origin gets its own visit and snapshot."""
+    loader = DebianLoader(resources=get_worker_resources())
+    return loader.load_many([
+        (origin, date, packages) for origin, packages in origins
+    ])
@@ -21,6 +21,28 @@ TEST_LOADER_CONFIG = {
 
     'save_data': False,
 
+    'download_max_workers': 4,
+    'download_prefetch': False,
+    'download_mirrors': [],
+    'download_retries': 3,
+    'download_backoff': 0,
+    'download_timeout': 60,
+    'local_mirrors': {},
+    'artifact_cache_dir': None,
+    'artifact_cache_max_size': 10 * 1024 * 1024,
+    'pipeline_depth': 0,
+    'process_pool_size': 0,
+    'unpack_max_size': 0,
+    'scratch_dirs': [],
+    'scratch_budget': 0,
+    'scratch_expansion_factor': 4,
+    'revision_index_path': None,
+    'stream_min_size': 0,
+    'metrics': {'cls': 'noop', 'args': {}},
+    'checkpoint_interval': 10,
+    'hash_cache_trees': 4,
+    'seen_max_ids': 1024 * 1024,
+
     'lister_db_url':
         'postgresql+psycopg2:///test-lister-debian?host={PGHOST}'.format(
         **os.environ)
@@ -0,0 +1,104 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import io
+import logging
+from unittest import TestCase
+
+from debian.changelog import Changelog
+
+from swh.loader.debian.changelog import CHECK_CHUNK_SIZE, parse_changelog
+
+
+ENTRY = '''\
+%(package)s (%(version)s) unstable; urgency=low
+
+  * Change.
+%(changes)s
+ -- %(author)s  Mon, %(day)02d Jan 2018 12:00:00 +0100
+
+'''
+
+
+def entry(version, package='hello', author='Jane Doe <jane@example.org>',
+          day=1, changes=''):
+    return (ENTRY % {
+        'package': package,
+        'version': version,
+        'author': author,
+        'day': day,
+        'changes': changes,
+    }).encode('utf-8')
+
+
+class TestParseChangelog(TestCase):
+    def setUp(self):
+        # Changelog warns about the lines it does not expect
+        logging.disable(logging.WARNING)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def assertParsedAsChangelog(self, data, encoding='utf-8'):
+        parsed = parse_changelog(io.BytesIO(data), encoding=encoding)
+        changelog = Changelog(io.BytesIO(data), encoding=encoding)
+        self.assertEqual(parsed, {
+            'author': changelog.author,
+            'date': changelog.date,
+            'entries': [(block.package, str(block.version))
+                        for block in changelog],
+        })
+        return parsed
+
+    def test_entries(self):
+        data = b''.join(entry('1.%d-1' % i, day=i + 1)
+                        for i in reversed(range(3)))
+        parsed = self.assertParsedAsChangelog(data)
+        self.assertEqual(parsed['author'], 'Jane Doe <jane@example.org>')
+        self.assertEqual(parsed['date'], 'Mon, 03 Jan 2018 12:00:00 +0100')
+        self.assertEqual(parsed['entries'], [
+            ('hello', '1.2-1'), ('hello', '1.1-1'), ('hello', '1.0-1'),
+        ])
+
+    def test_odd_changelogs(self):
+        for data in [
+            b'',
+            b'\n\n',
+            b'not a changelog\n',
+            # no trailer
+            entry('1.0-1').split(b' -- ')[0],
+            # header lines in changes, and bad trailers
+            entry('2.0-1', changes='hello (1.5-1) unstable; urgency=low\n'
+                  ' --\n -- Nobody\n')
+            + entry('1:1.0-1'),
+            # Windows line endings
+            entry('1.0-1').replace(b'\n', b'\r\n'),
+            # comments, then editor variables ending the entries
+            entry('2.0-1') + b'# comment\n$Id: x $\n' + entry('1.0-1')
+            + b'Local variables:\n' + entry('0.9-1'),
+            # an old format changelog ending the entries
+            entry('2.0-1') + b'Old Changelog:\n' + entry('1.0-1'),
+        ]:
+            with self.subTest(data=data):
+                self.assertParsedAsChangelog(data)
+
+    def test_encoding(self):
+        author = 'J\xe9r\xf4me <j@example.org>'
+        utf8 = entry('1.0-1', author=author)
+        iso = utf8.replace(author.encode('utf-8'),
+                           author.encode('iso-8859-15'))
+        # a valid first entry, and an error after the first chunk checked
+        late_error = entry('2.0-1', author=author,
+                           changes='  * %s\n' % ('x' * CHECK_CHUNK_SIZE)) + iso
+
+        self.assertParsedAsChangelog(utf8)
+        # characters across the chunks checked, in either variant
+        for prefix in ['', 'x']:
+            self.assertParsedAsChangelog(entry('1.0-1', changes='  * %s%s' % (
+                prefix, '\xe9' * CHECK_CHUNK_SIZE)))
+        for data in [iso, late_error]:
+            with self.assertRaises(UnicodeDecodeError):
+                Changelog(io.BytesIO(data))
+            with self.assertRaises(UnicodeDecodeError):
+                parse_changelog(io.BytesIO(data))
+            self.assertParsedAsChangelog(data, encoding='iso-8859-15')
@@ -0,0 +1,517 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import hashlib
+import http.server
+import os
+import re
+import socketserver
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests_mock
+
+from swh.loader.debian.cache import ArtifactCache
+from swh.loader.debian.download import Downloader, link_file
+from swh.loader.debian.exceptions import (
+    PackageDownloadFailed, ScratchSpaceExhausted,
+)
+from swh.loader.debian.loader import get_file_info
+from swh.loader.debian.scratch import ScratchSpace
+
+
+def _fileinfo(name, data, uri):
+    return {
+        'name': name,
+        'uri': uri,
+        'size': len(data),
+        'md5sum': hashlib.md5(data).hexdigest(),
+        'sha256': hashlib.sha256(data).hexdigest(),
+    }
+
+
+class TestDownloader(TestCase):
+    def setUp(self):
+        self.downloader = Downloader(max_workers=2, backoff=0)
+        self.data = {
+            'foo_1.0-1.dsc': b'dsc contents',
+            'foo_1.0.orig.tar.gz': b'orig tarball' * 1000,
+            'foo_1.0-1.debian.tar.xz': b'debian tarball',
+        }
+        self.package = {
+            'name': 'foo',
+            'version': '1.0-1',
+            'files': {
+                name: _fileinfo(name, data, 'http://mirror.test/' + name)
+                for name, data in self.data.items()
+            },
+        }
+
+    def tearDown(self):
+        self.downloader.close()
+
+    def test_download_package(self):
+        with requests_mock.Mocker() as m:
+            for name, data in self.data.items():
+                m.get('http://mirror.test/' + name, content=data)
+            tempdir, files_info = self.downloader.download_package(
+                self.package)
+
+        for name, data in self.data.items():
+            with open(os.path.join(tempdir.name, name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.assertEqual(files_info[name],
+                             get_file_info(os.path.join(tempdir.name, name)))
+        tempdir.cleanup()
+
+    def test_download_package_prefetched(self):
+        with requests_mock.Mocker() as m:
+            for name, data in self.data.items():
+                m.get('http://mirror.test/' + name, content=data)
+            self.downloader.prefetch(self.package)
+            tempdir, files_info = self.downloader.download_package(
+                self.package)
+            self.assertEqual(m.call_count, len(self.data))
+
+        self.assertEqual(self.downloader.prefetched, {})
+        tempdir.cleanup()
+
+    def test_download_package_other_prefetched(self):
+        # another package, with the same name, version and file names
+        other_data = dict(self.data, **{'foo_1.0-1.dsc': b'other dsc'})
+        other_package = dict(self.package, files={
+            name: _fileinfo(name, data, 'http://other.test/' + name)
+            for name, data in other_data.items()
+        })
+        with requests_mock.Mocker() as m:
+            for name, data in self.data.items():
+                m.get('http://mirror.test/' + name, content=data)
+                m.get('http://other.test/' + name, content=other_data[name])
+            self.downloader.prefetch(other_package)
+            tempdir, files_info = self.downloader.download_package(
+                self.package)
+
+        with open(os.path.join(tempdir.name, 'foo_1.0-1.dsc'), 'rb') as f:
+            self.assertEqual(f.read(), b'dsc contents')
+        self.assertEqual(files_info['foo_1.0-1.dsc'].length,
+                         len(b'dsc contents'))
+        self.assertEqual(len(self.downloader.prefetched), 1)
+        tempdir.cleanup()
+
+    def test_download_package_checksum_mismatch(self):
+        with requests_mock.Mocker() as m:
+            for name, data in self.data.items():
+                m.get('http://mirror.test/' + name, content=data[::-1])
+            with self.assertRaisesRegex(PackageDownloadFailed, 'mismatch'):
+                self.downloader.download_package(self.package)
+
+    def test_session_per_host(self):
+        get_session = self.downloader.get_session
+        self.assertIs(get_session('http://a.test/x'),
+                      get_session('http://a.test/y'))
+        self.assertIsNot(get_session('http://a.test/x'),
+                         get_session('http://b.test/x'))
+
+
+class FaultyMirror(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """A local HTTP mirror serving files, which injects the faults scheduled
+    for each of them.
+
+    The faults of a file are consumed by its successive requests; once none
+    is left, the file is served correctly (with support for ranges):
+
+    - ``error``: answer with a 503 status
+    - ``missing``: answer with a 404 status
+    - ``truncate``: close the connection after half of the data
+    - ``no_range``: ignore the requested range
+    - ``wrong_size``: announce and send another file, one byte larger
+    - ``corrupt``: send other data of the same size
+
+    """
+    daemon_threads = True
+
+    def __init__(self, files):
+        super().__init__(('127.0.0.1', 0), FaultyMirrorHandler)
+        self.files = files
+        self.faults = {}
+        self.requests = []
+        self.base_uri = 'http://127.0.0.1:%s/debian/' % self.server_port
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class FaultyMirrorHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        name = self.path.rsplit('/', 1)[-1]
+        server.requests.append((name, self.headers.get('Range')))
+        fault = None
+        if server.faults.get(name):
+            fault = server.faults[name].pop(0)
+        data = server.files.get(name)
+
+        if data is None or fault in ('missing', 'error'):
+            self.send_error(503 if fault == 'error' else 404)
+            return
+
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+        if match and fault != 'no_range':
+            start = int(match.group(1))
+        if fault == 'wrong_size':
+            data += b'\0'
+        elif fault == 'corrupt':
+            data = data[::-1]
+
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (
+                start, len(data) - 1, len(data)))
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        if fault == 'truncate':
+            self.wfile.write(data[start:start + (len(data) - start) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+
+class TestDownloaderFaults(TestCase):
+    def setUp(self):
+        self.data = os.urandom(100000)
+        self.files = {'foo_1.0.orig.tar.gz': self.data}
+        self.mirrors = [FaultyMirror(self.files) for _ in range(2)]
+        self.downloader = Downloader(
+            mirrors=[mirror.base_uri for mirror in self.mirrors],
+            retries=3, backoff=0.5,
+        )
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'foo_1.0.orig.tar.gz')
+        self.fileinfo = _fileinfo(
+            'foo_1.0.orig.tar.gz', self.data,
+            self.mirrors[0].base_uri + 'pool/main/f/foo/foo_1.0.orig.tar.gz')
+        sleep = patch('swh.loader.debian.download.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+        # the chunk being received when a transfer is interrupted is lost
+        chunk_size = patch(
+            'swh.loader.debian.download.DOWNLOAD_CHUNK_SIZE', 10000)
+        chunk_size.start()
+        self.addCleanup(chunk_size.stop)
+
+    def tearDown(self):
+        self.downloader.close()
+        for mirror in self.mirrors:
+            mirror.stop()
+        self.tempdir.cleanup()
+
+    def _fetch(self):
+        info = self.downloader.fetch_file(self.fileinfo, self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(info, get_file_info(self.path))
+        return info
+
+    def _requests(self, mirror):
+        return [range_ for _, range_ in self.mirrors[mirror].requests]
+
+    def test_mirror_uris(self):
+        self.assertEqual(self.downloader.get_mirror_uris(
+            self.fileinfo['uri']), [
+                self.fileinfo['uri'],
+                self.mirrors[1].base_uri
+                + 'pool/main/f/foo/foo_1.0.orig.tar.gz',
+            ])
+        self.assertEqual(self.downloader.get_mirror_uris('http://x/a'),
+                         ['http://x/a'])
+
+    def test_resume(self):
+        self.mirrors[0].faults = {'foo_1.0.orig.tar.gz': ['truncate']}
+        self.mirrors[1].faults = {'foo_1.0.orig.tar.gz': ['truncate']}
+        self._fetch()
+
+        # each transfer resumes where the previous one stopped
+        self.assertEqual(self._requests(0), [None, 'bytes=70000-'])
+        self.assertEqual(self._requests(1), ['bytes=50000-'])
+        self.assertEqual(
+            [call[0] for call in self.sleep.call_args_list],
+            [(0.5,), (1,)])
+
+    def test_range_not_supported(self):
+        self.mirrors[0].faults = {'foo_1.0.orig.tar.gz': ['truncate']}
+        self.mirrors[1].faults = {'foo_1.0.orig.tar.gz': ['no_range']}
+        self._fetch()
+        self.assertEqual(self._requests(1), ['bytes=50000-'])
+
+    def test_wrong_size(self):
+        self.mirrors[0].faults = {
+            'foo_1.0.orig.tar.gz': ['wrong_size', 'wrong_size'],
+        }
+        self._fetch()
+
+        # the mirror serving another file is not tried again, right away
+        self.assertEqual(self._requests(0), [None])
+        self.assertEqual(self._requests(1), [None])
+        self.sleep.assert_not_called()
+
+    def test_checksum_mismatch(self):
+        self.mirrors[0].faults = {'foo_1.0.orig.tar.gz': ['corrupt']}
+        self._fetch()
+        self.assertEqual(self._requests(1), [None])
+
+    def test_all_mirrors_fail(self):
+        self.mirrors[0].faults = {'foo_1.0.orig.tar.gz': ['missing']}
+        self.mirrors[1].faults = {'foo_1.0.orig.tar.gz': ['error'] * 10}
+        with self.assertRaisesRegex(PackageDownloadFailed, '503'):
+            self.downloader.fetch_file(self.fileinfo, self.path)
+
+        self.assertEqual(len(self._requests(0)), 1)
+        self.assertEqual(len(self._requests(1)), 4)
+        self.assertEqual(
+            [call[0] for call in self.sleep.call_args_list],
+            [(0.5,), (1,), (2,)])
+
+
+class TestLocalMirror(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.mirror = os.path.join(self.tempdir.name, 'mirror')
+        self.dest = os.path.join(self.tempdir.name, 'dest')
+        os.makedirs(os.path.join(self.mirror, 'pool/main/f/foo'))
+        os.mkdir(self.dest)
+        self.data = b'orig tarball' * 1000
+        self.local_path = os.path.join(self.mirror,
+                                       'pool/main/f/foo/foo_1.0.orig.tar.gz')
+        with open(self.local_path, 'wb') as f:
+            f.write(self.data)
+        self.path = os.path.join(self.dest, 'foo_1.0.orig.tar.gz')
+        self.downloader = Downloader(
+            local_mirrors={'http://mirror.test/debian/': self.mirror},
+            backoff=0,
+        )
+
+    def tearDown(self):
+        self.downloader.close()
+        self.tempdir.cleanup()
+
+    def _fileinfo(self, uri, data=None):
+        return _fileinfo('foo_1.0.orig.tar.gz',
+                         self.data if data is None else data, uri)
+
+    def test_local_path(self):
+        get_local_path = self.downloader.get_local_path
+        self.assertEqual(get_local_path('file:///srv/a%20b.dsc'),
+                         '/srv/a b.dsc')
+        self.assertEqual(
+            get_local_path('http://mirror.test/debian/pool/foo.dsc'),
+            os.path.join(self.mirror, 'pool/foo.dsc'))
+        self.assertIsNone(get_local_path('http://mirror.test/pool/foo.dsc'))
+
+    def test_file_uri(self):
+        with requests_mock.Mocker() as m:
+            info = self.downloader.download_file(
+                self._fileinfo('file://' + self.local_path), self.path)
+            self.assertEqual(m.call_count, 0)
+
+        self.assertEqual(info, get_file_info(self.local_path))
+        # the file is not duplicated
+        self.assertTrue(os.path.samefile(self.path, self.local_path))
+
+    def test_mapped_uri(self):
+        uri = 'http://mirror.test/debian/pool/main/f/foo/foo_1.0.orig.tar.gz'
+        with requests_mock.Mocker() as m:
+            info = self.downloader.download_file(self._fileinfo(uri),
+                                                 self.path)
+            self.assertEqual(m.call_count, 0)
+        self.assertEqual(info, get_file_info(self.local_path))
+
+    def test_mapped_uri_out_of_sync(self):
+        uri = 'http://mirror.test/debian/pool/main/f/foo/foo_1.0.orig.tar.gz'
+        data = self.data[::-1]
+        with requests_mock.Mocker() as m:
+            m.get(uri, content=data)
+            self.downloader.download_file(self._fileinfo(uri, data),
+                                          self.path)
+
+        # downloaded, leaving the local mirror alone
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        with open(self.local_path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_file_uri_mismatch(self):
+        with self.assertRaisesRegex(PackageDownloadFailed, 'mismatch'):
+            self.downloader.download_file(
+                self._fileinfo('file://' + self.local_path, self.data[::-1]),
+                self.path)
+
+    def test_link_file_fallback(self):
+        with patch('os.link', side_effect=OSError(18, 'cross-device')), \
+                patch('fcntl.ioctl', side_effect=OSError(95, 'unsupported')):
+            self.assertEqual(link_file(self.local_path, self.path),
+                             'symlink')
+        self.assertEqual(os.readlink(self.path), self.local_path)
+
+
+class TestArtifactCache(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.cache = ArtifactCache(os.path.join(self.tempdir.name, 'cache'),
+                                   max_size=100)
+        self.fills = []
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _fill(self, data):
+        def fill(path):
+            self.fills.append(path)
+            with open(path, 'wb') as f:
+                f.write(data)
+            return {'length': len(data)}
+        return fill
+
+    def _dest(self, name):
+        return os.path.join(self.tempdir.name, name)
+
+    def test_fetch(self):
+        sha256 = hashlib.sha256(b'foo').hexdigest()
+        for name in 'ab':
+            info = self.cache.fetch(sha256, self._dest(name),
+                                    self._fill(b'foo'))
+            self.assertEqual(info, {'length': 3})
+
+        self.assertEqual(len(self.fills), 1)
+        for name in 'ab':
+            with open(self._dest(name), 'rb') as f:
+                self.assertEqual(f.read(), b'foo')
+
+    def test_fetch_failed(self):
+        def fill(path):
+            open(path, 'wb').close()
+            raise PackageDownloadFailed('nope')
+
+        with self.assertRaises(PackageDownloadFailed):
+            self.cache.fetch('00' * 32, self._dest('a'), fill)
+        self.assertFalse(os.path.exists(self.cache.path('00' * 32)))
+
+    def test_fetch_concurrent(self):
+        sha256 = hashlib.sha256(b'foo').hexdigest()
+        threads = [
+            threading.Thread(target=self.cache.fetch, args=(
+                sha256, self._dest(str(i)), self._fill(b'foo'),
+            ))
+            for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.fills), 1)
+
+    def test_evict(self):
+        shas = []
+        for i in range(4):
+            data = bytes([i]) * 40
+            sha256 = hashlib.sha256(data).hexdigest()
+            shas.append(sha256)
+            self.cache.fetch(sha256, self._dest(str(i)), self._fill(data))
+            os.utime(self.cache.path(sha256), (i, i))
+            self.cache.evict()
+
+        present = [os.path.exists(self.cache.path(sha256))
+                   for sha256 in shas]
+        self.assertEqual(present, [False, False, True, True])
+
+    def test_lock_file_removed(self):
+        lock_path = os.path.join(self.cache.locks_dir, 'foo.lock')
+        holders = []
+        overlaps = []
+
+        def hold(name):
+            with self.cache._locked(lock_path):
+                holders.append(name)
+                if len(holders) > 1:
+                    overlaps.append(list(holders))
+                time.sleep(0.1)
+                holders.remove(name)
+
+        with self.cache._locked(lock_path):
+            waiting = threading.Thread(target=hold, args=('waiting',))
+            waiting.start()
+            # let it block on the lock file, then remove it, as evict() does
+            time.sleep(0.1)
+            os.unlink(lock_path)
+        hold('new')
+        waiting.join()
+
+        self.assertEqual(overlaps, [])
+
+
+class TestScratchSpace(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.small = os.path.join(self.tempdir.name, 'small')
+        self.large = os.path.join(self.tempdir.name, 'large')
+        os.mkdir(self.small)
+        os.mkdir(self.large)
+        self.space = ScratchSpace(
+            dirs=[{'path': self.small, 'max_size': 500},
+                  {'path': self.large}],
+            budget=1000, expansion_factor=4,
+        )
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _package(self, size):
+        return {'name': 'foo', 'version': '1.0-1',
+                'files': {'foo_1.0.tar.xz': {'size': size}}}
+
+    def test_allocate_dirs(self):
+        small = self.space.allocate(self._package(10))
+        self.assertEqual(os.path.dirname(small.name), self.small)
+        large = self.space.allocate(self._package(150))
+        self.assertEqual(os.path.dirname(large.name), self.large)
+        self.assertEqual(self.space.reserved, 800)
+
+        small.cleanup()
+        large.cleanup()
+        small.cleanup()
+        self.assertEqual(self.space.reserved, 0)
+        self.assertEqual(os.listdir(self.small), [])
+        self.assertEqual(os.listdir(self.large), [])
+
+    def test_allocate_budget(self):
+        with self.assertRaises(ScratchSpaceExhausted):
+            self.space.allocate(self._package(1000))
+
+        first = self.space.allocate(self._package(150))
+        with self.assertRaises(ScratchSpaceExhausted):
+            self.space.allocate(self._package(100), blocking=False)
+
+        allocated = []
+        thread = threading.Thread(target=lambda: allocated.append(
+            self.space.allocate(self._package(100))))
+        thread.start()
+        first.cleanup()
+        thread.join()
+        self.assertEqual(self.space.reserved, 500)
+        allocated[0].cleanup()
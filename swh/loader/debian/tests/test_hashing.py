@@ -0,0 +1,133 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from swh.model.from_disk import Directory
+from swh.model.hashutil import MultiHash
+
+from swh.loader.debian.hashing import (
+    MMAP_MIN_SIZE, TreeHashCache, directory_from_disk, hash_file,
+    reset_io_stats,
+)
+
+
+class TestHashing(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.fsencode(self.tempdir.name)
+        self.sizes = {b'empty': 0, b'small': 1000,
+                      b'large': MMAP_MIN_SIZE * 3 + 1}
+        os.makedirs(os.path.join(self.path, b'dir'))
+        for name, size in self.sizes.items():
+            with open(os.path.join(self.path, b'dir', name), 'wb') as f:
+                f.write(os.urandom(size))
+        os.symlink(b'dir/small', os.path.join(self.path, b'link'))
+        os.symlink(b'dir', os.path.join(self.path, b'dirlink'))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_hash_file(self):
+        stats = reset_io_stats()
+        for name in self.sizes:
+            path = os.path.join(self.path, b'dir', name)
+            self.assertEqual(hash_file(path).digest(),
+                             MultiHash.from_path(path).digest())
+
+        self.assertEqual(stats.files, 3)
+        self.assertEqual(stats.bytes_read, self.sizes[b'small'])
+        self.assertEqual(stats.bytes_mapped, self.sizes[b'large'])
+
+    def test_directory_from_disk(self):
+        directory = directory_from_disk(self.path)
+        expected = Directory.from_disk(path=self.path, save_path=True)
+        self.assertEqual(directory.hash, expected.hash)
+        self.assertEqual(directory.collect(), expected.collect())
+
+
+class TestTreeHashCache(TestCase):
+    # the modification time of the files extracted from the tarball, and
+    # the time the extraction started
+    TARBALL_MTIME = 1500000000 * 10 ** 9
+    EXTRACTION_START = 1600000000 * 10 ** 9
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.first = os.path.join(os.fsencode(self.tempdir.name), b'first')
+        self.second = os.path.join(os.fsencode(self.tempdir.name), b'second')
+        self._write(self.first, {
+            b'src/a.c': b'a' * 100,
+            b'src/b.c': b'b' * MMAP_MIN_SIZE,
+            b'src/removed.c': b'removed',
+            b'README': b'readme',
+            b'debian/changelog': b'changelog 1',
+        })
+        # written by the extraction, after the tarball was extracted
+        self._write(self.first, {b'src/patched.c': b'patched 1'},
+                    self.EXTRACTION_START + 10 ** 9)
+        os.symlink(b'README', os.path.join(self.first, b'link'))
+
+        shutil.copytree(self.first, self.second, symlinks=True)
+        os.unlink(os.path.join(self.second, b'src/removed.c'))
+        self._write(self.second, {
+            b'src/added.c': b'added',
+            b'debian/changelog': b'changelog 2',
+        })
+        # the same size and modification time, but other contents
+        self._write(self.second, {b'src/patched.c': b'patched 2'},
+                    self.EXTRACTION_START + 10 ** 9)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _write(self, root, files, mtime=TARBALL_MTIME):
+        for name, data in files.items():
+            path = os.path.join(root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.utime(path, ns=(mtime, mtime))
+
+    def assertSameTree(self, directory, path):
+        expected = Directory.from_disk(path=path, save_path=True)
+        self.assertEqual(directory.hash, expected.hash)
+        self.assertEqual(directory.collect(), expected.collect())
+
+    def test_reuse(self):
+        cache = TreeHashCache(max_trees=2)
+        stats = reset_io_stats()
+        directory = cache.directory_from_disk(
+            'orig', self.first, self.EXTRACTION_START)
+        self.assertSameTree(directory, self.first)
+        self.assertEqual((stats.files, stats.files_reused), (6, 0))
+        # neither the patched file nor the packaging files are cached
+        self.assertEqual(sorted(cache.trees['orig']), [
+            b'README', b'src/a.c', b'src/b.c', b'src/removed.c',
+        ])
+
+        stats = reset_io_stats()
+        directory = cache.directory_from_disk(
+            'orig', self.second, self.EXTRACTION_START)
+        # the same identifiers as a full hash, with the contents in place
+        self.assertSameTree(directory, self.second)
+        self.assertEqual((stats.files, stats.files_reused), (3, 3))
+        self.assertEqual(stats.bytes_reused, 100 + MMAP_MIN_SIZE + 6)
+
+    def test_other_tarball(self):
+        cache = TreeHashCache(max_trees=1)
+        cache.directory_from_disk('orig', self.first, self.EXTRACTION_START)
+        cache.directory_from_disk('other', self.first,
+                                  self.EXTRACTION_START)
+        self.assertEqual(list(cache.trees), ['other'])
+
+        stats = reset_io_stats()
+        directory = cache.directory_from_disk(
+            'orig', self.second, self.EXTRACTION_START)
+        self.assertSameTree(directory, self.second)
+        self.assertEqual(stats.files_reused, 0)
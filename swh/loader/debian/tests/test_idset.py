@@ -0,0 +1,74 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import hashlib
+from unittest import TestCase
+
+from swh.loader.debian.idset import MIN_SLOTS, IdSet
+
+
+def make_id(i):
+    return hashlib.sha1(b'%d' % i).digest()
+
+
+class TestIdSet(TestCase):
+    def test_membership(self):
+        ids = IdSet(20, 100000)
+        added = [make_id(i) for i in range(MIN_SLOTS * 4)]
+        for id in added:
+            ids.add(id)
+        # the table grew, without losing any id
+        self.assertGreater(ids.current.nslots, MIN_SLOTS)
+        self.assertIsNone(ids.previous)
+        self.assertEqual(len(ids), len(added))
+        for id in added:
+            self.assertIn(id, ids)
+        for i in range(len(added), len(added) * 2):
+            self.assertNotIn(make_id(i), ids)
+
+        # ids sharing their first bytes collide in the table
+        prefixed = [b'\x01' * 12 + bytes([i]) * 8 for i in range(1, 10)]
+        for id in prefixed[:5]:
+            ids.add(id)
+            ids.add(id)
+        self.assertEqual(len(ids), len(added) + 5)
+        self.assertEqual([id in ids for id in prefixed],
+                         [True] * 5 + [False] * 4)
+
+    def test_zero_id(self):
+        ids = IdSet(20, 4)
+        zero = bytes(20)
+        self.assertNotIn(zero, ids)
+        ids.add(zero)
+        self.assertIn(zero, ids)
+        self.assertEqual(len(ids), 1)
+        # kept in the previous generation, then forgotten
+        ids.add(make_id(0))
+        ids.add(make_id(1))
+        self.assertIn(zero, ids)
+        ids.add(make_id(2))
+        ids.add(make_id(3))
+        self.assertNotIn(zero, ids)
+        ids.clear()
+        self.assertEqual(len(ids), 0)
+
+    def test_bounded(self):
+        max_ids = 1000
+        ids = IdSet(20, max_ids)
+        for i in range(max_ids * 10):
+            ids.add(make_id(i))
+            self.assertLessEqual(len(ids), max_ids)
+        # the most recent ids are kept, the oldest ones forgotten
+        self.assertGreaterEqual(len(ids), max_ids // 2)
+        self.assertIn(make_id(max_ids * 10 - 1), ids)
+        self.assertNotIn(make_id(0), ids)
+        self.assertLessEqual(ids.current.nslots, MIN_SLOTS)
+
+    def test_id_size(self):
+        ids = IdSet(32, 10)
+        with self.assertRaises(ValueError):
+            ids.add(make_id(0))
+        with self.assertRaises(ValueError):
+            make_id(0) in ids
@@ -0,0 +1,60 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import os
+import tempfile
+from unittest import TestCase
+
+from swh.loader.debian.index import RevisionIndex, artifact_key
+
+
+FILES = {
+    'foo_1.0-1.dsc': {'sha256': '00' * 32, 'size': 1},
+    'foo_1.0.orig.tar.gz': {'sha256': '11' * 32, 'size': 2},
+}
+
+
+class TestArtifactKey(TestCase):
+    def test_artifact_key(self):
+        key = artifact_key('foo', '1.0-1', FILES)
+        self.assertEqual(
+            key, artifact_key('foo', '1.0-1', dict(reversed(FILES.items()))))
+        self.assertNotEqual(key, artifact_key('foo', '1.0-2', FILES))
+        self.assertNotEqual(key, artifact_key('bar', '1.0-1', FILES))
+
+        other_files = dict(FILES)
+        other_files['foo_1.0.orig.tar.gz'] = {'sha256': '22' * 32}
+        self.assertNotEqual(key, artifact_key('foo', '1.0-1', other_files))
+
+    def test_artifact_key_no_sha256(self):
+        files = dict(FILES)
+        files['foo_1.0-1.debian.tar.xz'] = {'md5sum': '00' * 16}
+        self.assertIsNone(artifact_key('foo', '1.0-1', files))
+
+
+class TestRevisionIndex(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'index.sqlite')
+        self.index = RevisionIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        self.tempdir.cleanup()
+
+    def test_get_many(self):
+        self.index.add_many([('a', b'\x01' * 20), ('b', b'\x02' * 20)])
+        self.index.add_many([('a', b'\x03' * 20)])
+        keys = ['a', 'b', 'c'] + [str(i) for i in range(1000)]
+        self.assertEqual(self.index.get_many(keys), {
+            'a': b'\x03' * 20,
+            'b': b'\x02' * 20,
+        })
+
+    def test_persistent(self):
+        self.index.add_many([('a', b'\x01' * 20)])
+        other = RevisionIndex(self.path)
+        self.assertEqual(other.get_many(['a']), {'a': b'\x01' * 20})
+        other.close()
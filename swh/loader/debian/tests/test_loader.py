@@ -3,24 +3,51 @@
 # License: GNU General Public License version 3, or any later version
 # See top-level LICENSE file for more information
 
+import collections
+import hashlib
 import os
-from unittest import TestCase
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
 
 import pytest
 import requests_mock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 
 from typing import Iterable
 
 from swh.core.db.tests.db_testing import SingleDbTestFixture
+from swh.model.from_disk import Directory
 from swh.model.hashutil import hash_to_bytes
-from swh.storage.schemata.distribution import SQLBase
+from swh.storage.schemata.distribution import (
+    Area, Distribution, Package, SQLBase,
+)
 from swh.loader.core.tests import BaseLoaderTest
-from swh.loader.debian.loader import get_file_info, DebianLoader
+from swh.loader.debian.index import RevisionIndex
+from swh.loader.debian.loader import (
+    deduplicate_branches, get_file_info, get_packages_revisions,
+    prune_known_objects, update_packages_revisions, DebianLoader,
+)
+from swh.loader.debian.resources import WorkerResources
+from swh.loader.debian.scratch import package_size
+from swh.loader.debian.tasks import load_debian_packages_batch
 
 from . import TEST_LOADER_CONFIG
+from .test_download import FaultyMirror
 
 RESOURCES_PATH = os.path.join(os.path.dirname(__file__), 'resources')
 
+# The files of the versions of the hello package loaded by LoaderTestCase
+HELLO_FILES = ['hello_2.10-1+deb9u1.dsc', 'hello_2.10-1+deb9u1.debian.tar.xz',
+               'hello_2.10.orig.tar.gz']
+
+# Time after which a load is considered hung
+LOAD_TIMEOUT = 60
+
 
 class DebianLoaderTest(DebianLoader):
     def parse_config_file(self, *args, **kwargs):
@@ -44,7 +71,148 @@ class TestFileInfo(TestCase):
             'blake2s256': '4072cf9a0017ad7705a9995bbfbbc098276e6a3afea8d84ab54bff6381c897ab',  # noqa
         }
 
-        self.assertEqual(actual_info, expected_info)
+        self.assertEqual(actual_info.to_dict(), expected_info)
+
+
+class TestDeduplicateBranches(TestCase):
+    def test_deduplicate_branches(self):
+        files = {
+            'foo_1.0-1.dsc': {'sha256': '00' * 32, 'size': 1},
+            'foo_1.0.orig.tar.gz': {'sha256': '11' * 32, 'size': 2},
+        }
+        other_files = {
+            'foo_1.0-2.dsc': {'sha256': '22' * 32, 'size': 1},
+            'foo_1.0.orig.tar.gz': {'sha256': '11' * 32, 'size': 2},
+        }
+        packages = {
+            'a': {'files': files, 'revision_id': None},
+            'b': {'files': other_files, 'revision_id': None},
+            'c': {'files': dict(reversed(list(files.items()))),
+                  'revision_id': '01' * 20},
+            'd': {'revision_id': '02' * 20},
+        }
+
+        equiv_branch, branches_revs = deduplicate_branches(packages)
+
+        self.assertEqual(equiv_branch, {'a': 'a', 'b': 'b', 'c': 'a',
+                                        'd': 'd'})
+        self.assertEqual(branches_revs, {
+            'a': b'\x01' * 20,
+            'b': None,
+            'd': b'\x02' * 20,
+        })
+
+
+class TestUpdatePackagesRevisions(TestCase):
+    def get_db_session(self):
+        """A session on an empty lister database"""
+        engine = create_engine('sqlite://')
+        SQLBase.metadata.create_all(engine)
+        return sessionmaker(bind=engine)()
+
+    def test_update_packages_revisions(self):
+        db_session = self.get_db_session()
+        area = Area(distribution=Distribution(name='Debian', type='deb',
+                                              mirror_uri='http://x/'),
+                    name='main')
+        packages = [
+            Package(area=area, name='foo', version=str(i), directory='d',
+                    files={})
+            for i in range(5)
+        ]
+        db_session.add_all(packages)
+        db_session.commit()
+
+        revisions = {
+            package.id: bytes([package.id]) * 20 for package in packages[1:]
+        }
+        update_packages_revisions(db_session, revisions, batch_size=3)
+
+        db_session.expire_all()
+        self.assertEqual(
+            get_packages_revisions(db_session,
+                                   [package.id for package in packages],
+                                   batch_size=2),
+            revisions,
+        )
+
+        revisions[packages[0].id] = None
+        self.assertEqual(
+            dict(db_session.query(Package.id, Package.revision_id)),
+            revisions,
+        )
+
+
+class TestUpdatePackagesRevisionsPostgresql(SingleDbTestFixture,
+                                            TestUpdatePackagesRevisions):
+    """Update the packages with a single statement per batch"""
+    TEST_DB_NAME = 'test-lister-debian'
+    TEST_DB_DUMP = []  # type: Iterable[str]
+
+    def get_db_session(self):
+        engine = create_engine(TEST_LOADER_CONFIG['lister_db_url'])
+        SQLBase.metadata.create_all(engine)
+        db_session = sessionmaker(bind=engine)()
+        self.addCleanup(engine.dispose)
+        self.addCleanup(SQLBase.metadata.drop_all, engine)
+        self.addCleanup(db_session.close)
+        self.assertEqual(engine.dialect.name, 'postgresql')
+        return db_session
+
+
+@pytest.mark.fs
+class TestPruneKnownObjects(TestCase):
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            for path in ['src/a/1', 'src/a/2', 'src/b/3', 'debian/4']:
+                path = os.path.join(tempdir, path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as f:
+                    f.write(path)
+            self.directory = Directory.from_disk(path=os.fsencode(tempdir))
+        self.objects = self.directory.collect()
+        self.checked = []
+
+    def _directory_missing(self, known):
+        known_ids = {self.directory[path].hash for path in known}
+
+        def directory_missing(dir_ids):
+            self.checked.append(set(dir_ids))
+            return [dir_id for dir_id in dir_ids if dir_id not in known_ids]
+        return directory_missing
+
+    def test_prune_known_subtree(self):
+        objects = prune_known_objects(
+            self.objects, self.directory.hash,
+            self._directory_missing([b'src']),
+        )
+
+        self.assertEqual(set(objects['directory']), {
+            self.directory.hash, self.directory[b'debian'].hash,
+        })
+        self.assertEqual(set(objects['content']), {
+            self.directory[b'debian/4'].hash,
+        })
+        # the subdirectories of src were never looked at
+        self.assertEqual(self.checked, [
+            {self.directory.hash},
+            {self.directory[b'src'].hash, self.directory[b'debian'].hash},
+        ])
+
+    def test_prune_known_root(self):
+        objects = prune_known_objects(
+            self.objects, self.directory.hash,
+            self._directory_missing([b'']),
+        )
+        self.assertEqual(objects['directory'], {})
+        self.assertEqual(objects['content'], {})
+
+    def test_prune_nothing_known(self):
+        objects = prune_known_objects(
+            self.objects, self.directory.hash,
+            self._directory_missing([]),
+        )
+        self.assertEqual(objects, self.objects)
 
 
 @pytest.mark.fs
@@ -99,8 +267,8 @@ class TestDebianLoader(SingleDbTestFixture, BaseLoaderTest):
         self.loader.db_session.commit()
         self.pkg_id = pkg.id
 
-    def _load(self):
-        self.loader.load(
+    def _load(self, revision_id=None):
+        return self.loader.load(
             origin=self.repo_url,
             date='2018-12-14 16:45:00+00',
             packages={
@@ -108,7 +276,7 @@ class TestDebianLoader(SingleDbTestFixture, BaseLoaderTest):
                     'id': self.pkg_id,
                     'name': 'hello',
                     'version': '2.10-1+deb9u1',
-                    'revision_id': None,
+                    'revision_id': revision_id,
                     'files': self.files,
                 }
             }
@@ -148,3 +316,505 @@ class TestDebianLoader(SingleDbTestFixture, BaseLoaderTest):
         missing = list(self.storage.content_missing(
             [{'sha1': hash_to_bytes(hello_c_hash)}]))
         self.assertEqual(missing, [])
+
+    def test_revisit_unchanged(self):
+        with requests_mock.Mocker() as m:
+            for file_ in self.files.values():
+                path = os.path.join(RESOURCES_PATH, file_['name'])
+                with open(path, 'rb') as fd:
+                    m.get(file_['uri'], content=fd.read())
+            self.assertEqual(self._load()['status'], 'eventful')
+        origin_id = self.loader.origin_id
+        snapshot = self.storage.snapshot_get_latest(origin_id)
+        (revision_id,) = [branch['target']
+                          for branch in snapshot['branches'].values()]
+
+        # nothing to download, and the snapshot of the first visit is reused
+        result = self._load(revision_id=revision_id)
+        self.assertEqual(result['status'], 'uneventful')
+        self.assertNotIn('flush', result['stats']['stages'])
+        self.assertCountSnapshots(1)
+        self.assertEqual(
+            self.storage.snapshot_get_by_origin_visit(
+                origin_id, self.loader.visit)['id'],
+            snapshot['id'])
+
+
+@pytest.mark.fs
+class LoaderTestCase(TestCase):
+    """Load versions of the hello package of the test resources, with a
+    SQLite lister database.
+
+    The versions only differ by the name of their dsc file: they share their
+    tree, but not their revision.
+
+    """
+
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.tmp = tempdir.name
+        self.scratch_dir = os.path.join(tempdir.name, 'scratch')
+        os.mkdir(self.scratch_dir)
+        self.db_url = 'sqlite:///%s' % os.path.join(tempdir.name, 'lister.db')
+        engine = create_engine(self.db_url)
+        self.addCleanup(engine.dispose)
+        SQLBase.metadata.create_all(engine)
+        self.db_session = sessionmaker(bind=engine)()
+        self.addCleanup(self.db_session.close)
+        self.area = Area(distribution=Distribution(name='Debian', type='deb',
+                                                   mirror_uri='devnull://'),
+                         name='main')
+
+    def make_packages(self, versions, broken=(), mirror=None):
+        """Add versions of hello to the lister database.
+
+        Args:
+            versions (list): the versions to add
+            broken (list): the versions whose dsc file is missing
+            mirror (FaultyMirror): the mirror to serve the files of the
+              packages from, rather than their ``file://`` uris
+
+        Returns:
+            dict: the packages, as given to the loader, indexed by branch
+
+        """
+        packages = {}
+        for version in versions:
+            files = {}
+            for source in HELLO_FILES:
+                name = source
+                with open(os.path.join(RESOURCES_PATH, source), 'rb') as f:
+                    data = f.read()
+                if name.endswith('.dsc'):
+                    name = 'hello_%s.dsc' % version
+                    if version in broken:
+                        source = 'missing.dsc'
+                uri = 'file://%s/%s' % (RESOURCES_PATH, source)
+                if mirror is not None:
+                    mirror.files[name] = data
+                    uri = mirror.base_uri + name
+                files[name] = {
+                    'name': name,
+                    'uri': uri,
+                    'size': len(data),
+                    'sha256': hashlib.sha256(data).hexdigest(),
+                }
+            package = Package(area=self.area, name='hello', version=version,
+                              directory='dir', files=files)
+            self.db_session.add(package)
+            self.db_session.commit()
+            packages['sid/main/%s' % version] = {
+                'id': package.id,
+                'name': 'hello',
+                'version': version,
+                'revision_id': None,
+                'files': files,
+            }
+        return packages
+
+    def forget_revisions(self):
+        """Forget the revisions saved to the lister database by the previous
+        loads"""
+        self.db_session.query(Package).update({'revision_id': None})
+        self.db_session.commit()
+
+    def get_config(self, **config):
+        return dict(TEST_LOADER_CONFIG, lister_db_url=self.db_url,
+                    scratch_dirs=[{'path': self.scratch_dir}], **config)
+
+    def get_loader(self, **config):
+        return DebianLoader(config=self.get_config(**config))
+
+    def load(self, loader, packages):
+        """Load packages, failing rather than hanging if the load does"""
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(loader.load(
+            origin='http://deb.debian.org/hello',
+            date='2019-01-01 00:00:00+00', packages=packages)), daemon=True)
+        thread.start()
+        thread.join(timeout=LOAD_TIMEOUT)
+        self.assertFalse(thread.is_alive(), 'The load hangs')
+        return result
+
+    def get_archive(self, loader):
+        """The objects loaded: the snapshot of the last visit, the revisions
+        it targets, the (recursive) listing of their trees, and the number
+        of objects of each type"""
+        storage = loader.storage
+        snapshot = storage.snapshot_get_latest(loader.origin_id)
+        revisions = list(storage.revision_get(sorted({
+            branch['target'] for branch in snapshot['branches'].values()
+            if branch is not None})))
+        directories = {
+            revision['directory']: list(storage.directory_ls(
+                revision['directory'], recursive=True))
+            for revision in revisions
+        }
+        storage.refresh_stat_counters()
+        return snapshot, revisions, directories, storage.stat_counters()
+
+    def assertScratchReleased(self, loader):
+        self.assertEqual(loader.downloader.scratch.reserved, 0)
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+
+class TestCheckpoints(LoaderTestCase):
+    def test_resume_interrupted_visit(self):
+        packages = self.make_packages(['2.10-1', '2.10-2', '2.10-3'])
+        loader = self.get_loader()
+        self.load(loader, packages)
+        snapshot, revisions, _, _ = self.get_archive(loader)
+
+        # interrupted after the first version
+        self.forget_revisions()
+        interrupted = self.get_loader(checkpoint_interval=1)
+        process_version = interrupted.process_version
+
+        def crash(idx):
+            if idx > 0:
+                raise RuntimeError('crash')
+            return process_version(idx)
+
+        with mock.patch.object(interrupted, 'process_version', crash):
+            result = self.load(interrupted, packages)
+        self.assertEqual(result['status'], 'failed')
+        self.db_session.expire_all()
+        saved = get_packages_revisions(
+            self.db_session, [package['id'] for package in packages.values()])
+        self.assertEqual(list(saved),
+                         [packages['sid/main/2.10-1']['id']])
+
+        # the remaining versions are loaded by the next visit
+        loader = self.get_loader(checkpoint_interval=1)
+        loader.storage = interrupted.storage
+        result = self.load(loader, packages)
+        self.assertEqual(result['status'], 'eventful')
+        self.assertEqual(result['stats']['versions'], 2)
+        self.assertEqual(
+            [branch for branch, _ in loader.versions_to_load],
+            ['sid/main/2.10-2', 'sid/main/2.10-3'])
+
+        resumed, resumed_revisions, _, _ = self.get_archive(loader)
+        self.assertEqual(len(resumed['branches']), 3)
+        self.assertEqual(resumed['id'], snapshot['id'])
+        self.assertEqual(resumed['branches'], snapshot['branches'])
+        self.assertEqual(resumed_revisions, revisions)
+
+
+class TestLoaderRevisionIndex(LoaderTestCase):
+    def test_index_per_visit(self):
+        packages = self.make_packages(['2.10-1'])
+        loader = self.get_loader(
+            revision_index_path=os.path.join(self.tmp, 'index.sqlite'))
+        indexes = []
+
+        def open_index(path):
+            indexes.append(RevisionIndex(path))
+            return indexes[-1]
+
+        with mock.patch('swh.loader.debian.loader.RevisionIndex',
+                        side_effect=open_index):
+            self.assertEqual(self.load(loader, packages)['status'],
+                             'eventful')
+            # the revision is found in the index by the next visit
+            self.forget_revisions()
+            result = self.load(loader, packages)
+        self.assertEqual(result['status'], 'uneventful')
+        self.assertEqual(result['stats']['versions'], 0)
+
+        # each visit closed the index it opened
+        self.assertEqual(len(indexes), 2)
+        for index in indexes:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                index.db.execute('select 1')
+        self.assertIsNone(loader.revision_index)
+
+
+class TestStoreDirectories(LoaderTestCase):
+    def test_directories_checked_once(self):
+        packages = self.make_packages(['2.10-1', '2.10-2'])
+        loader = self.get_loader()
+        checked = []
+        directory_missing = loader.storage.directory_missing
+
+        def record_directory_missing(dir_ids):
+            checked.extend(dir_ids)
+            return directory_missing(dir_ids)
+
+        with mock.patch.object(loader.storage, 'directory_missing',
+                               side_effect=record_directory_missing):
+            self.assertEqual(self.load(loader, packages)['status'],
+                             'eventful')
+
+        # the directories found missing when pruning are not checked again
+        # before being sent
+        self.assertTrue(checked)
+        self.assertEqual(len(checked), len(set(checked)))
+        _, _, directories, _ = self.get_archive(loader)
+        for root, entries in directories.items():
+            self.assertIn(root, checked)
+            for entry in entries:
+                if entry['type'] == 'dir':
+                    self.assertIn(entry['target'], checked)
+
+
+class TestMetricsSink(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.server.close)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+        self.metrics_config = {'cls': 'statsd', 'args': {
+            'host': '127.0.0.1',
+            'port': self.server.getsockname()[1],
+        }}
+
+    def test_own_sink_closed(self):
+        packages = self.make_packages(['2.10-1'])
+        loader = self.get_loader(metrics=self.metrics_config)
+        self.assertEqual(self.load(loader, packages)['status'], 'eventful')
+        self.assertTrue(self.server.recv(1024))
+        self.assertIsNone(loader.metrics.socket)
+
+    def test_shared_sink(self):
+        packages = self.make_packages(['2.10-1'])
+        resources = WorkerResources()
+        loaders = [
+            DebianLoader(config=self.get_config(metrics=self.metrics_config),
+                         resources=resources)
+            for _ in range(2)
+        ]
+        self.assertIs(loaders[0].metrics, loaders[1].metrics)
+        self.assertEqual(self.load(loaders[0], packages)['status'],
+                         'eventful')
+        self.assertTrue(self.server.recv(1024))
+        # the sink of the worker process stays open for its next loaders
+        metrics = resources.get_metrics(self.metrics_config)
+        self.assertIs(loaders[0].metrics, metrics)
+        self.assertIsNotNone(metrics.socket)
+        metrics.close()
+
+
+class TestPipeline(LoaderTestCase):
+    def test_version_order(self):
+        packages = self.make_packages(['2.10-1', '2.10-2', '2.10-3'])
+
+        self.forget_revisions()
+        loader = self.get_loader()
+        self.load(loader, packages)
+        sequential = self.get_archive(loader)
+
+        self.forget_revisions()
+        loader = self.get_loader(pipeline_depth=2)
+        stored = []
+        store_data = loader.store_data
+
+        def record_store_data():
+            stored.append(loader.current_branch)
+            store_data()
+
+        with mock.patch.object(loader, 'store_data', record_store_data):
+            result = self.load(loader, packages)
+
+        self.assertEqual(result['status'], 'eventful')
+        self.assertEqual(stored, sorted(packages))
+        self.assertEqual(self.get_archive(loader), sequential)
+        self.assertIsNone(loader.pipeline)
+        self.assertScratchReleased(loader)
+
+    def test_failed_version(self):
+        packages = self.make_packages(['2.10-1', '2.10-2', '2.10-3'],
+                                      broken=['2.10-2'])
+        # equivalent branches, of the same files
+        area = Area(distribution=self.area.distribution, name='contrib')
+        for version in ['2.10-1', '2.10-2']:
+            package = packages['sid/main/%s' % version]
+            row = Package(area=area, name='hello', version=version,
+                          directory='dir', files=package['files'])
+            self.db_session.add(row)
+            self.db_session.commit()
+            packages['sid/contrib/%s' % version] = dict(package, id=row.id)
+
+        loader = self.get_loader(pipeline_depth=2)
+        result = self.load(loader, packages)
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(result['stats']['versions'], 3)
+        self.assertEqual(result['stats']['versions_failed'], 1)
+        self.assertTrue(loader.partial)
+
+        snapshot, revisions, _, _ = self.get_archive(loader)
+        targets = {
+            branch.decode(): target and target['target']
+            for branch, target in snapshot['branches'].items()
+        }
+        self.assertIsNone(targets['sid/main/2.10-2'])
+        self.assertIsNone(targets['sid/contrib/2.10-2'])
+        self.assertEqual(targets['sid/contrib/2.10-1'],
+                         targets['sid/main/2.10-1'])
+        self.assertEqual(len(revisions), 2)
+
+        self.db_session.expire_all()
+        self.assertEqual(
+            get_packages_revisions(self.db_session, [
+                package['id'] for package in packages.values()]),
+            {package['id']: targets[branch]
+             for branch, package in packages.items() if targets[branch]},
+        )
+        self.assertScratchReleased(loader)
+
+    def test_failure_with_results_queued(self):
+        packages = self.make_packages(['2.10-1', '2.10-2', '2.10-3'])
+        loader = self.get_loader(pipeline_depth=2)
+
+        def fail(*args, **kwargs):
+            # once the following versions are processed ahead
+            deadline = time.monotonic() + LOAD_TIMEOUT
+            while (loader.pipeline.qsize() < 2
+                   and time.monotonic() < deadline):
+                time.sleep(0.01)
+            self.assertEqual(loader.pipeline.qsize(), 2)
+            raise RuntimeError('storage down')
+
+        with mock.patch.object(loader, 'maybe_load_missing_directories',
+                               side_effect=fail):
+            result = self.load(loader, packages)
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertIsNone(loader.pipeline)
+        self.assertEqual(loader.tempdirs, [])
+        self.assertScratchReleased(loader)
+
+    def test_failure_waiting_for_scratch_space(self):
+        packages = self.make_packages(['2.10-1', '2.10-2', '2.10-3'])
+        # room for a single version at a time: the pipeline worker waits for
+        # the version being stored to be released
+        budget = package_size(packages['sid/main/2.10-1']) * (
+            1 + TEST_LOADER_CONFIG['scratch_expansion_factor'])
+        loader = self.get_loader(pipeline_depth=2, scratch_budget=budget)
+        with mock.patch.object(loader, 'maybe_load_missing_directories',
+                               side_effect=RuntimeError('storage down')):
+            result = self.load(loader, packages)
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(loader.versions_failed, 0)
+        self.assertIsNone(loader.pipeline)
+        self.assertScratchReleased(loader)
+
+
+class TestProcessPool(LoaderTestCase):
+    def test_same_as_sequential(self):
+        packages = self.make_packages(['2.10-1', '2.10-2', '2.10-3'])
+
+        archives = []
+        for process_pool_size in [0, 2]:
+            self.forget_revisions()
+            loader = self.get_loader(process_pool_size=process_pool_size)
+            result = self.load(loader, packages)
+            self.assertEqual(result['status'], 'eventful')
+            self.assertEqual(result['stats']['versions'], 3)
+            self.assertIsNone(loader.process_pool)
+            self.assertScratchReleased(loader)
+            archives.append(self.get_archive(loader))
+
+        snapshot, revisions, directories, counters = archives[0]
+        self.assertEqual(len(snapshot['branches']), 3)
+        self.assertEqual(len(revisions), 3)
+        self.assertEqual(counters['directory'], 14)
+        self.assertEqual(archives[1], archives[0])
+
+
+class TestLoadMany(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.mirror = FaultyMirror({})
+        self.addCleanup(self.mirror.stop)
+
+    def load_batch(self, **config):
+        """Load two origins sharing a version through the batch task, with
+        the given loader configuration.
+
+        Returns:
+            tuple: the results of the visits, the origins loaded, and the
+            storage they were loaded to
+
+        """
+        packages = self.make_packages(['2.10-1', '2.10-2', '2.10-3'],
+                                      mirror=self.mirror)
+        origins = collections.OrderedDict([
+            ('http://deb.debian.org/hello', {
+                branch: packages[branch]
+                for branch in ['sid/main/2.10-1', 'sid/main/2.10-2']
+            }),
+            ('http://deb.debian.org/hello-fork', {
+                branch: packages[branch]
+                for branch in ['sid/main/2.10-1', 'sid/main/2.10-3']
+            }),
+        ])
+
+        resources = self.resources = WorkerResources()
+        config = self.get_config(**config)
+        resources.loader_configs[DebianLoader] = config
+        with mock.patch('swh.loader.debian.tasks.get_worker_resources',
+                        return_value=resources):
+            results = load_debian_packages_batch(
+                list(origins.items()), date='2019-01-01 00:00:00+00')
+        return results, origins, resources.get_storage(config['storage'])
+
+    def assertVisits(self, results, origins, storage):
+        self.assertEqual([result['status'] for result in results],
+                         ['eventful', 'eventful'])
+        snapshots = []
+        for origin, packages in origins.items():
+            origin_id = storage.origin_get(
+                {'type': 'deb', 'url': origin})['id']
+            self.assertEqual(len(list(storage.origin_visit_get(origin_id))), 1)
+            snapshot = storage.snapshot_get_latest(origin_id)
+            self.assertEqual(
+                {branch.decode() for branch in snapshot['branches']},
+                set(packages))
+            snapshots.append(snapshot['id'])
+        self.assertNotEqual(snapshots[0], snapshots[1])
+
+        # the files were downloaded once, for both origins (and the dsc files
+        # of the versions, which have the same contents, only once)
+        contents = {hashlib.sha256(data).digest()
+                    for data in self.mirror.files.values()}
+        self.assertEqual(len(self.mirror.requests), len(contents))
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+    def test_load_many(self):
+        results, origins, storage = self.load_batch()
+        self.assertVisits(results, origins, storage)
+
+        # the tree of the shared upstream tarball is not hashed again
+        hashed = [result['stats']['stages']['hash']['files']
+                  for result in results]
+        self.assertLess(hashed[1], hashed[0])
+
+    def test_load_many_process_pool(self):
+        results, origins, storage = self.load_batch(process_pool_size=2)
+        self.assertVisits(results, origins, storage)
+
+    def test_load_many_scratch_shared(self):
+        downloaders = []
+        load = DebianLoader.load
+
+        def record_load(loader, **kwargs):
+            downloaders.append(loader.downloader)
+            return load(loader, **kwargs)
+
+        with mock.patch.object(DebianLoader, 'load', autospec=True,
+                               side_effect=record_load):
+            results, origins, storage = self.load_batch()
+        self.assertVisits(results, origins, storage)
+
+        # the download engine of the batch, with its own artifact cache,
+        # counts against the scratch budget of the worker process
+        shared = self.resources.get_downloader(self.get_config())
+        self.assertEqual(len(downloaders), 2)
+        for downloader in downloaders:
+            self.assertIsNot(downloader, shared)
+            self.assertIs(downloader.scratch, shared.scratch)
@@ -0,0 +1,98 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import pickle
+import socket
+from unittest import TestCase
+
+from swh.loader.debian.hashing import IOStats
+from swh.loader.debian.metrics import (
+    InMemoryMetrics, LoadStats, NoopMetrics, StatsdMetrics, get_metrics,
+)
+
+
+class TestLoadStats(TestCase):
+    def test_stage(self):
+        stats = LoadStats()
+        io_stats = IOStats()
+        io_stats.files, io_stats.bytes_read = 2, 100
+        for _ in range(2):
+            with stats.stage('hash', io_stats):
+                io_stats.files += 3
+                io_stats.bytes_read += 10
+                io_stats.bytes_mapped += 1000
+        with self.assertRaises(ValueError):
+            with stats.stage('download') as stage:
+                stage.files += 1
+                raise ValueError()
+
+        self.assertEqual(list(stats.stages), ['hash', 'download'])
+        self.assertEqual((stats['hash'].calls, stats['hash'].files,
+                          stats['hash'].bytes), (2, 6, 2020))
+        self.assertEqual((stats['download'].calls, stats['download'].files),
+                         (1, 1))
+        self.assertGreaterEqual(stats['hash'].seconds, 0)
+
+        extra = stats.as_log_extra()
+        self.assertEqual(extra['swh_hash_files'], 6)
+        self.assertEqual(extra['swh_hash_bytes'], 2020)
+        self.assertNotIn('swh_download_bytes', extra)
+
+    def test_merge(self):
+        stats = LoadStats()
+        with stats.stage('download') as stage:
+            stage.bytes += 10
+        other = pickle.loads(pickle.dumps(stats))
+        with other.stage('store'):
+            pass
+        stats.merge(other)
+
+        summary = stats.to_dict()
+        self.assertEqual(list(summary), ['download', 'store'])
+        self.assertEqual(summary['download']['calls'], 2)
+        self.assertEqual(summary['download']['bytes'], 20)
+
+    def test_send(self):
+        stats = LoadStats()
+        with stats.stage('download') as stage:
+            stage.files += 3
+        metrics = InMemoryMetrics()
+        stats.send(metrics)
+        stats.send(metrics)
+
+        self.assertEqual(len(metrics.timings['stage.download']), 2)
+        self.assertEqual(metrics.counters, {'stage.download.files': 6})
+
+
+class TestMetrics(TestCase):
+    def test_get_metrics(self):
+        self.assertIsInstance(get_metrics(), NoopMetrics)
+        self.assertIsInstance(get_metrics('memory'), InMemoryMetrics)
+        with self.assertRaises(ValueError):
+            get_metrics('unknown')
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        metrics = get_metrics('statsd', {
+            'host': '127.0.0.1',
+            'port': server.getsockname()[1],
+            'prefix': 'test',
+        })
+        self.assertIsInstance(metrics, StatsdMetrics)
+
+        metrics.timing('stage.download', 1.5)
+        metrics.increment('versions', 2)
+        self.assertEqual(server.recv(1024), b'test.stage.download:1500|ms')
+        self.assertEqual(server.recv(1024), b'test.versions:2|c')
+
+        # the socket is opened again after the sink is closed
+        metrics.close()
+        self.assertIsNone(metrics.socket)
+        metrics.increment('versions')
+        self.assertEqual(server.recv(1024), b'test.versions:1|c')
+        metrics.close()
@@ -0,0 +1,79 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import datetime
+import pickle
+import types
+from unittest import TestCase
+
+from swh.loader.debian import converters
+from swh.loader.debian.records import (
+    ChangelogInfo, OriginalArtifact, PackageMetadata,
+)
+
+
+class TestRecords(TestCase):
+    def setUp(self):
+        self.artifact = OriginalArtifact(
+            name='foo_1.0-1.dsc', length=10, sha1='01' * 20,
+            sha1_git='02' * 20, sha256='03' * 32, blake2s256='04' * 32,
+        )
+        self.metadata = PackageMetadata(
+            name='foo',
+            version='1.0-1',
+            changelog=ChangelogInfo(
+                person=converters.uid_to_person('J\xe9r\xf4me <j@d.org>'),
+                date=datetime.datetime(2019, 1, 2, 3, 4, 5,
+                                       tzinfo=datetime.timezone.utc),
+                history=(('foo', '0.9-1'),),
+            ),
+            maintainers=('Jane <jane@d.org>', 'John <john@d.org>'),
+            original_artifact=(self.artifact, self.artifact),
+        )
+
+    def test_original_artifact(self):
+        d = self.artifact.to_dict()
+        self.assertEqual(d['sha1_git'], '02' * 20)
+        self.assertEqual(OriginalArtifact.from_dict(d), self.artifact)
+        self.assertEqual(OriginalArtifact.from_hashes(
+            'foo_1.0-1.dsc', 10, dict(d, md5='05' * 16)), self.artifact)
+
+    def test_to_revision_metadata(self):
+        self.assertEqual(self.metadata.to_revision_metadata(), {
+            'original_artifact': [self.artifact.to_dict()] * 2,
+            'package_info': {
+                'name': 'foo',
+                'version': '1.0-1',
+                'changelog': {
+                    'person': {
+                        'name': 'J\xe9r\xf4me',
+                        'email': 'j@d.org',
+                        'fullname': 'J\xe9r\xf4me <j@d.org>',
+                    },
+                    'date': '2019-01-02T03:04:05+00:00',
+                    'history': [('foo', '0.9-1')],
+                },
+                'maintainers': [
+                    {'name': 'Jane', 'email': 'jane@d.org',
+                     'fullname': 'Jane <jane@d.org>'},
+                    {'name': 'John', 'email': 'john@d.org',
+                     'fullname': 'John <john@d.org>'},
+                ],
+            },
+        })
+
+    def test_package_metadata_to_revision(self):
+        metadata = pickle.loads(pickle.dumps(self.metadata))
+        self.assertEqual(metadata, self.metadata)
+
+        revision = converters.package_metadata_to_revision(
+            {'name': 'foo', 'version': '1.0-1'},
+            types.SimpleNamespace(hash=b'\x00' * 20), metadata,
+        )
+        self.assertEqual(revision['author'], self.metadata.changelog.person)
+        self.assertEqual(revision['metadata'],
+                         self.metadata.to_revision_metadata())
+        self.assertEqual(revision['id'].hex(),
+                         '69042510b0380faaf9b0fb04382950ea3ad635bf')
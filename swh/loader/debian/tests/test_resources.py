@@ -0,0 +1,62 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import os
+from unittest import TestCase, mock
+
+from swh.loader.debian.loader import PLACEHOLDER_STORAGE_CONFIG, DebianLoader
+from swh.loader.debian.resources import WorkerResources, get_worker_resources
+
+from . import TEST_LOADER_CONFIG
+
+
+class TestWorkerResources(TestCase):
+    def test_shared(self):
+        resources = get_worker_resources()
+        self.assertIs(resources, get_worker_resources())
+
+        storage = resources.get_storage({'cls': 'memory', 'args': {}})
+        self.assertIs(storage,
+                      resources.get_storage({'args': {}, 'cls': 'memory'}))
+
+        downloader = resources.get_downloader(TEST_LOADER_CONFIG)
+        self.assertIs(downloader, resources.get_downloader(
+            dict(TEST_LOADER_CONFIG, download_prefetch=True)))
+        self.assertIsNot(downloader, resources.get_downloader(
+            dict(TEST_LOADER_CONFIG, download_max_workers=1)))
+
+        metrics = resources.get_metrics({'cls': 'memory', 'args': {}})
+        self.assertIs(metrics,
+                      resources.get_metrics({'args': {}, 'cls': 'memory'}))
+        self.assertIsNot(metrics, resources.get_metrics({'cls': 'noop'}))
+
+        sessions = [resources.get_db_session('sqlite://') for _ in range(2)]
+        self.assertIsNot(sessions[0], sessions[1])
+        self.assertIs(sessions[0].bind, sessions[1].bind)
+
+    def test_loader_storage(self):
+        resources = WorkerResources()
+        config = dict(TEST_LOADER_CONFIG, lister_db_url='sqlite://')
+        with mock.patch('swh.loader.core.loader.get_storage',
+                        wraps=lambda **kwargs: object()) as get_storage:
+            loaders = [DebianLoader(config=config, resources=resources)
+                       for _ in range(2)]
+        # the core loader only built placeholders
+        self.assertEqual(get_storage.call_args_list, [
+            mock.call(**PLACEHOLDER_STORAGE_CONFIG)] * 2)
+        self.assertIs(loaders[0].storage, loaders[1].storage)
+        self.assertIs(loaders[0].storage,
+                      resources.get_storage(config['storage']))
+        self.assertEqual(loaders[0].config, config)
+
+    def test_fork(self):
+        resources = get_worker_resources()
+        pid = os.fork()
+        if pid == 0:
+            # exit status 0 iff the child got its own resources
+            os._exit(int(get_worker_resources() is resources))
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertIs(get_worker_resources(), resources)
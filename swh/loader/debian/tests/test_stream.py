@@ -0,0 +1,61 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import os
+import tempfile
+from unittest import TestCase
+
+from swh.model.from_disk import Directory
+
+from swh.loader.debian.stream import TreeStreamer
+
+
+class TestTreeStreamer(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.fsencode(self.tempdir.name)
+        for i in range(4):
+            for j in range(5):
+                path = os.path.join(self.tempdir.name, 'd%d' % i, 'e%d' % j)
+                os.makedirs(path)
+                with open(os.path.join(path, 'f'), 'w') as f:
+                    f.write('%d %d' % (i, j))
+                os.symlink('f', os.path.join(path, 'link'))
+        os.makedirs(os.path.join(self.tempdir.name, 'empty'))
+        os.chmod(os.path.join(self.tempdir.name, 'd0', 'e0', 'f'), 0o755)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_stream(self):
+        streamer = TreeStreamer(self.path, batch_size=3)
+        sent = set()
+        contents = {}
+        directories = {}
+        for object_type, objects in streamer:
+            self.assertLessEqual(len(objects), 3)
+            if object_type == 'content':
+                for content in objects:
+                    sent.add(content['sha1_git'])
+                    contents[content['sha1_git']] = content
+            else:
+                for directory in objects:
+                    # children come first
+                    for entry in directory['entries']:
+                        self.assertIn(entry['target'], sent)
+                    sent.add(directory['id'])
+                    directories[directory['id']] = directory
+
+        expected = Directory.from_disk(path=self.path, save_path=True)
+        self.assertEqual(streamer.hash, expected.hash)
+
+        objects = expected.collect()
+        self.assertEqual(contents, objects['content'])
+        self.assertEqual(
+            {dir_id: sorted(d['entries'], key=lambda e: e['name'])
+             for dir_id, d in directories.items()},
+            {dir_id: sorted(d['entries'], key=lambda e: e['name'])
+             for dir_id, d in objects['directory'].items()},
+        )
@@ -0,0 +1,140 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest import TestCase
+
+import pytest
+
+from swh.model.from_disk import Directory
+from swh.loader.debian.loader import extract_package
+from swh.loader.debian.unpack import unpack_package
+
+RESOURCES_PATH = os.path.join(os.path.dirname(__file__), 'resources')
+
+CHANGELOG = b'''foo (1.0) unstable; urgency=low
+
+  * Initial release.
+
+ -- Jane Doe <jane@example.org>  Mon, 01 Jan 2018 00:00:00 +0000
+'''
+
+
+def _add_member(tar, name, data=None, mode=0o644, linkname=None):
+    info = tarfile.TarInfo(name)
+    info.mode = mode
+    if linkname is not None:
+        info.type = tarfile.SYMTYPE
+        info.linkname = linkname
+        tar.addfile(info)
+    elif data is None:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tar.addfile(info)
+    else:
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+
+def _write_dsc(path, source_format, files):
+    lines = [
+        'Format: %s' % source_format,
+        'Source: foo',
+        'Version: 1.0',
+        'Files:',
+    ]
+    for name in files:
+        with open(os.path.join(os.path.dirname(path), name), 'rb') as f:
+            data = f.read()
+        lines.append(' %s %s %s' % (hashlib.md5(data).hexdigest(),
+                                    len(data), name))
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+@pytest.mark.fs
+class TestUnpackPackage(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _check_unpack(self, package, dsc_name):
+        dsc_path = os.path.join(self.tempdir.name, dsc_name)
+        unpacked = unpack_package(package, dsc_path, max_size=10 ** 9,
+                                  content_size_limit=10 ** 9)
+        self.assertIsNotNone(unpacked)
+        directory, changelog = unpacked
+
+        _, debdir = extract_package(package, self.tempdir)
+        expected = Directory.from_disk(path=os.fsencode(debdir))
+        self.assertEqual(directory.hash, expected.hash)
+        with open(os.path.join(debdir, 'debian/changelog'), 'rb') as f:
+            self.assertEqual(changelog, f.read())
+        return directory
+
+    def test_unpack_quilt(self):
+        files = ['hello_2.10-1+deb9u1.dsc',
+                 'hello_2.10-1+deb9u1.debian.tar.xz',
+                 'hello_2.10.orig.tar.gz']
+        for name in files:
+            shutil.copy(os.path.join(RESOURCES_PATH, name),
+                        self.tempdir.name)
+        package = {
+            'name': 'hello',
+            'version': '2.10-1+deb9u1',
+            'files': {name: {'name': name} for name in files},
+        }
+
+        directory = self._check_unpack(package, files[0])
+        self.assertEqual(directory.hash.hex(),
+                         'c906789049d2327a69b81cca6a1c1737321c836f')
+
+    def _make_native(self, extra_members=()):
+        tarball = os.path.join(self.tempdir.name, 'foo_1.0.tar.xz')
+        with tarfile.open(tarball, 'w:xz') as tar:
+            _add_member(tar, 'foo-1.0')
+            _add_member(tar, 'foo-1.0/debian')
+            _add_member(tar, 'foo-1.0/debian/changelog', CHANGELOG)
+            _add_member(tar, 'foo-1.0/debian/source')
+            _add_member(tar, 'foo-1.0/debian/source/format',
+                        b'3.0 (native)\n')
+            _add_member(tar, 'foo-1.0/configure', b'#!/bin/sh\n', 0o755)
+            _add_member(tar, 'foo-1.0/empty')
+            _add_member(tar, 'foo-1.0/link', linkname='configure')
+            for args in extra_members:
+                _add_member(tar, *args)
+
+        _write_dsc(os.path.join(self.tempdir.name, 'foo_1.0.dsc'),
+                   '3.0 (native)', ['foo_1.0.tar.xz'])
+        return {
+            'name': 'foo',
+            'version': '1.0',
+            'files': {name: {'name': name}
+                      for name in ['foo_1.0.dsc', 'foo_1.0.tar.xz']},
+        }
+
+    def test_unpack_native(self):
+        package = self._make_native()
+        directory = self._check_unpack(package, 'foo_1.0.dsc')
+        self.assertIn(b'empty', directory)
+
+    def test_unpack_unsupported_member(self):
+        package = self._make_native(extra_members=[
+            ('foo-1.0/../escape', b'data'),
+        ])
+        dsc_path = os.path.join(self.tempdir.name, 'foo_1.0.dsc')
+        self.assertIsNone(unpack_package(package, dsc_path, 10 ** 9, 10 ** 9))
+
+    def test_unpack_too_large(self):
+        package = self._make_native()
+        dsc_path = os.path.join(self.tempdir.name, 'foo_1.0.dsc')
+        self.assertIsNone(unpack_package(package, dsc_path, 10, 10))
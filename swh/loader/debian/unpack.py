@@ -0,0 +1,297 @@
+# Copyright (C) 2019  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+"""Unpack Debian source packages in memory, without dpkg-source.
+
+Only the source formats for which the result of ``dpkg-source -x`` can be
+reproduced exactly are supported: "3.0 (native)" packages, and "3.0 (quilt)"
+packages without components nor patches to apply. :func:`unpack_package`
+returns None for any other package, so that the caller falls back to
+:func:`swh.loader.debian.loader.extract_package`.
+
+"""
+
+import logging
+import os
+import posixpath
+import re
+import stat
+import tarfile
+
+from debian.deb822 import Dsc
+
+from swh.model.from_disk import (
+    Content, DentryPerms, Directory, mode_to_perms,
+)
+from swh.model.hashutil import MultiHash
+
+from .hashing import get_io_stats
+
+
+log = logging.getLogger(__name__)
+
+TARBALL_RE = re.compile(
+    r'\.(?:(?P<kind>orig|debian|orig-[^.]+)\.)?tar\.(?:gz|bz2|xz)$'
+)
+
+# The quilt database dpkg-source creates when unpacking a "3.0 (quilt)"
+# package (even without patches)
+QUILT_DB = {
+    b'.quilt_patches': b'debian/patches\n',
+    b'.quilt_series': b'series\n',
+    b'.version': b'2\n',
+    b'applied-patches': b'',
+}
+
+REGULAR_FILE_MODE = stat.S_IFREG | 0o644
+EXECUTABLE_FILE_MODE = stat.S_IFREG | 0o755
+SYMLINK_MODE = stat.S_IFLNK | 0o777
+
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+UMASK = _get_umask()
+
+
+class UnpackUnsupported(Exception):
+    """Raised when a package cannot be unpacked exactly in memory"""
+    pass
+
+
+class _Tree:
+    """In-memory tree of the files of a source package, filled from tarballs.
+
+    Directories are represented as plain dicts from entry names (bytes) to
+    entries, files as :class:`Content` objects (which are dicts too).
+
+    Args:
+        max_size (int): maximum cumulated size of the files, over which
+          :exc:`UnpackUnsupported` is raised
+        content_size_limit (int): size over which file data is hashed but
+          not kept in memory (the content will be skipped when sending)
+
+    """
+
+    def __init__(self, max_size, content_size_limit):
+        self.root = {}
+        self.size = 0
+        self.max_size = max_size
+        self.content_size_limit = content_size_limit
+
+    def get_dir(self, parts, create=True):
+        node = self.root
+        for part in parts:
+            child = node.get(part)
+            if child is None:
+                if not create:
+                    return None
+                child = node[part] = {}
+            elif isinstance(child, Content):
+                raise UnpackUnsupported('%r is not a directory' % part)
+            node = child
+        return node
+
+    def add_tarball(self, path, prefix=None):
+        """Add the members of the tarball at path to the tree.
+
+        Args:
+            path (str): the path to the tarball
+            prefix (bytes): if set, the only top-level directory the
+              tarball is allowed to contain
+
+        """
+        with tarfile.open(path, mode='r|*') as tar:
+            for member in tar:
+                name = posixpath.normpath(os.fsencode(member.name))
+                if name.startswith((b'/', b'../')) or name == b'..':
+                    raise UnpackUnsupported('unsafe member %r' % name)
+                if name == b'.':
+                    continue
+                parts = name.split(b'/')
+                if prefix is not None and parts[0] != prefix:
+                    raise UnpackUnsupported('unexpected member %r' % name)
+
+                if member.isdir():
+                    self.get_dir(parts)
+                    continue
+
+                parent = self.get_dir(parts[:-1])
+                existing = parent.get(parts[-1])
+                if existing is not None and not isinstance(existing, Content):
+                    raise UnpackUnsupported('%r is a directory' % name)
+
+                if member.issym():
+                    parent[parts[-1]] = Content.from_bytes(
+                        mode=SYMLINK_MODE,
+                        data=os.fsencode(member.linkname),
+                    )
+                elif member.isreg():
+                    parent[parts[-1]] = self._read_member(tar, member)
+                else:
+                    # hardlinks, devices, fifos
+                    raise UnpackUnsupported('unsupported member %r' % name)
+
+    def _read_member(self, tar, member):
+        self.size += member.size
+        if self.size > self.max_size:
+            raise UnpackUnsupported('package larger than %s bytes' %
+                                    self.max_size)
+
+        keep_data = member.size <= self.content_size_limit
+        hashes = MultiHash(length=member.size)
+        chunks = []
+        fobj = tar.extractfile(member)
+        while True:
+            chunk = fobj.read(1024 * 1024)
+            if not chunk:
+                break
+            hashes.update(chunk)
+            if keep_data:
+                chunks.append(chunk)
+        stats = get_io_stats()
+        stats.files += 1
+        stats.bytes_read += member.size
+
+        # tar applies the umask, then dpkg-source sets the executable bits
+        # of files which kept any of them
+        executable = member.mode & 0o111 & ~UMASK
+        ret = hashes.digest()
+        ret['length'] = member.size
+        ret['perms'] = mode_to_perms(
+            EXECUTABLE_FILE_MODE if executable else REGULAR_FILE_MODE
+        )
+        if keep_data:
+            ret['data'] = b''.join(chunks)
+        return Content(ret)
+
+    def strip_single_directory(self):
+        """Make the only top-level directory of the tree its root, as
+        dpkg-source does when unpacking the main tarball"""
+        if len(self.root) == 1:
+            (child,) = self.root.values()
+            if not isinstance(child, Content):
+                self.root = child
+
+    def to_directory(self, node=None, name=b''):
+        """Convert the tree to a :class:`Directory`"""
+        if node is None:
+            node = self.root
+        ret = Directory({'name': name})
+        ret.update({
+            entry_name: (entry if isinstance(entry, Content)
+                         else self.to_directory(entry, entry_name))
+            for entry_name, entry in node.items()
+        })
+        return ret
+
+
+def _classify_files(package):
+    """Sort the files of package by kind of tarball.
+
+    Returns:
+        dict: file names indexed by kind ('native', 'orig', 'debian')
+
+    """
+    ret = {}
+    for filename in package['files']:
+        if filename.endswith(('.dsc', '.asc')):
+            continue
+        m = TARBALL_RE.search(filename)
+        if not m:
+            raise UnpackUnsupported('unsupported file %s' % filename)
+        kind = m.group('kind') or 'native'
+        if kind.startswith('orig-'):
+            raise UnpackUnsupported('component tarball %s' % filename)
+        if kind in ret:
+            raise UnpackUnsupported('several %s tarballs' % kind)
+        ret[kind] = filename
+    return ret
+
+
+def _has_patches(tree):
+    patches = tree.get_dir([b'debian', b'patches'], create=False)
+    if not patches:
+        return False
+    for series_name, series in patches.items():
+        if not series_name.endswith(b'series'):
+            continue
+        if not isinstance(series, Content) or 'data' not in series.data:
+            return True
+        for line in series.data['data'].splitlines():
+            line = line.split(b'#', 1)[0].strip()
+            if line:
+                return True
+    return False
+
+
+def unpack_package(package, dsc_path, max_size, content_size_limit):
+    """Unpack the source package, whose files were downloaded next to
+    dsc_path, in memory.
+
+    Args:
+        package (dict): package information dictionary
+        dsc_path (str): path to the package's dsc file
+        max_size (int): maximum cumulated size of the package files
+        content_size_limit (int): size over which file data is not kept in
+          memory
+
+    Returns:
+        tuple: the root :class:`Directory` of the package, and the contents
+        of its ``debian/changelog``; or None if the package cannot be
+        unpacked exactly in memory
+
+    """
+    try:
+        return _unpack_package(package, dsc_path, max_size,
+                               content_size_limit)
+    except (UnpackUnsupported, tarfile.TarError, EOFError) as e:
+        log.debug('Cannot unpack %s_%s in memory: %s' %
+                  (package['name'], package['version'], e), extra={
+                      'swh_type': 'deb_unpack_fallback',
+                      'swh_name': package['name'],
+                      'swh_version': str(package['version']),
+                      'swh_reason': str(e),
+                  })
+        return None
+
+
+def _unpack_package(package, dsc_path, max_size, content_size_limit):
+    with open(dsc_path, 'rb') as dsc:
+        source_format = Dsc(dsc).get('Format', '').strip()
+
+    tarballs = _classify_files(package)
+    dsc_dir = os.path.dirname(dsc_path)
+    tree = _Tree(max_size, content_size_limit)
+
+    if source_format == '3.0 (native)' and set(tarballs) == {'native'}:
+        tree.add_tarball(os.path.join(dsc_dir, tarballs['native']))
+        tree.strip_single_directory()
+    elif (source_format == '3.0 (quilt)'
+          and set(tarballs) == {'orig', 'debian'}):
+        tree.add_tarball(os.path.join(dsc_dir, tarballs['orig']))
+        tree.strip_single_directory()
+        tree.root.pop(b'debian', None)
+        tree.add_tarball(os.path.join(dsc_dir, tarballs['debian']),
+                         prefix=b'debian')
+        if _has_patches(tree):
+            raise UnpackUnsupported('patches to apply')
+        pc = tree.get_dir([b'.pc'])
+        for name, data in QUILT_DB.items():
+            pc[name] = Content.from_bytes(mode=REGULAR_FILE_MODE, data=data)
+    else:
+        raise UnpackUnsupported('unsupported source format %s' %
+                                source_format)
+
+    debian = tree.get_dir([b'debian'], create=False) or {}
+    changelog = debian.get(b'changelog')
+    if (not isinstance(changelog, Content) or 'data' not in changelog.data
+            or changelog.data['perms'] == DentryPerms.symlink):
+        raise UnpackUnsupported('no regular debian/changelog')
+
+    return tree.to_directory(), changelog.data['data']